@@ -0,0 +1,26 @@
+# Example of an in-process hook that Superpaper calls after every
+# wallpaper change. Unlike run-after-wp-change.py no new Python process
+# is started for it.
+#
+# Put this file in the "hooks" folder in the config folder
+# (~/.config/superpaper/hooks or XDG_CONFIG_HOME/superpaper/hooks)
+# and list it in the general_settings file:
+#   hook_modules=example_hook
+# Several modules are separated by commas, and a function other than
+# on_wallpaper_change can be named with "module:function".
+# Installed packages can also provide hooks through the "superpaper.hooks"
+# entry point group.
+#
+# Hooks run on their own threads; one that is still running after
+# hook_timeout seconds (default 30) is skipped until it returns.
+
+import subprocess
+
+
+def on_wallpaper_change(event):
+    # event.outputfile  path of the composed wallpaper
+    # event.pieces      per display pieces if the wallpaper was set display by display
+    # event.sources     list of the source images
+    # event.profile     name of the profile
+    # event.timings     durations in seconds, e.g. {"render": 1.2, "set": 0.05}
+    subprocess.run(["gio", "open", event.outputfile])
@@ -3,7 +3,12 @@ Simple wrapper that makes the module structure of Superpaper
 compatible with PyInstaller builds.
 """
 
+import multiprocessing
+import sys
+
 from superpaper.__main__ import main
 
 if __name__ == '__main__':
-    main()
+    # render processes re-run the frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,18 @@
+"""
+Superpaper is a cross-platform multi monitor wallpaper manager.
+
+The package also offers its renderer as a library, see superpaper.renderer:
+
+    superpaper.render(sources, display_system, options) -> RenderResult
+"""
+
+_RENDERER_API = ("render", "DisplayLayout", "RenderOptions", "RenderResult")
+
+
+def __getattr__(name):
+    # The renderer is imported on first use, so that importing the package
+    # for the CLI or the tray applet stays light.
+    if name in _RENDERER_API:
+        import superpaper.renderer as renderer
+        return getattr(renderer, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
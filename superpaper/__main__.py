@@ -10,18 +10,23 @@ __author__ = "Henri Hänninen"
 
 import sys
 
-from superpaper.cli import cli_logic
-from superpaper.tray import tray_loop
-from superpaper.spanmode import set_spanmode
 
 def main():
-    """Runs tray applet if no command line arguments are passed, CLI parsing otherwise."""
-    set_spanmode()
+    """Runs tray applet if no command line arguments are passed, CLI parsing otherwise.
+
+    Returns the exit status of a CLI call. The heavy modules are imported only when needed so that CLI calls
+    served by a running instance start quickly.
+    """
     if len(sys.argv) <= 1:
+        from superpaper.spanmode import set_spanmode
+        from superpaper.tray import tray_loop
+        set_spanmode()
         tray_loop()
     else:
-        cli_logic()
+        from superpaper.cli import cli_logic
+        return cli_logic()
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,15 +1,34 @@
 """CLI for Superpaper. --help switch prints usage."""
 import argparse
+import json
 import logging
 import os
 import sys
 
 import superpaper.sp_paths as sp_paths
 import superpaper.sp_logging as sp_logging
-from superpaper.data import CLIProfileData
-import superpaper.wallpaper_processing as wpproc
-from superpaper.wallpaper_processing import get_display_data, refresh_display_data, change_wallpaper_job
-from superpaper.tray import tray_loop
+from superpaper.control import send_command
+
+
+def tray_loop(profile=None):
+    """Import and run the tray applet."""
+    from superpaper.spanmode import set_spanmode
+    from superpaper.tray import tray_loop as run_tray
+    set_spanmode()
+    run_tray(profile=profile)
+
+
+def report_reply(reply):
+    """Print the reply of the running instance, return exit status."""
+    if not reply.get("ok"):
+        sp_logging.G_LOGGER.error("Exception: %s", reply.get("error"))
+        if reply.get("profiles"):
+            sp_logging.G_LOGGER.error("Valid profile names are: (%s)", reply["profiles"])
+        return 1
+    reply = {key: val for key, val in reply.items() if key != "ok"}
+    if reply:
+        print(json.dumps(reply, indent=2))
+    return 0
 
 
 def cli_logic():
@@ -17,6 +36,8 @@ def cli_logic():
     CLI command parsing and enacting.
 
     Allows setting a wallpaper using Superpaper features without running the full application.
+    If Superpaper is already running, the command is sent to it over the control socket,
+    otherwise the work is done in this process.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--setimages", nargs='*',
@@ -47,6 +68,16 @@ def cli_logic():
                                 Must be in quotes.""")
     parser.add_argument("-d", "--debug", action="store_true",
                         help="Run the full application with debugging.")
+    parser.add_argument("-n", "--next", action="store_true",
+                        help="Change to the next wallpaper of the running profile.")
+    parser.add_argument("--previous", action="store_true",
+                        help="Go back to the previous wallpaper in the history.")
+    parser.add_argument("--pause", action="store_true",
+                        help="Pause or resume the slideshow of the running profile.")
+    parser.add_argument("--status", action="store_true",
+                        help="Print the state of the running instance.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Print timing measurements of the running instance.")
     args = parser.parse_args()
 
     if args.debug:
@@ -65,6 +96,22 @@ def cli_logic():
         sp_logging.G_LOGGER.info("Debugging: {}".format(args.debug))
     if args.debug and len(sys.argv) == 2:
         tray_loop()
+    elif args.next or args.previous or args.pause or args.status or args.metrics:
+        if args.next:
+            request = {"cmd": "next"}
+        elif args.previous:
+            request = {"cmd": "previous"}
+        elif args.pause:
+            request = {"cmd": "pause"}
+        elif args.status:
+            request = {"cmd": "status"}
+        else:
+            request = {"cmd": "metrics"}
+        reply = send_command(request)
+        if reply is None:
+            sp_logging.G_LOGGER.error("Exception: Superpaper is not running. Exiting.")
+            return 1
+        return report_reply(reply)
     else:
         if args.setimages and not args.profile:
             for filename in args.setimages:
@@ -73,6 +120,9 @@ def cli_logic():
 a file: (%s). Exiting.", filename)
                     exit()
         elif args.profile and not args.setimages:
+            reply = send_command({"cmd": "profile", "name": args.profile})
+            if reply is not None:
+                return report_reply(reply)
             if os.path.isfile(os.path.join(sp_paths.PROFILES_PATH, args.profile + ".profile")):
                 tray_loop(profile=os.path.join(sp_paths.PROFILES_PATH, args.profile + ".profile"))
             else:
@@ -87,12 +137,6 @@ wallpaper with '-s' or '--setimages', or a profile \
 to start Superpaper with using '-p' or '--profile'. \
 Exiting.""")
             exit()
-        if args.perspective:
-            refresh_display_data()
-            if args.perspective not in wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict:
-                sp_logging.G_LOGGER.error("Exception: Valid perspective profile names are: \
-%s." % list(wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict.keys()))
-                exit()
         spangrp = None
         if args.spangroups:
             # Parse spangroups
@@ -110,13 +154,39 @@ was not an integer: {}. Exiting.".format(grp))
 If passing manual offsets, give width and height offset for each display, even if \
 not actually offsetting every display. Exiting.")
             exit()
-        if args.command:
-            if len(args.command) > 1:
-                sp_logging.G_LOGGER.error("Exception: Remember to put the \
+        if args.command and len(args.command) > 1:
+            sp_logging.G_LOGGER.error("Exception: Remember to put the \
 custom command in quotes. Exiting.")
-                exit()
-            wpproc.G_SET_COMMAND_STRING = args.command[0]
+            exit()
+        if not args.command:
+            # A custom command would change the setter of the running
+            # instance, so that case is always done here.
+            reply = send_command({
+                "cmd": "set_images",
+                "files": [os.path.realpath(fname) for fname in args.setimages],
+                "advanced": args.advanced,
+                "perspective": args.perspective,
+                "spangroups": spangrp,
+                "offsets": args.offsets,
+            })
+            if reply is not None:
+                return report_reply(reply)
 
+        from superpaper.data import CLIProfileData
+        from superpaper.hooks import wait_for_hooks
+        from superpaper.spanmode import set_spanmode
+        import superpaper.wallpaper_processing as wpproc
+        from superpaper.wallpaper_processing import (get_display_data, refresh_display_data,
+                                                     change_wallpaper_job)
+        if args.command:
+            wpproc.G_SET_COMMAND_STRING = args.command[0]
+        set_spanmode()
+        if args.perspective:
+            refresh_display_data()
+            if args.perspective not in wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict:
+                sp_logging.G_LOGGER.error("Exception: Valid perspective profile names are: \
+%s." % list(wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict.keys()))
+                exit()
         get_display_data()
         refresh_display_data()
         profile = CLIProfileData(args.setimages,
@@ -127,4 +197,5 @@ custom command in quotes. Exiting.")
                                 )
         job_thread = change_wallpaper_job(profile, force=True)
         job_thread.join()
+        wait_for_hooks()
         return 0
@@ -2,7 +2,8 @@
 GUI dialogs for Superpaper.
 """
 import os
-import time
+from bisect import bisect_right
+from collections import OrderedDict
 
 import superpaper.perspective as persp
 import superpaper.sp_logging as sp_logging
@@ -11,6 +12,7 @@ from superpaper.data import GeneralSettingsData, ProfileData, TempProfileData, C
 from superpaper.message_dialog import show_message_dialog
 from superpaper.wallpaper_processing import NUM_DISPLAYS, get_display_data, change_wallpaper_job
 from superpaper.sp_paths import PATH, CONFIG_PATH, PROFILES_PATH
+from superpaper.thumbnails import get_thumbnail_service
 
 try:
     import wx
@@ -21,6 +23,133 @@ except ImportError:
 RESOURCES_PATH = os.path.join(PATH, "superpaper/resources")
 TRAY_ICON = os.path.join(RESOURCES_PATH, "superpaper.png")
 
+class PathListCtrl(wx.ListCtrl):
+    """
+    Virtual report list of wallpaper source paths with lazy thumbnails.
+
+    Rows live in a Python list and the control only asks for the visible
+    ones, so thumbnails are requested just for those. Thumbnail bitmaps
+    are kept in a fixed number of image list slots that are reused in
+    least recently used order, which bounds memory however many paths
+    are listed.
+    """
+    THUMB_SLOTS = 64
+
+    def __init__(self, parent, path_column, tsize, style, sort_rows=False):
+        wx.ListCtrl.__init__(self, parent, -1, size=(-1, -1), style=style|wx.LC_VIRTUAL)
+        self.rows = []  # (column texts, is_dir)
+        self.path_column = path_column
+        self.sort_rows = sort_rows
+        self.tsize = tsize
+        self.il = wx.ImageList(tsize[0], tsize[1])
+        self.folder_img = self.il.Add(
+            wx.ArtProvider.GetBitmap(wx.ART_FOLDER, wx.ART_TOOLBAR, tsize))
+        file_bmp = wx.ArtProvider.GetBitmap(wx.ART_NORMAL_FILE, wx.ART_TOOLBAR, tsize)
+        self.file_img = self.il.Add(file_bmp)
+        self.free_slots = [self.il.Add(file_bmp) for _ in range(self.THUMB_SLOTS)]
+        self.thumb_slots = OrderedDict()    # path -> image list index, LRU first
+        self.thumb_futures = OrderedDict()  # path -> pending thumbnail request
+        self.SetImageList(self.il, wx.IMAGE_LIST_SMALL)
+
+    def append_row(self, texts):
+        """Add a row of column texts. Sorted by the first column if sort_rows."""
+        row = (list(texts), os.path.isdir(texts[self.path_column]))
+        if self.sort_rows:
+            index = bisect_right([r[0][0] for r in self.rows], row[0][0])
+        else:
+            index = len(self.rows)
+        self.rows.insert(index, row)
+        self.SetItemCount(len(self.rows))
+        self.RefreshItems(index, len(self.rows) - 1)
+        return index
+
+    def delete_row(self, index):
+        """Remove the row at index."""
+        del self.rows[index]
+        self.SetItemCount(len(self.rows))
+        self.Refresh()
+
+    def row_texts(self):
+        """Return the column texts of all rows."""
+        return [list(texts) for texts, _ in self.rows]
+
+    def OnGetItemText(self, item, col):
+        return self.rows[item][0][col]
+
+    def OnGetItemImage(self, item):
+        texts, is_dir = self.rows[item]
+        if is_dir:
+            return self.folder_img
+        path = texts[self.path_column]
+        slot = self.thumb_slots.get(path)
+        if slot is not None:
+            self.thumb_slots.move_to_end(path)
+            return slot
+        self.request_thumbnail(path)
+        return self.file_img
+
+    def request_thumbnail(self, path):
+        """Request a thumbnail, dropping the oldest requests beyond the slot count."""
+        if path in self.thumb_futures:
+            self.thumb_futures.move_to_end(path)
+            return
+        self.thumb_futures[path] = get_thumbnail_service().request(
+            path,
+            lambda pth, thumb: wx.CallAfter(self.on_thumbnail_ready, pth, thumb)
+        )
+        while len(self.thumb_futures) > self.THUMB_SLOTS:
+            _, future = self.thumb_futures.popitem(last=False)
+            future.cancel()
+
+    def on_thumbnail_ready(self, path, thumb):
+        """Put a finished thumbnail in a slot and show it. Runs in UI thread."""
+        if not self:
+            # List has been destroyed.
+            return
+        self.thumb_futures.pop(path, None)
+        if thumb is None or path in self.thumb_slots:
+            return
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            _, slot = self.thumb_slots.popitem(last=False)
+        self.il.Replace(slot, self.create_thumb_bmp(thumb))
+        self.thumb_slots[path] = slot
+        top = self.GetTopItem()
+        bottom = min(top + self.GetCountPerPage(), len(self.rows) - 1)
+        if bottom >= top:
+            self.RefreshItems(top, bottom)
+
+    def cancel_thumbnails(self):
+        """Drop thumbnail requests that have not been started yet."""
+        for future in self.thumb_futures.values():
+            future.cancel()
+        self.thumb_futures.clear()
+
+    def create_thumb_bmp(self, pil_img):
+        wximg = wx.Image(pil_img.size[0], pil_img.size[1])
+        wximg.SetData(pil_img.convert("RGB").tobytes())
+        if pil_img.mode == "RGBA":
+            wximg.SetAlpha(pil_img.getchannel("A").tobytes())
+        imgsize = wximg.GetSize()
+        w2h_ratio = imgsize[0]/imgsize[1]
+        if w2h_ratio > 1:
+            target_w = self.tsize[0]
+            target_h = target_w/w2h_ratio
+            pos = (0, round((target_w - target_h)/2))
+        else:
+            target_h = self.tsize[1]
+            target_w = target_h*w2h_ratio
+            pos = (round((target_h - target_w)/2), 0)
+        bmp = wximg.Scale(round(target_w),
+                          round(target_h),
+                          quality=wx.IMAGE_QUALITY_BOX_AVERAGE
+                         ).Resize(self.tsize,
+                                  pos
+                                 ).ConvertToBitmap()
+        return bmp
+
+
 class BrowsePaths(wx.Dialog):
     """Path picker dialog class."""
     def __init__(self, parent, use_multi_image, defdir, num_span_groups=None):
@@ -31,7 +160,6 @@ class BrowsePaths(wx.Dialog):
         # self.SetMinSize((250, 250))
         BMP_SIZE = 32
         self.tsize = (BMP_SIZE, BMP_SIZE)
-        self.il = wx.ImageList(BMP_SIZE, BMP_SIZE)
 
         if num_span_groups:
             self.num_wallpaper_area = num_span_groups
@@ -116,86 +244,48 @@ class BrowsePaths(wx.Dialog):
 
     def create_paths_listctrl(self, use_multi_image):
         if use_multi_image:
-            self.paths_listctrl = wx.ListCtrl(self, -1,
-                                              size=(-1, -1),
-                                              style=wx.LC_REPORT
-                                              #  | wx.BORDER_SUNKEN
-                                              | wx.BORDER_SIMPLE
-                                              #  | wx.BORDER_STATIC
-                                              #  | wx.BORDER_THEME
-                                              #  | wx.BORDER_NONE
-                                              #  | wx.LC_EDIT_LABELS
-                                              | wx.LC_SORT_ASCENDING
-                                              #  | wx.LC_NO_HEADER
-                                              #  | wx.LC_VRULES
-                                              #  | wx.LC_HRULES
-                                              #  | wx.LC_SINGLE_SEL
-                                             )
+            self.paths_listctrl = PathListCtrl(self, 1, self.tsize,
+                                               sort_rows=True,
+                                               style=wx.LC_REPORT
+                                               #  | wx.BORDER_SUNKEN
+                                               | wx.BORDER_SIMPLE
+                                               #  | wx.BORDER_STATIC
+                                               #  | wx.BORDER_THEME
+                                               #  | wx.BORDER_NONE
+                                               #  | wx.LC_EDIT_LABELS
+                                               #  | wx.LC_NO_HEADER
+                                               #  | wx.LC_VRULES
+                                               #  | wx.LC_HRULES
+                                               #  | wx.LC_SINGLE_SEL
+                                              )
             self.paths_listctrl.InsertColumn(0, self.wp_area_name, wx.LIST_FORMAT_RIGHT, width=100)
             self.paths_listctrl.InsertColumn(1, 'Source', width=620)
         else:
             # show simpler listing without header if only one wallpaper target
-            self.paths_listctrl = wx.ListCtrl(self, -1,
-                                              size=(-1, -1),
-                                              style=wx.LC_REPORT
-                                              #  | wx.BORDER_SUNKEN
-                                              | wx.BORDER_SIMPLE
-                                              #  | wx.BORDER_STATIC
-                                              #  | wx.BORDER_THEME
-                                              #  | wx.BORDER_NONE
-                                              #  | wx.LC_EDIT_LABELS
-                                              #  | wx.LC_SORT_ASCENDING
-                                              | wx.LC_NO_HEADER
-                                              #  | wx.LC_VRULES
-                                              #  | wx.LC_HRULES
-                                              #  | wx.LC_SINGLE_SEL
-                                             )
+            self.paths_listctrl = PathListCtrl(self, 0, self.tsize,
+                                               style=wx.LC_REPORT
+                                               #  | wx.BORDER_SUNKEN
+                                               | wx.BORDER_SIMPLE
+                                               #  | wx.BORDER_STATIC
+                                               #  | wx.BORDER_THEME
+                                               #  | wx.BORDER_NONE
+                                               #  | wx.LC_EDIT_LABELS
+                                               | wx.LC_NO_HEADER
+                                               #  | wx.LC_VRULES
+                                               #  | wx.LC_HRULES
+                                               #  | wx.LC_SINGLE_SEL
+                                              )
             self.paths_listctrl.InsertColumn(0, 'Source', width=720)
-
-        # Add the item list to the control
-        self.paths_listctrl.SetImageList(self.il, wx.IMAGE_LIST_SMALL)
+        self.il = self.paths_listctrl.il
 
         self.sizer_paths_list.Add(self.paths_listctrl, 1, wx.CENTER|wx.ALL|wx.EXPAND, 5)
 
     def append_to_listctrl(self, data_row):
-        if self.use_multi_image:
-            img_id = self.add_to_imagelist(data_row[1])
-            index = self.paths_listctrl.InsertItem(self.paths_listctrl.GetItemCount(), data_row[0], img_id)
-            self.paths_listctrl.SetItem(index, 1, data_row[1])
-        else:
-            img_id = self.add_to_imagelist(data_row[0])
-            index = self.paths_listctrl.InsertItem(self.paths_listctrl.GetItemCount(), data_row[0], img_id)
-            # self.paths_listctrl.SetItem(index, 1, data[1])
-
-    def add_to_imagelist(self, path):
-        folder_bmp =  wx.ArtProvider.GetBitmap(wx.ART_FOLDER, wx.ART_TOOLBAR, self.tsize)
-        # file_bmp =  wx.ArtProvider.GetBitmap(wx.ART_NORMAL_FILE, wx.ART_TOOLBAR, self.tsize)
-        if os.path.isdir(path):
-            img_id = self.il.Add(folder_bmp)
-        else:
-            thumb_bmp = self.create_thumb_bmp(path)
-            img_id = self.il.Add(thumb_bmp)
-        return img_id
+        self.paths_listctrl.append_row(data_row)
 
-    def create_thumb_bmp(self, filename):
-        wximg = wx.Image(filename, type=wx.BITMAP_TYPE_ANY)
-        imgsize = wximg.GetSize()
-        w2h_ratio = imgsize[0]/imgsize[1]
-        if w2h_ratio > 1:
-            target_w = self.tsize[0]
-            target_h = target_w/w2h_ratio
-            pos = (0, round((target_w - target_h)/2))
-        else:
-            target_h = self.tsize[1]
-            target_w = target_h*w2h_ratio
-            pos = (round((target_h - target_w)/2), 0)
-        bmp = wximg.Scale(round(target_w),
-                          round(target_h),
-                          quality=wx.IMAGE_QUALITY_BOX_AVERAGE
-                         ).Resize(self.tsize,
-                                  pos
-                                 ).ConvertToBitmap()
-        return bmp
+    def cancel_thumbnails(self):
+        """Drop thumbnail requests that have not been started yet."""
+        self.paths_listctrl.cancel_thumbnails()
 
     #
     # BUTTON methods
@@ -217,7 +307,7 @@ class BrowsePaths(wx.Dialog):
         """Removes last appended path from export field."""
         item = self.paths_listctrl.GetFocusedItem()
         if item != -1:
-            self.paths_listctrl.DeleteItem(item)
+            self.paths_listctrl.delete_row(item)
 
     def onDefDir(self, event):
         sel_path = self.dir3.GetPath()
@@ -241,19 +331,16 @@ class BrowsePaths(wx.Dialog):
 
     def onOk(self, event):
         """Exports path to parent Profile Config dialog."""
-        columns = self.paths_listctrl.GetColumnCount()
-        for idx in range(self.paths_listctrl.GetItemCount()):
-            item_dat = []
-            for col in range(columns):
-                item_dat.append(self.paths_listctrl.GetItemText(idx, col))
-            self.path_list_data.append(item_dat)
+        self.path_list_data.extend(self.paths_listctrl.row_texts())
         # print(self.path_list_data)
         # if listctrl is empty, onOk maybe could pass on the selected item? or disable OK if list is empty?
+        self.cancel_thumbnails()
         self.EndModal(wx.ID_OK)
 
 
     def onCancel(self, event):
         """Closes path picker, throwing away selections."""
+        self.cancel_thumbnails()
         self.Destroy()
 
 
@@ -443,8 +530,8 @@ class DisplayPositionEntry(wx.Frame):
         self.display_sys.update_ppinorm_offsets(offs)
         self.parent.display_data = self.display_sys.get_disp_list(True)
         self.parent.refresh_preview(use_ppi_px=True, force_refresh=True)
-        self.parent.create_shapes()
-        self.parent.frame.Refresh()
+        self.parent.update_shapes()
+        self.parent.Refresh(False)
 
         self.populate_fields()
         return True
@@ -469,8 +556,8 @@ class DisplayPositionEntry(wx.Frame):
         # redraw preview with restored data
         self.parent.display_data = self.display_sys.get_disp_list(True)
         self.parent.refresh_preview(use_ppi_px=True, force_refresh=True)
-        self.parent.create_shapes()
-        self.parent.frame.Refresh()
+        self.parent.update_shapes()
+        self.parent.Refresh(False)
         # close dialog
         self.parent.button_save.Enable()
         self.parent.button_cancel.Enable()
@@ -1089,27 +1176,22 @@ class PerspectiveConfig(wx.Dialog):
             for pix in off:
                 flat_offsets.append(pix)
 
-        busy = wx.BusyCursor()
-
         # Save entered perspective values and get its name
         save_succ = self.onSave()
         if save_succ == 0:
             # Save failed or canceled, abort test.
-            del busy
             return 0
         perspective = self.choice_profiles.GetString(
             self.choice_profiles.GetSelection()
         )
 
-        wx.Yield()
         # Use the simplified CLI profile class
         wpproc.refresh_display_data()
         profile = CLIProfileData(testimage, advanced=True,
             perspective=perspective, spangroups=None, offsets=flat_offsets)
-        thrd = change_wallpaper_job(profile, force=True)
-        while thrd.is_alive():
-            time.sleep(0.5)
-        del busy
+        job = change_wallpaper_job(profile, force=True)
+        if job:
+            RenderProgressDialog(self, job, "Alignment test", on_done=report_render_result)
         return 1
 
     def onChooseTestImage(self, event):
@@ -1235,6 +1317,72 @@ class PerspectiveConfig(wx.Dialog):
 
 
 
+class RenderProgressDialog(wx.Dialog):
+    """
+    Non-modal progress of a wallpaper render with a cancel button.
+
+    Progress events of the RenderJob arrive on the render thread and are
+    handed over with wx.CallAfter. on_done(job) is called on the GUI thread
+    once the job has finished, after which the dialog closes itself.
+    """
+    STAGE_LABELS = {
+        "load": "Loading image...",
+        "display": "Rendering display {}...",
+        "compose": "Composing wallpaper...",
+        "set": "Setting wallpaper...",
+    }
+
+    def __init__(self, parent, job, title="Rendering wallpaper", on_done=None):
+        wx.Dialog.__init__(self, parent, -1, title,
+                           style=wx.DEFAULT_DIALOG_STYLE|wx.FRAME_FLOAT_ON_PARENT)
+        self.job = job
+        self.on_done = on_done
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        self.st_stage = wx.StaticText(self, -1, "Waiting for the renderer...")
+        self.gauge = wx.Gauge(self, -1, range=100, size=(300, -1))
+        self.button_cancel = wx.Button(self, wx.ID_CANCEL, "Cancel")
+        self.button_cancel.Bind(wx.EVT_BUTTON, self.onCancel)
+        self.Bind(wx.EVT_CLOSE, self.onCancel)
+        sizer.Add(self.st_stage, 0, wx.ALL|wx.EXPAND, 10)
+        sizer.Add(self.gauge, 0, wx.LEFT|wx.RIGHT|wx.EXPAND, 10)
+        sizer.Add(self.button_cancel, 0, wx.ALL|wx.ALIGN_RIGHT, 10)
+        self.SetSizerAndFit(sizer)
+        self.CenterOnParent()
+        self.Show()
+        job.add_progress_callback(lambda event: wx.CallAfter(self.update_progress, event))
+        job.add_done_callback(lambda job: wx.CallAfter(self.finish, job))
+
+    def update_progress(self, event):
+        """Show a RenderProgress."""
+        if not self:
+            return  # dialog already destroyed
+        self.st_stage.SetLabel(
+            self.STAGE_LABELS.get(event.stage, event.stage).format(event.completed)
+        )
+        self.gauge.SetValue(int(100 * event.fraction))
+
+    def finish(self, job):
+        """Apply the result and close."""
+        if self.on_done:
+            self.on_done(job)
+        if self:
+            self.Destroy()
+
+    def onCancel(self, event):
+        """Ask the render to stop, the dialog closes once it has."""
+        self.job.cancel()
+        self.st_stage.SetLabel("Cancelling...")
+        self.button_cancel.Disable()
+
+
+def report_render_result(job):
+    """Tell the user if a GUI started render did not finish."""
+    if job.state == "failed":
+        show_message_dialog("Setting the wallpaper failed: {}".format(job.exception), "Error")
+    elif sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("GUI render finished: %s", job)
+
+
 class SettingsFrame(wx.Frame):
     """Settings dialog frame."""
     def __init__(self, parent_tray_obj):
@@ -1256,19 +1404,21 @@ class SettingsPanel(wx.Panel):
         self.frame = parent
         self.parent_tray_obj = parent_tray_obj
         self.sizer_main = wx.BoxSizer(wx.VERTICAL)
-        self.sizer_grid_settings = wx.GridSizer(6, 2, 5, 5)
+        self.sizer_grid_settings = wx.GridSizer(7, 2, 5, 5)
         self.sizer_buttons = wx.BoxSizer(wx.HORIZONTAL)
         pnl = self
         st_logging = wx.StaticText(pnl, -1, "Logging")
         st_usehotkeys = wx.StaticText(pnl, -1, "Use hotkeys")
         st_warn_large = wx.StaticText(pnl, -1, "Large image warning")
         st_hk_next = wx.StaticText(pnl, -1, "Hotkey: Next wallpaper")
+        st_hk_previous = wx.StaticText(pnl, -1, "Hotkey: Previous wallpaper")
         st_hk_pause = wx.StaticText(pnl, -1, "Hotkey: Pause slideshow")
         st_setcmd = wx.StaticText(pnl, -1, "Custom command")
         self.cb_logging = wx.CheckBox(pnl, -1, "")
         self.cb_usehotkeys = wx.CheckBox(pnl, -1, "")
         self.cb_warn_large = wx.CheckBox(pnl, -1, "")
         self.tc_hk_next = wx.TextCtrl(pnl, -1, size=(200, -1))
+        self.tc_hk_previous = wx.TextCtrl(pnl, -1, size=(200, -1))
         self.tc_hk_pause = wx.TextCtrl(pnl, -1, size=(200, -1))
         self.tc_setcmd = wx.TextCtrl(pnl, -1, size=(200, -1))
 
@@ -1282,6 +1432,8 @@ class SettingsPanel(wx.Panel):
                 (self.cb_warn_large, 0, wx.ALIGN_LEFT),
                 (st_hk_next, 0, wx.ALIGN_RIGHT),
                 (self.tc_hk_next, 0, wx.ALIGN_LEFT),
+                (st_hk_previous, 0, wx.ALIGN_RIGHT),
+                (self.tc_hk_previous, 0, wx.ALIGN_LEFT),
                 (st_hk_pause, 0, wx.ALIGN_RIGHT),
                 (self.tc_hk_pause, 0, wx.ALIGN_LEFT),
                 (st_setcmd, 0, wx.ALIGN_RIGHT),
@@ -1308,11 +1460,14 @@ class SettingsPanel(wx.Panel):
         self.cb_usehotkeys.SetValue(g_settings.use_hotkeys)
         self.cb_warn_large.SetValue(g_settings.warn_large_img)
         self.tc_hk_next.ChangeValue(self.show_hkbinding(g_settings.hk_binding_next))
+        self.tc_hk_previous.ChangeValue(self.show_hkbinding(g_settings.hk_binding_previous))
         self.tc_hk_pause.ChangeValue(self.show_hkbinding(g_settings.hk_binding_pause))
         self.tc_setcmd.ChangeValue(g_settings.set_command)
 
     def show_hkbinding(self, hktuple):
         """Formats hotkey tuple as a readable string."""
+        if not hktuple:
+            return ""
         hkstring = "+".join(hktuple)
         return hkstring
 
@@ -1329,6 +1484,12 @@ class SettingsPanel(wx.Panel):
             )
         else:
             current_settings.hk_binding_next = None
+        if self.tc_hk_previous.GetLineText(0):
+            current_settings.hk_binding_previous = tuple(
+                self.tc_hk_previous.GetLineText(0).strip().split("+")
+            )
+        else:
+            current_settings.hk_binding_previous = None
         if self.tc_hk_pause.GetLineText(0):
             current_settings.hk_binding_pause = tuple(
                 self.tc_hk_pause.GetLineText(0).strip().split("+")
@@ -0,0 +1,286 @@
+"""
+Local control socket of a running Superpaper instance.
+
+The tray application listens on a Unix domain socket so that the command
+line interface can hand its work to the running instance instead of
+starting the whole application, querying the displays and parsing the
+profiles again. The protocol is one JSON object per line in each
+direction, e.g.
+
+    {"cmd": "next"}                      -> {"ok": true}
+    {"cmd": "profile", "name": "foo"}    -> {"ok": true}
+    {"cmd": "status"}                    -> {"ok": true, "profile": "foo", ...}
+
+Commands: ping, status, metrics, next, previous, pause, profile, set_images.
+
+This module is imported by the CLI before anything else, so it must only
+depend on the standard library and the light Superpaper modules.
+"""
+
+import json
+import os
+import socket
+import threading
+
+import superpaper.sp_logging as sp_logging
+from superpaper.sp_paths import TEMP_PATH
+
+CONTROL_TIMEOUT = 60    # seconds, e.g. a set_images waits for the render
+MAX_REQUEST_SIZE = 1 << 20
+
+
+def control_socket_path():
+    """Return the path of the control socket."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "superpaper-control.sock")
+    return os.path.join(TEMP_PATH, "control.sock")
+
+
+def control_supported():
+    """Test if the platform supports Unix domain sockets."""
+    return hasattr(socket, "AF_UNIX")
+
+
+def send_command(request, timeout=CONTROL_TIMEOUT, path=None):
+    """Send a request dict to the running instance and return its reply.
+
+    Returns None if no instance is listening.
+    """
+    if not control_supported():
+        return None
+    if path is None:
+        path = control_socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    try:
+        with sock, sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            line = stream.readline(MAX_REQUEST_SIZE)
+    except OSError as excep:
+        return {"ok": False, "error": "Connection to the running instance failed: {}".format(excep)}
+    if not line:
+        return {"ok": False, "error": "The running instance closed the connection."}
+    try:
+        return json.loads(line.decode("utf-8"))
+    except ValueError:
+        return {"ok": False, "error": "The running instance sent an invalid reply."}
+
+
+class ControlServer():
+    """
+    Serves control requests on a Unix domain socket.
+
+    handler(request) is called on a per connection thread with the
+    request dict and returns the reply dict.
+    """
+    def __init__(self, handler, path=None):
+        self.handler = handler
+        self.path = path if path else control_socket_path()
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        """Bind the socket and start serving. Returns False if that's not possible."""
+        if not control_supported():
+            return False
+        if send_command({"cmd": "ping"}, timeout=2, path=self.path) is not None:
+            sp_logging.G_LOGGER.info("Another instance is listening on %s.", self.path)
+            return False
+        if os.path.exists(self.path):
+            # stale socket of an instance that didn't exit cleanly
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        except OSError as excep:
+            sp_logging.G_LOGGER.info("Could not bind control socket %s: %s", self.path, excep)
+            sock.close()
+            return False
+        finally:
+            os.umask(old_umask)
+        sock.listen(8)
+        self.sock = sock
+        self.thread = threading.Thread(target=self._accept_loop, name="sp-control", daemon=True)
+        self.thread.start()
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Listening for control commands on %s", self.path)
+        return True
+
+    def stop(self):
+        """Close the socket and remove its file."""
+        if self.sock is None:
+            return
+        sock = self.sock
+        self.sock = None
+        sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _accept_loop(self):
+        while self.sock is not None:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,),
+                             name="sp-control-conn", daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rwb") as stream:
+            try:
+                line = stream.readline(MAX_REQUEST_SIZE)
+                if not line:
+                    return
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    reply = {"ok": False, "error": "Request is not valid JSON."}
+                else:
+                    try:
+                        reply = self.handler(request)
+                    except Exception as excep:
+                        sp_logging.G_LOGGER.exception("Control request failed: %s", request)
+                        reply = {"ok": False, "error": str(excep)}
+                stream.write(json.dumps(reply).encode("utf-8") + b"\n")
+                stream.flush()
+            except OSError as excep:
+                sp_logging.G_LOGGER.info("Control connection failed: %s", excep)
+
+
+class TrayControlHandler():
+    """
+    Carries out control requests on the running tray application.
+
+    Commands that use the tray state are run on the wx main thread, like
+    the menu and hotkey actions, and the connection thread waits for
+    their reply.
+    """
+    def __init__(self, tray):
+        self.tray = tray
+        self.commands = {
+            "ping": self.ping,
+            "status": self.status,
+            "metrics": self.metrics,
+            "next": self.next_wallpaper,
+            "previous": self.previous_wallpaper,
+            "pause": self.pause,
+            "profile": self.profile,
+            "set_images": self.set_images,
+        }
+        self.gui_commands = {self.status, self.next_wallpaper, self.previous_wallpaper,
+                             self.pause, self.profile}
+
+    def __call__(self, request):
+        command = self.commands.get(request.get("cmd"))
+        if command is None:
+            return {"ok": False, "error": "Unknown command: {}".format(request.get("cmd"))}
+        if command in self.gui_commands:
+            return self.call_on_gui_thread(command, request)
+        return command(request)
+
+    @staticmethod
+    def call_on_gui_thread(command, request):
+        """Run command(request) on the wx main thread and return its reply."""
+        import wx
+        done = threading.Event()
+        replies = []
+
+        def run():
+            try:
+                replies.append(command(request))
+            except Exception as excep:
+                sp_logging.G_LOGGER.exception("Control request failed: %s", request)
+                replies.append({"ok": False, "error": str(excep)})
+            finally:
+                done.set()
+
+        wx.CallAfter(run)
+        if not done.wait(CONTROL_TIMEOUT):
+            return {"ok": False, "error": "The running instance did not respond in time."}
+        return replies[0]
+
+    def ping(self, request):
+        return {"ok": True}
+
+    def status(self, request):
+        import superpaper.wallpaper_processing as wpproc
+        tray = self.tray
+        timer = tray.repeating_timer
+        return {
+            "ok": True,
+            "profile": tray.active_profile.name if tray.active_profile else None,
+            "slideshow": bool(timer is not None and timer.is_running),
+            "paused": tray.is_paused,
+            "displays": wpproc.NUM_DISPLAYS,
+            "profiles": [prof.name for prof in tray.list_of_profiles],
+        }
+
+    def metrics(self, request):
+        import superpaper.sp_metrics as sp_metrics
+        return {"ok": True, "metrics": sp_metrics.snapshot()}
+
+    def next_wallpaper(self, request):
+        if self.tray.active_profile is None:
+            return {"ok": False, "error": "No profile is running."}
+        self.tray.next_wallpaper(None)
+        return {"ok": True}
+
+    def previous_wallpaper(self, request):
+        import superpaper.history as history
+        if history.get_history().step(-1, move=False) is None:
+            return {"ok": False, "error": "There is no earlier wallpaper in the history."}
+        self.tray.previous_wallpaper(None)
+        return {"ok": True}
+
+    def pause(self, request):
+        """Toggle the slideshow pause, or set it with "paused": true/false."""
+        wanted = request.get("paused")
+        if wanted is None or bool(wanted) != self.tray.is_paused:
+            self.tray.pause_timer(None)
+        return {"ok": True, "paused": self.tray.is_paused}
+
+    def profile(self, request):
+        self.tray.reload_profiles(None)
+        profile = self.tray.get_profile_by_name(request.get("name"))
+        if profile is None:
+            return {"ok": False,
+                    "error": "No profile was found by the given name: {}".format(request.get("name")),
+                    "profiles": sorted(prof.name for prof in self.tray.list_of_profiles)}
+        self.tray.start_profile(None, profile, force_reload=True)
+        return {"ok": True}
+
+    def set_images(self, request):
+        import superpaper.wallpaper_processing as wpproc
+        from superpaper.data import CLIProfileData
+        files = request.get("files") or []
+        for fname in files:
+            if not os.path.isfile(fname):
+                return {"ok": False, "error": "Not a file: {}".format(fname)}
+        perspective = request.get("perspective")
+        if (perspective
+                and perspective not in wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict):
+            return {"ok": False,
+                    "error": "Valid perspective profile names are: {}".format(
+                        list(wpproc.G_ACTIVE_DISPLAYSYSTEM.perspective_dict.keys()))}
+        profile = CLIProfileData(files,
+                                 request.get("advanced", False),
+                                 perspective,
+                                 request.get("spangroups"),
+                                 request.get("offsets"))
+        job = wpproc.change_wallpaper_job(profile, force=True)
+        job.join(CONTROL_TIMEOUT)
+        if job.state != "done":
+            return {"ok": False, "error": "Render {}.".format(job.state)}
+        return {"ok": True}
@@ -12,8 +12,16 @@ import random
 import datetime
 import sys
 
+import superpaper.governor as governor
+import superpaper.history as history
+import superpaper.hooks as hooks
+import superpaper.mipmaps as mipmaps
+import superpaper.power as power
+import superpaper.profile_schedule as profile_schedule
+import superpaper.render_process as render_process
 import superpaper.sp_logging as sp_logging
 from superpaper.message_dialog import show_message_dialog
+from superpaper.packed_paths import IndexPermutation, PackedPathList
 import superpaper.wallpaper_processing as wpproc
 import superpaper.sp_paths as sp_paths
 from superpaper.sp_paths import (PATH, CONFIG_PATH, PROFILES_PATH, TEMP_PATH)
@@ -95,6 +103,16 @@ def write_active_profile(profname):
 
 
 
+# Resource governor limits in general_settings: key -> (governor attribute, type)
+GOVERNOR_SETTINGS = {
+    "render_nice": ("RENDER_NICE", int),
+    "render_ioprio": ("RENDER_IOPRIO", int),
+    "render_workers": ("MAX_WORKERS", int),
+    "render_memory_mb": ("JOB_MEMORY_MB", int),
+    "cpu_pressure_limit": ("CPU_PRESSURE_LIMIT", float),
+}
+
+
 class GeneralSettingsData(object):
     """Object to store and save application wide settings."""
 
@@ -103,10 +121,26 @@ class GeneralSettingsData(object):
         self.use_hotkeys = True
         self.hk_binding_next = None
         self.hk_binding_pause = None
+        self.hk_binding_previous = None
         self.set_command = ""
         self.browse_default_dir = ""
         self.show_help = True
         self.warn_large_img = True
+        self.hook_modules = []
+        self.hook_timeout = hooks.HOOK_TIMEOUT
+        self.topology_variants = wpproc.TOPOLOGY_VARIANTS_MAX
+        self.progressive_apply = wpproc.PROGRESSIVE_APPLY
+        self.power_aware = power.POWER_AWARE
+        self.battery_interval_factor = power.BATTERY_INTERVAL_FACTOR
+        self.governor_limits = {key: getattr(governor, attr)
+                                for key, (attr, _) in GOVERNOR_SETTINGS.items()}
+        self.profile_schedule = []
+        self.profile_schedule_lead = 120
+        self.history_max_mb = history.HISTORY_MAX_MB
+        self.render_processes = render_process.RENDER_PROCESSES
+        self.render_process_jobs = render_process.RENDER_PROCESS_JOBS
+        self.mipmap_cache = mipmaps.MIPMAP_CACHE
+        self.mipmap_max_mb = mipmaps.MIPMAP_MAX_MB
         self.parse_settings()
 
     def parse_settings(self):
@@ -148,6 +182,13 @@ class GeneralSettingsData(object):
                             self.hk_binding_next = tuple(binding_strings)
                         if sp_logging.DEBUG:
                             sp_logging.G_LOGGER.info("hk_binding_next: %s", self.hk_binding_next)
+                    elif words[0] == "previous wallpaper hotkey":
+                        binding_strings = words[1].strip().split("+")
+                        if binding_strings and binding_strings[0]:
+                            self.hk_binding_previous = tuple(binding_strings)
+                        if sp_logging.DEBUG:
+                            sp_logging.G_LOGGER.info("hk_binding_previous: %s",
+                                                     self.hk_binding_previous)
                     elif words[0] == "pause wallpaper hotkey":
                         binding_strings = words[1].strip().split("+")
                         if binding_strings:
@@ -171,6 +212,80 @@ class GeneralSettingsData(object):
                             pass
                     elif words[0].strip() == "browse_default_dir":
                         self.browse_default_dir = words[1].strip()
+                    elif words[0].strip() == "hook_modules":
+                        self.hook_modules = [mod.strip() for mod in words[1].split(",")
+                                             if mod.strip()]
+                        hooks.HOOK_MODULES = self.hook_modules
+                    elif words[0].strip() == "hook_timeout":
+                        try:
+                            self.hook_timeout = float(words[1].strip())
+                            hooks.HOOK_TIMEOUT = self.hook_timeout
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid hook_timeout: %s", words[1])
+                    elif words[0].strip() == "topology_variants":
+                        try:
+                            self.topology_variants = max(0, int(words[1].strip()))
+                            wpproc.TOPOLOGY_VARIANTS_MAX = self.topology_variants
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid topology_variants: %s", words[1])
+                    elif words[0].strip() == "progressive_apply":
+                        self.progressive_apply = bool(words[1].strip().lower() == "true")
+                        wpproc.PROGRESSIVE_APPLY = self.progressive_apply
+                    elif words[0].strip() == "power_aware":
+                        self.power_aware = bool(words[1].strip().lower() != "false")
+                        power.POWER_AWARE = self.power_aware
+                    elif words[0].strip() == "battery_interval_factor":
+                        try:
+                            self.battery_interval_factor = max(1.0, float(words[1].strip()))
+                            power.BATTERY_INTERVAL_FACTOR = self.battery_interval_factor
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid battery_interval_factor: %s",
+                                                     words[1])
+                    elif words[0].strip() == "profile_schedule":
+                        # the rules contain '=' too
+                        self.profile_schedule = profile_schedule.parse_profile_schedule(
+                            "=".join(words[1:]))
+                    elif words[0].strip() == "profile_schedule_lead":
+                        try:
+                            self.profile_schedule_lead = max(0, int(words[1].strip()))
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid profile_schedule_lead: %s", words[1])
+                    elif words[0].strip() == "history_max_mb":
+                        try:
+                            self.history_max_mb = max(0, int(words[1].strip()))
+                            history.HISTORY_MAX_MB = self.history_max_mb
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid history_max_mb: %s", words[1])
+                    elif words[0].strip() == "render_processes":
+                        try:
+                            self.render_processes = max(0, int(words[1].strip()))
+                            if render_process.HAVE_SHARED_MEMORY:
+                                render_process.RENDER_PROCESSES = self.render_processes
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid render_processes: %s", words[1])
+                    elif words[0].strip() == "render_process_jobs":
+                        try:
+                            self.render_process_jobs = max(1, int(words[1].strip()))
+                            render_process.RENDER_PROCESS_JOBS = self.render_process_jobs
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid render_process_jobs: %s", words[1])
+                    elif words[0].strip() == "mipmap_cache":
+                        self.mipmap_cache = bool(words[1].strip().lower() == "true")
+                        mipmaps.MIPMAP_CACHE = self.mipmap_cache
+                    elif words[0].strip() == "mipmap_max_mb":
+                        try:
+                            self.mipmap_max_mb = max(0, int(words[1].strip()))
+                            mipmaps.MIPMAP_MAX_MB = self.mipmap_max_mb
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid mipmap_max_mb: %s", words[1])
+                    elif words[0].strip() in GOVERNOR_SETTINGS:
+                        key = words[0].strip()
+                        attr, conv = GOVERNOR_SETTINGS[key]
+                        try:
+                            self.governor_limits[key] = conv(words[1].strip())
+                            setattr(governor, attr, self.governor_limits[key])
+                        except ValueError:
+                            sp_logging.G_LOGGER.info("Invalid %s: %s", key, words[1])
                     else:
                         sp_logging.G_LOGGER.info("GeneralSettings parse Exception: Unkown general setting: %s",
                                                  words[0])
@@ -188,6 +303,8 @@ class GeneralSettingsData(object):
             self.hk_binding_next = ("control", "super", "w")
             general_settings_file.write("pause wallpaper hotkey=control+super+shift+p\n")
             self.hk_binding_pause = ("control", "super", "shift", "p")
+            general_settings_file.write("previous wallpaper hotkey=control+super+shift+w\n")
+            self.hk_binding_previous = ("control", "super", "shift", "w")
             general_settings_file.write("set_command=\n")
             general_settings_file.write("browse_default_dir=\n")
             general_settings_file.write("warn_large_img=true")
@@ -217,6 +334,10 @@ class GeneralSettingsData(object):
             hk_string_p = "+".join(self.hk_binding_pause)
             general_settings_file.write("pause wallpaper hotkey={}\n".format(hk_string_p))
 
+        if self.hk_binding_previous:
+            hk_string_prev = "+".join(self.hk_binding_previous)
+            general_settings_file.write("previous wallpaper hotkey={}\n".format(hk_string_prev))
+
         if self.show_help:
             general_settings_file.write("show_help_at_start=true\n")
         else:
@@ -224,6 +345,32 @@ class GeneralSettingsData(object):
 
         general_settings_file.write("set_command={}\n".format(self.set_command))
         general_settings_file.write("browse_default_dir={}\n".format(self.browse_default_dir))
+        general_settings_file.write("hook_modules={}\n".format(",".join(self.hook_modules)))
+        general_settings_file.write("hook_timeout={}\n".format(self.hook_timeout))
+        general_settings_file.write("topology_variants={}\n".format(self.topology_variants))
+        if self.progressive_apply:
+            general_settings_file.write("progressive_apply=true\n")
+        else:
+            general_settings_file.write("progressive_apply=false\n")
+        if self.power_aware:
+            general_settings_file.write("power_aware=true\n")
+        else:
+            general_settings_file.write("power_aware=false\n")
+        general_settings_file.write(
+            "battery_interval_factor={}\n".format(self.battery_interval_factor))
+        for key in GOVERNOR_SETTINGS:
+            general_settings_file.write("{}={}\n".format(key, self.governor_limits[key]))
+        general_settings_file.write("profile_schedule={}\n".format(
+            profile_schedule.profile_schedule_str(self.profile_schedule)))
+        general_settings_file.write("profile_schedule_lead={}\n".format(self.profile_schedule_lead))
+        general_settings_file.write("history_max_mb={}\n".format(self.history_max_mb))
+        general_settings_file.write("render_processes={}\n".format(self.render_processes))
+        general_settings_file.write("render_process_jobs={}\n".format(self.render_process_jobs))
+        if self.mipmap_cache:
+            general_settings_file.write("mipmap_cache=true\n")
+        else:
+            general_settings_file.write("mipmap_cache=false\n")
+        general_settings_file.write("mipmap_max_mb={}\n".format(self.mipmap_max_mb))
 
         if self.warn_large_img:
             general_settings_file.write("warn_large_img=true")
@@ -493,9 +640,13 @@ class ProfileData(object):
                 "Bezel px calculation: resulting combined manual offset: %s",
                 self.manual_offsets)
 
-    def next_wallpaper_files(self, peek=False):
-        """Asks the file handler iterator for next image(s) for the wallpaper."""
-        return self.file_handler.next_wallpaper_files(peek=peek)
+    def next_wallpaper_files(self, peek=False, indices=None):
+        """Asks the file handler iterator for next image(s) for the wallpaper.
+
+        If indices is given, only those image lists advance and the others
+        return their current image.
+        """
+        return self.file_handler.next_wallpaper_files(peek=peek, indices=indices)
 
     class Filehandler(object):
         """
@@ -506,6 +657,8 @@ class ProfileData(object):
         orders the list according to sortmode. Allows for shuffling of the
         wallpapers, i.e. non-repeating randomized list, which is re-randomized
         once it has been exhausted.
+
+        The lists are PackedPathLists, so huge libraries stay compact.
         """
         def __init__(self, paths_array, sortmode):
             # A list of lists if there is more than one monitor with distinct
@@ -514,7 +667,7 @@ class ProfileData(object):
             self.paths_array = paths_array
             self.sortmode = sortmode
             for paths_list in paths_array:
-                list_of_images = []
+                list_of_images = PackedPathList()
                 for path in paths_list:
                     # Add list items to the end of the list instead of
                     # appending the list to the list.
@@ -528,14 +681,15 @@ Use absolute paths for best reliabilty.".format(path)
                         # List only images that are of supported type.
                         if os.path.isfile(path):
                             if path.lower().endswith(wpproc.G_SUPPORTED_IMAGE_EXTENSIONS):
-                                list_of_images += [path]
+                                list_of_images.append(path)
                             else:
                                 pass
                         else:
-                            list_of_images += [os.path.join(path, f)
-                                            for f in os.listdir(path)
-                                            if f.lower().endswith(wpproc.G_SUPPORTED_IMAGE_EXTENSIONS)
-                                            ]
+                            with os.scandir(path) as entries:
+                                for entry in entries:
+                                    if entry.name.lower().endswith(
+                                            wpproc.G_SUPPORTED_IMAGE_EXTENSIONS):
+                                        list_of_images.append_name(path, entry.name)
                 # Append the list of monitor_i specific files to the list of
                 # lists of images.
                 self.all_files_in_paths.append(list_of_images)
@@ -546,13 +700,19 @@ Use absolute paths for best reliabilty.".format(path)
                         diplay_image_list,
                         self.sortmode))
 
-        def next_wallpaper_files(self, peek=False):
-            """Calls its internal iterators to give the next image for each monitor."""
+        def next_wallpaper_files(self, peek=False, indices=None):
+            """Calls its internal iterators to give the next image for each monitor.
+
+            Iterators not in indices, if given, keep their current image.
+            """
             files = []
-            for iterable in self.iterators:
+            for index, iterable in enumerate(self.iterators):
                 if peek:
                     next_image = iterable.__peek__()
                     # print("PEEKED: {}".format(next_image))
+                elif (indices is not None and index not in indices
+                      and iterable.current is not None):
+                    next_image = iterable.current
                 else:
                     next_image = iterable.__next__()
                     # print("NEXT: {}".format(next_image))
@@ -563,53 +723,66 @@ Use absolute paths for best reliabilty.".format(path)
                     if sp_logging.DEBUG:
                         sp_logging.G_LOGGER.info("Ran into an invalid file, reinitializing..")
                     self.__init__(self.paths_array, self.sortmode)
-                    files = self.next_wallpaper_files()
+                    files = self.next_wallpaper_files(indices=indices)
                     break
             return files
 
         class ImageList:
-            """Image list iterable that can reinitialize itself once it has been gone through."""
+            """
+            Image list iterable that can reinitialize itself once it has been gone through.
+
+            Shuffled orders are an IndexPermutation over the list, so a new
+            round costs no time or memory however long the list is.
+            """
             def __init__(self, filelist, sortmode):
                 self.counter = 0
+                self.current = None
                 self.files = filelist
                 self.sortmode = sortmode
+                self.order = None
+                if self.sortmode == "alphabetical":
+                    self.files.sort()
                 self.arrange_list()
 
             def __iter__(self):
                 return self
 
             def __next__(self):
-                if self.counter < len(self.files):
-                    image = self.files[self.counter]
-                else:
+                if self.counter >= len(self.files):
                     self.counter = 0
                     self.arrange_list()
-                    image = self.files[self.counter]
-                # print(self.counter)
-                # print("next {}".format([self.files[self.counter]]))
+                image = self.image_at(self.counter)
                 self.counter += 1
+                self.current = image
                 return image
-            
+
             def __peek__(self):
-                if self.counter < len(self.files):
-                    image = self.files[self.counter]
-                else:
+                if self.counter >= len(self.files):
                     self.counter = 0
                     self.arrange_list()
-                    image = self.files[self.counter]
-                # print(self.counter)
-                # print("peek {}".format([self.files[self.counter]]))
-                return image
+                return self.image_at(self.counter)
+
+            def image_at(self, position):
+                """Return the image at position of the current order."""
+                if self.order is None:
+                    return self.files[position]
+                return self.files[self.order[position]]
+
+            def seek(self, position):
+                """Make the image at position of the current order the next one."""
+                self.counter = position % len(self.files) if self.files else 0
 
             def arrange_list(self):
                 """Reorders the image list as requested. Mostly for reoccuring shuffling."""
                 if self.sortmode == "shuffle":
-                    random.shuffle(self.files)
+                    self.order = IndexPermutation(len(self.files), random.getrandbits(64))
                 elif self.sortmode == "date_seeded_shuffle":
                     today = datetime.datetime.now()
-                    random.Random(today.strftime("%Y%m%d%H")).shuffle(self.files)
+                    seed = random.Random(today.strftime("%Y%m%d%H")).getrandbits(64)
+                    self.order = IndexPermutation(len(self.files), seed)
                 elif self.sortmode == "alphabetical":
-                    self.files.sort()
+                    # sorted once at init
+                    self.order = None
                 else:
                     sp_logging.G_LOGGER.info(
                         "ImageList.arrange_list: unknown sortmode: %s",
@@ -653,7 +826,7 @@ class CLIProfileData(ProfileData):
         for item in files:
             self.files.append(os.path.realpath(item))
 
-    def next_wallpaper_files(self):
+    def next_wallpaper_files(self, peek=False, indices=None):
         """Returns a list of the real paths of the images given at construction time."""
         return self.files
 
@@ -0,0 +1,153 @@
+"""
+Resource governor for background render work.
+
+Render and thumbnail workers lower their own CPU and I/O priority so
+that interactive applications on the same desktop keep running smoothly.
+The governor also caps worker counts, can enforce a memory budget per
+render job and tells when the system is under CPU pressure, as reported
+by the Linux pressure stall information in /proc/pressure/cpu, so that
+deferrable work can wait. The memory budget is off by default since
+huge panoramas are supported, see Image.MAX_IMAGE_PIXELS.
+
+The limits are set from general_settings.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+
+import superpaper.sp_logging as sp_logging
+
+# Set from general_settings.
+RENDER_NICE = 10                # added niceness of worker threads, 0 disables
+RENDER_IOPRIO = 7               # best-effort I/O priority level 0-7, negative disables
+MAX_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+JOB_MEMORY_MB = 0               # per job budget of decoded image memory, 0 disables
+CPU_PRESSURE_LIMIT = 40.0       # avg10 % of 'some' CPU stall, 0 disables
+PRESSURE_RETRY_DELAY = 30       # seconds
+PRESSURE_MAX_DEFER = 300        # seconds, deferred work runs after this anyway
+
+PRESSURE_PATH = "/proc/pressure/cpu"
+
+# ioprio_set syscall numbers, see linux/ioprio.h
+IOPRIO_SYSCALLS = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+}
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+G_LIBC = None
+G_LIBC_LOCK = threading.Lock()
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a render job would need more memory than its budget."""
+
+
+def _libc():
+    global G_LIBC
+    with G_LIBC_LOCK:
+        if G_LIBC is None:
+            G_LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return G_LIBC
+
+
+def _set_thread_ioprio(level):
+    syscall_nr = IOPRIO_SYSCALLS.get(platform.machine())
+    if syscall_nr is None:
+        return False
+    ioprio = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | max(0, min(7, level))
+    # who 0 is the calling thread
+    return _libc().syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, ioprio) == 0
+
+
+def lower_thread_priority():
+    """Lower the CPU and I/O priority of the calling worker thread.
+
+    On Linux niceness and I/O priority are per thread. Elsewhere the
+    niceness of the whole process would change, which is left alone.
+    """
+    if platform.system() != "Linux":
+        return
+    if RENDER_NICE:
+        try:
+            tid = threading.get_native_id()
+            current = os.getpriority(os.PRIO_PROCESS, tid)
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, current + RENDER_NICE))
+        except (AttributeError, OSError) as excep:
+            sp_logging.G_LOGGER.info("Could not lower worker niceness: %s", excep)
+    if RENDER_IOPRIO >= 0:
+        try:
+            if not _set_thread_ioprio(RENDER_IOPRIO):
+                sp_logging.G_LOGGER.info("Could not set worker I/O priority.")
+        except (AttributeError, OSError) as excep:
+            sp_logging.G_LOGGER.info("Could not set worker I/O priority: %s", excep)
+
+
+def worker_limit(requested):
+    """Return the number of workers a pool may use, at most requested."""
+    return max(1, min(requested, MAX_WORKERS))
+
+
+def image_memory(size, bands=3):
+    """Return the bytes a decoded image of size takes."""
+    return size[0] * size[1] * bands
+
+
+def check_memory(nbytes, what):
+    """Raise MemoryBudgetExceeded if nbytes is over the job memory budget."""
+    if JOB_MEMORY_MB and nbytes > JOB_MEMORY_MB * 1024 * 1024:
+        raise MemoryBudgetExceeded(
+            "{} would need {:.0f} MB, the render job budget is {} MB.".format(
+                what, nbytes / (1024 * 1024), JOB_MEMORY_MB))
+
+
+def fit_image(img, needed_size):
+    """Keep the decode of an opened image within the job memory budget.
+
+    A JPEG over the budget is decoded at a reduced scale that still
+    covers needed_size. Raises MemoryBudgetExceeded if it doesn't fit.
+    """
+    if (JOB_MEMORY_MB and img.format == "JPEG"
+            and image_memory(img.size) > JOB_MEMORY_MB * 1024 * 1024):
+        img.draft("RGB", needed_size)
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Decoding %s at %s to fit the memory budget.",
+                                     getattr(img, "filename", ""), img.size)
+    check_memory(image_memory(img.size), "Decoding {}".format(getattr(img, "filename", "")))
+
+
+def cpu_pressure():
+    """Return the avg10 'some' CPU stall percentage, None if not available."""
+    try:
+        with open(PRESSURE_PATH, "r") as pressure_file:
+            for line in pressure_file:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    for field in fields[1:]:
+                        key, _, value = field.partition("=")
+                        if key == "avg10":
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def under_pressure():
+    """Test if deferrable work should wait for the CPU pressure to ease."""
+    if not CPU_PRESSURE_LIMIT:
+        return False
+    pressure = cpu_pressure()
+    if pressure is not None and pressure > CPU_PRESSURE_LIMIT:
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("CPU pressure %.1f %% is over the limit.", pressure)
+        return True
+    return False
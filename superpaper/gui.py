@@ -2,17 +2,19 @@
 New wallpaper configuration GUI for Superpaper.
 """
 import os
-import time
 from operator import itemgetter
-from PIL import Image, ImageEnhance, UnidentifiedImageError
 
 import superpaper.sp_logging as sp_logging
 import superpaper.wallpaper_processing as wpproc
-from superpaper.configuration_dialogs import BrowsePaths, PerspectiveConfig, DisplayPositionEntry, HelpFrame, HelpPopup
+from superpaper.configuration_dialogs import (BrowsePaths, PerspectiveConfig, DisplayPositionEntry,
+                                              HelpFrame, HelpPopup, RenderProgressDialog,
+                                              report_render_result)
 from superpaper.data import GeneralSettingsData, ProfileData, TempProfileData, CLIProfileData, list_profiles, open_profile
 from superpaper.message_dialog import show_message_dialog
+from superpaper.preview import PreviewRenderer
 from superpaper.sp_paths import PATH, CONFIG_PATH, PROFILES_PATH
-from superpaper.wallpaper_processing import NUM_DISPLAYS, get_display_data, change_wallpaper_job, resize_to_fill
+from superpaper.thumbnails import get_thumbnail_service
+from superpaper.wallpaper_processing import NUM_DISPLAYS, get_display_data, change_wallpaper_job
 
 try:
     import wx
@@ -65,6 +67,8 @@ class WallpaperSettingsPanel(wx.Panel):
         BMP_SIZE = 32
         self.tsize = (BMP_SIZE, BMP_SIZE)
         self.image_list = wx.ImageList(BMP_SIZE, BMP_SIZE)
+        self.thumb_futures = []
+        self.thumb_generation = 0
 
         # top half
         self.resized = False
@@ -712,6 +716,7 @@ class WallpaperSettingsPanel(wx.Panel):
                     # user canceled
                     return False
             self.path_listctrl.Destroy()
+            self.cancel_thumbnails()
             self.image_list.RemoveAll()
             if use_multi_image:
                 self.multi_column_listc = True
@@ -903,15 +908,45 @@ class WallpaperSettingsPanel(wx.Panel):
 
     def add_to_imagelist(self, path):
         folder_bmp =  wx.ArtProvider.GetBitmap(wx.ART_FOLDER, wx.ART_TOOLBAR, self.tsize)
+        file_bmp =  wx.ArtProvider.GetBitmap(wx.ART_NORMAL_FILE, wx.ART_TOOLBAR, self.tsize)
         if os.path.isdir(path):
             img_id = self.image_list.Add(folder_bmp)
         else:
-            thumb_bmp = self.create_thumb_bmp(path)
-            img_id = self.image_list.Add(thumb_bmp)
+            # Show a placeholder until the thumbnail worker is done.
+            img_id = self.image_list.Add(file_bmp)
+            generation = self.thumb_generation
+            self.thumb_futures.append(
+                get_thumbnail_service().request(
+                    path,
+                    lambda pth, thumb, img_id=img_id: wx.CallAfter(
+                        self.on_thumbnail_ready, img_id, thumb, generation)
+                )
+            )
         return img_id
 
-    def create_thumb_bmp(self, filename):
-        wximg = wx.Image(filename, type=wx.BITMAP_TYPE_ANY)
+    def on_thumbnail_ready(self, img_id, thumb, generation):
+        """Swap a finished thumbnail in place of its placeholder. Runs in UI thread."""
+        if not self or thumb is None:
+            # Panel has been destroyed or thumbnail creation failed.
+            return
+        if generation != self.thumb_generation:
+            # Image list has been cleared since the request was made.
+            return
+        self.image_list.Replace(img_id, self.create_thumb_bmp(thumb))
+        self.path_listctrl.Refresh()
+
+    def cancel_thumbnails(self):
+        """Drop pending thumbnail requests, e.g. when the image list is cleared."""
+        for future in self.thumb_futures:
+            future.cancel()
+        self.thumb_futures = []
+        self.thumb_generation += 1
+
+    def create_thumb_bmp(self, pil_img):
+        wximg = wx.Image(pil_img.size[0], pil_img.size[1])
+        wximg.SetData(pil_img.convert("RGB").tobytes())
+        if pil_img.mode == "RGBA":
+            wximg.SetAlpha(pil_img.getchannel("A").tobytes())
         imgsize = wximg.GetSize()
         w2h_ratio = imgsize[0]/imgsize[1]
         if w2h_ratio > 1:
@@ -1031,21 +1066,17 @@ class WallpaperSettingsPanel(wx.Panel):
 
     def onApply(self, event):
         """Applies the currently open profile. Saves it first."""
-        busy = wx.BusyCursor()
         saved_file = self.onSave(None)
         sp_logging.G_LOGGER.info("onApply profile: saved %s", saved_file)
         if saved_file:
             saved_profile_name = ProfileData(saved_file).name
             self.parent_tray_obj.reload_profiles(event)
             saved_profile_to_start = self.parent_tray_obj.get_profile_by_name(saved_profile_name)
-            wx.Yield()
-            thrd = self.parent_tray_obj.start_profile(event, saved_profile_to_start, force_reload=True)
-            if thrd:
-                while thrd.is_alive():
-                    time.sleep(0.5)
+            job = self.parent_tray_obj.start_profile(event, saved_profile_to_start, force_reload=True)
+            if job:
+                RenderProgressDialog(self, job, on_done=report_render_result)
         else:
             pass
-        del busy
 
     def onSave(self, event):
         """Saves currently open profile into file. A test method is called to verify data."""
@@ -1254,16 +1285,13 @@ class WallpaperSettingsPanel(wx.Panel):
             self.ch_persp.GetSelection()
         )
 
-        busy = wx.BusyCursor()
-
         # Use the simplified CLI profile class
         wpproc.refresh_display_data()
         profile = CLIProfileData(testimage, advanced=True,
             perspective=perspective, spangroups=None, offsets=flat_offsets)
-        thrd = change_wallpaper_job(profile, force=True)
-        while thrd.is_alive():
-            time.sleep(0.5)
-        del busy
+        job = change_wallpaper_job(profile, force=True)
+        if job:
+            RenderProgressDialog(self, job, "Alignment test", on_done=report_render_result)
 
     def onPerspectives(self, event):
         """Open perspective configuration dialog."""
@@ -1363,7 +1391,12 @@ class WallpaperPreviewPanel(wx.Panel):
         self.clr_prw_mntr = wx.Colour(0, 0, 0, alpha=wx.ALPHA_OPAQUE)
         self.clr_prw_bkg = wx.Colour(30, 30, 30, alpha=wx.ALPHA_OPAQUE)
         self.SetBackgroundColour(self.clr_prw_bkg)
-        
+        # All painting goes through OnPaint from a cached backing bitmap
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.backing_bmp = None
+        self.backing_key = None
+        self.canvas_version = 0
+
         # Display data and sizes
         self.display_sys = display_sys
         self.display_data = self.display_sys.get_disp_list()
@@ -1376,6 +1409,7 @@ class WallpaperPreviewPanel(wx.Panel):
         self.current_preview_images = []
         self.preview_img_list = []
         self.bmp_list = []
+        self.preview_renderer = PreviewRenderer()
 
         # Draw preview
         self.draw_displays()
@@ -1385,8 +1419,11 @@ class WallpaperPreviewPanel(wx.Panel):
         self.create_bezel_buttons()
 
         self.draggable_shapes = []
+        self.drag_shape = None
+        self.drag_started = False
         self.positions_dragged = False
         self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
 
 
 
@@ -1420,7 +1457,7 @@ class WallpaperPreviewPanel(wx.Panel):
             # previews exist and should be blanked
             self.current_preview_images = [] # drop chached image list
 
-            self.st_bmp_canvas.SetBitmap(bmp_canv)
+            self.set_canvas_bitmap(bmp_canv)
             self.st_bmp_canvas.SetPosition(self.dtop_canvas_pos)
             # self.st_bmp_canvas.Hide()
 
@@ -1551,25 +1588,29 @@ class WallpaperPreviewPanel(wx.Panel):
                           use_multi_image=False,
                           display_data=None,
                           spangroups=None):
+        """Lay out the preview and request its images from the preview renderer.
+
+        Layout is computed right away, the bitmaps are filled in by
+        apply_preview once the background renderer is done. A newer
+        call supersedes any unfinished preview.
+        """
         self.use_multi_image = use_multi_image
         if display_data:
             self.display_data = display_data
         self.refresh_preview(use_ppi_px)
         self.current_preview_images = image_list
 
-        def safe_sub_bitmap(bm, rect):
-            if rect.GetBottom() >= bm.GetHeight():
-                rect.SetBottom(bm.GetHeight() - 1)
-            if rect.GetRight() >= bm.GetWidth():
-                rect.SetRight(bm.GetWidth() - 1)
-            return bm.GetSubBitmap(rect)
-
+        # Each placement is (item index, st_bmp, crop pos, crop size, bezels)
+        # where crop pos None means the bitmap is shown as is.
+        items = []
+        placements = []
+        canvas_item = None
         if use_multi_image:
             while len(image_list) < len(self.preview_img_list):
                 image_list.append(image_list[0])
             for img_nm, st_bmp in zip(image_list, self.preview_img_list):
-                prev_sz = st_bmp.GetSize()
-                st_bmp.SetBitmap(self.resize_and_bitmap(img_nm, prev_sz))
+                placements.append((len(items), st_bmp, None, None, None))
+                items.append((img_nm, tuple(st_bmp.GetSize()), False))
         elif use_ppi_px and spangroups:
             self.use_multi_image = True # disables canvas drawing
             # for each group of displays, run span wallpaper preview
@@ -1581,8 +1622,6 @@ class WallpaperPreviewPanel(wx.Panel):
                 preview_img_list = [self.preview_img_list[i] for i in grp]
 
                 canv_sz, canvas_pos = self.canvas_display_group(display_rel_sizes, (0, 0))
-                # print(canv_sz, canvas_pos)
-                bmp_clr, bmp_bw = self.resize_and_bitmap(img_nm, canv_sz, True)
                 for (disp,
                      img_sz,
                      bez_szs,
@@ -1590,78 +1629,84 @@ class WallpaperPreviewPanel(wx.Panel):
                                     img_rel_sizes,
                                     bz_rel_sizes,
                                     preview_img_list):
-                    sz = disp[0]
                     pos = (disp[1][0] - canvas_pos[0], disp[1][1] - canvas_pos[1])
-                    # print("pos", pos, "img_sz", img_sz)
-                    crop = safe_sub_bitmap(bmp_clr, wx.Rect(pos, img_sz))
-                    crop_w_bez = self.bezels_to_bitmap(crop, sz, bez_szs)
-                    st_bmp.SetBitmap(crop_w_bez)
-        elif use_ppi_px and not spangroups:
-            img = image_list[0]
+                    placements.append((len(items), st_bmp, pos, img_sz, (disp[0], bez_szs)))
+                items.append((img_nm, tuple(canv_sz), True))
+        else:
             # set canvas to fit with keeping aspect the image, with dim/blur
             # and crop pieces to show on monitor previews unaltered.
             # With use_ppi_px any provided bezels will be drawn.
             canv_sz = self.st_bmp_canvas.GetSize()
-            bmp_clr, bmp_bw = self.resize_and_bitmap(img, canv_sz, True)
-            self.st_bmp_canvas.SetBitmap(bmp_bw)
-            # self.st_bmp_canvas.Show()
-
+            canvas_item = 0
+            items.append((image_list[0], tuple(canv_sz), True))
             canvas_pos = self.dtop_canvas_pos
-            for (disp,
-                 img_sz,
-                 bez_szs,
-                 st_bmp) in zip(self.display_rel_sizes,
-                                self.img_rel_sizes,
-                                self.bz_rel_sizes,
-                                self.preview_img_list):
-                sz = disp[0]
-                pos = (disp[1][0] - canvas_pos[0], disp[1][1] - canvas_pos[1])
-                crop = safe_sub_bitmap(bmp_clr, wx.Rect(pos, img_sz))
-                crop_w_bez = self.bezels_to_bitmap(crop, sz, bez_szs)
-                st_bmp.SetBitmap(crop_w_bez)
-                # st_bmp.Show()
-        else:
-            img = image_list[0]
-            # set canvas to fit with keeping aspect the image, with dim/blur
-            # and crop pieces to show on monitor previews unaltered.
-            canv_sz = self.st_bmp_canvas.GetSize()
-            bmp_clr, bmp_bw = self.resize_and_bitmap(img, canv_sz, True)
-            self.st_bmp_canvas.SetBitmap(bmp_bw)
-            # self.st_bmp_canvas.Show()
+            if use_ppi_px:
+                for (disp,
+                     img_sz,
+                     bez_szs,
+                     st_bmp) in zip(self.display_rel_sizes,
+                                    self.img_rel_sizes,
+                                    self.bz_rel_sizes,
+                                    self.preview_img_list):
+                    pos = (disp[1][0] - canvas_pos[0], disp[1][1] - canvas_pos[1])
+                    placements.append((0, st_bmp, pos, img_sz, (disp[0], bez_szs)))
+            else:
+                for disp, st_bmp in zip(self.display_rel_sizes, self.preview_img_list):
+                    pos = (disp[1][0] - canvas_pos[0], disp[1][1] - canvas_pos[1])
+                    placements.append((0, st_bmp, pos, disp[0], None))
 
-            canvas_pos = self.dtop_canvas_pos
-            for disp, st_bmp in zip(self.display_rel_sizes, self.preview_img_list):
-                sz = disp[0]
-                pos = (disp[1][0] - canvas_pos[0], disp[1][1] - canvas_pos[1])
-                crop = safe_sub_bitmap(bmp_clr, wx.Rect(pos, sz))
-                st_bmp.SetBitmap(crop)
-                # st_bmp.Show()
+        self.preview_renderer.submit(
+            items,
+            lambda request_id, results: wx.CallAfter(
+                self.apply_preview, request_id, results, items,
+                placements, canvas_item, use_ppi_px)
+        )
+
+    def apply_preview(self, request_id, results, items, placements, canvas_item, use_ppi_px):
+        """Convert rendered preview images to bitmaps and show them. Runs in UI thread."""
+        if not self or not self.preview_renderer.is_current(request_id):
+            return
+
+        def safe_sub_bitmap(bm, rect):
+            if rect.GetBottom() >= bm.GetHeight():
+                rect.SetBottom(bm.GetHeight() - 1)
+            if rect.GetRight() >= bm.GetWidth():
+                rect.SetRight(bm.GetWidth() - 1)
+            return bm.GetSubBitmap(rect)
+
+        bitmaps = []
+        for (fname, size, dimmed), res in zip(items, results):
+            if res is None:
+                black_bmp = wx.Bitmap.FromRGBA(size[0], size[1], red=0, green=0, blue=0, alpha=255)
+                bitmaps.append((black_bmp, black_bmp) if dimmed else black_bmp)
+            elif dimmed:
+                bitmaps.append((self.pil_to_bitmap(res[0]), self.pil_to_bitmap(res[1])))
+            else:
+                bitmaps.append(self.pil_to_bitmap(res))
+
+        if canvas_item is not None:
+            self.set_canvas_bitmap(bitmaps[canvas_item][1])
+        for item_id, st_bmp, pos, size, bezels in placements:
+            bmp = bitmaps[item_id]
+            if pos is None:
+                st_bmp.SetBitmap(bmp)
+                continue
+            crop = safe_sub_bitmap(bmp[0], wx.Rect(pos, size))
+            if bezels:
+                crop = self.bezels_to_bitmap(crop, bezels[0], bezels[1])
+            st_bmp.SetBitmap(crop)
         self.draw_monitor_numbers(use_ppi_px)
         self.Refresh()
 
-    def resize_and_bitmap(self, fname, size, enhance_color=False):
-        """Take filename of an image and resize and center crop it to size."""
-        try:
-            pil = resize_to_fill(Image.open(fname), size, quality="fast")
-        except UnidentifiedImageError:
-            msg = ("Opening image '%s' failed with PIL.UnidentifiedImageError."
-                   "It could be corrupted or is of foreign type.") % fname
-            sp_logging.G_LOGGER.info(msg)
-            # show_message_dialog(msg)
-            black_bmp = wx.Bitmap.FromRGBA(size[0], size[1], red=0, green=0, blue=0, alpha=255)
-            if enhance_color:
-                return (black_bmp, black_bmp)
-            return black_bmp
+    def set_canvas_bitmap(self, bmp):
+        """Show bmp as the canvas preview, invalidating the backing bitmap."""
+        self.st_bmp_canvas.SetBitmap(bmp)
+        self.canvas_version += 1
+
+    def pil_to_bitmap(self, pil):
+        """Convert a PIL RGB image into a wx.Bitmap."""
         img = wx.Image(pil.size[0], pil.size[1])
         img.SetData(pil.convert("RGB").tobytes())
-        if enhance_color:
-            converter = ImageEnhance.Color(pil)
-            pilenh_bw = converter.enhance(0.25)
-            brightns = ImageEnhance.Brightness(pilenh_bw)
-            pilenh = brightns.enhance(0.45)
-            imgenh = wx.Image(pil.size[0], pil.size[1])
-            imgenh.SetData(pilenh.convert("RGB").tobytes())
-            return (img.ConvertToBitmap(), imgenh.ConvertToBitmap())
         return img.ConvertToBitmap()
 
     def bezels_to_bitmap(self, bmp, disp_sz, bez_rects):
@@ -2072,15 +2117,9 @@ class WallpaperPreviewPanel(wx.Panel):
             return wx.Rect(self.pos[0], self.pos[1],
                         self.bmp.GetWidth(), self.bmp.GetHeight())
 
-        def Draw(self, dc, op = wx.COPY):
+        def Draw(self, dc):
             if self.bmp.IsOk():
-                memDC = wx.MemoryDC()
-                memDC.SelectObject(self.bmp)
-
-                dc.Blit(self.pos[0], self.pos[1],
-                        self.bmp.GetWidth(), self.bmp.GetHeight(),
-                        memDC, 0, 0, op, True)
-
+                dc.DrawBitmap(self.bmp, self.pos[0], self.pos[1], True)
                 return True
             else:
                 return False
@@ -2090,8 +2129,8 @@ class WallpaperPreviewPanel(wx.Panel):
     def create_shapes(self, enable_movement=True):
         """Create draggable objects from display previews."""
         self.draggable_shapes = []
-        self.drag_image = None
         self.drag_shape = None
+        self.drag_started = False
 
         for st_bmp in self.preview_img_list:
             shape = self.DragShape(st_bmp.GetBitmap())
@@ -2102,8 +2141,17 @@ class WallpaperPreviewPanel(wx.Panel):
         if enable_movement:
             self.bind_movement_binds(True)
 
+    def update_shapes(self):
+        """Move existing draggable objects to the display previews, creating them if needed."""
+        if len(self.draggable_shapes) != len(self.preview_img_list):
+            self.create_shapes()
+            return
+        for shape, st_bmp in zip(self.draggable_shapes, self.preview_img_list):
+            shape.bmp = st_bmp.GetBitmap()
+            shape.pos = st_bmp.GetPosition()
+
     def bind_movement_binds(self, toggle):
-        """Bind or unbind DragImage dragging bindings."""
+        """Bind or unbind dragging bindings."""
         if toggle:
             self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
             self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
@@ -2116,79 +2164,84 @@ class WallpaperPreviewPanel(wx.Panel):
             self.Unbind(wx.EVT_LEAVE_WINDOW)
 
 
-    def draw_shapes(self, dc):
+    def draw_shapes(self, dc, update_rect):
+        """Draw the shapes in update_rect, the dragged shape on top."""
         for shape in self.draggable_shapes:
-            if shape.shown:
+            if (shape.shown and shape is not self.drag_shape
+                    and update_rect.Intersects(shape.GetRect())):
                 shape.Draw(dc)
+        if self.drag_shape and self.drag_shape.shown:
+            self.drag_shape.Draw(dc)
 
     def draw_canvas(self, dc, draw=True):
-        if self.st_bmp_canvas:
+        """Draw the canvas preview, or leave the background in its place if not draw."""
+        if self.st_bmp_canvas and draw:
             pos = self.st_bmp_canvas.GetPosition()
             bmp = self.st_bmp_canvas.GetBitmap()
-            bmp_sz = bmp.GetSize()
-            if not draw:
-                bmp = wx.Bitmap.FromRGBA(bmp_sz[0], bmp_sz[1], red=30, green=30, blue=30, alpha=255)
-            op = wx.COPY
-            if bmp.IsOk():
-                memDC = wx.MemoryDC()
-                # memDC.SelectObject(wx.NullBitmap)
-                memDC.SelectObject(bmp)
-
-                dc.Blit(pos[0], pos[1],
-                        bmp_sz[0], bmp_sz[1],
-                        memDC, 0, 0, op, True)
+            return self.draw_bmp(dc, pos, bmp)
+        return False
 
-                return True
-            else:
-                return False
-
-    def draw_st_bmps(self, dc):
+    def draw_st_bmps(self, dc, update_rect):
         for st_bmp in self.preview_img_list:
             pos = st_bmp.GetPosition()
             bmp = st_bmp.GetBitmap()
-            self.draw_bmp(dc, pos, bmp)
+            if update_rect.Intersects(wx.Rect(pos, bmp.GetSize())):
+                self.draw_bmp(dc, pos, bmp)
 
     def draw_bmp(self, dc, pos, bmp):
-        bmp_sz = bmp.GetSize()
-        op = wx.COPY
         if bmp.IsOk():
-            memDC = wx.MemoryDC()
-            memDC.SelectObject(bmp)
-
-            dc.Blit(pos[0], pos[1],
-                    bmp_sz[0], bmp_sz[1],
-                    memDC, 0, 0, op, True)
+            dc.DrawBitmap(bmp, pos[0], pos[1], True)
             return True
         else:
             return False
 
+    def get_backing_bitmap(self):
+        """Return the cached bottom layer of the preview: background and canvas.
+
+        It is redrawn only when the panel size, the canvas bitmap or its
+        visibility changes, not on every paint.
+        """
+        show_canvas = bool(not self.config_mode
+                           and not self.use_multi_image
+                           and self.current_preview_images)
+        size = self.GetClientSize()
+        key = (tuple(size), tuple(self.st_bmp_canvas.GetPosition()),
+               self.canvas_version, show_canvas)
+        if self.backing_bmp is None or key != self.backing_key:
+            self.backing_bmp = wx.Bitmap(max(size[0], 1), max(size[1], 1))
+            dc = wx.MemoryDC(self.backing_bmp)
+            dc.SetBackground(wx.Brush(self.clr_prw_bkg))
+            dc.Clear()
+            self.draw_canvas(dc, show_canvas)
+            dc.SelectObject(wx.NullBitmap)
+            self.backing_key = key
+        return self.backing_bmp
+
     def find_shape(self, pt):
-        for shape in self.draggable_shapes:
+        for shape in reversed(self.draggable_shapes):
             if shape.HitTest(pt):
                 return shape
         return None
 
     def OnPaint(self, evt):
-        dc = wx.PaintDC(self)
-        # Hiding bitmap widgets, probably unnecessary
-        # for st_bmp in self.preview_img_list:
-            # st_bmp.Hide()
-        
-        # Canvas drawing
-        if (not self.config_mode
-            and not self.use_multi_image
-            and self.current_preview_images):
-            # print("Drawing canvas: ", self.config_mode, not self.use_multi_image, self.current_preview_images)
-            self.draw_canvas(dc)
-        else:
-            # print("Skipping canvas: ", self.config_mode, not self.use_multi_image, self.current_preview_images)
-            self.draw_canvas(dc, False)
+        """Repaint the damaged area from the backing bitmap and the display bitmaps."""
+        dc = wx.AutoBufferedPaintDC(self)
+        update_rect = self.GetUpdateRegion().GetBox()
+        backing_dc = wx.MemoryDC(self.get_backing_bitmap())
+        dc.Blit(update_rect.x, update_rect.y, update_rect.width, update_rect.height,
+                backing_dc, update_rect.x, update_rect.y)
+        backing_dc.SelectObject(wx.NullBitmap)
 
         # Display drawing
         if self.config_mode:
-            self.draw_shapes(dc)
+            self.draw_shapes(dc, update_rect)
         else:
-            self.draw_st_bmps(dc)
+            self.draw_st_bmps(dc, update_rect)
+
+    def OnDestroy(self, evt):
+        if evt.GetEventObject() is self:
+            self.preview_renderer.stop()
+        evt.Skip()
 
     def OnLeftDown(self, evt):
         # Did the mouse go down on one of our shapes?
@@ -2199,66 +2252,43 @@ class WallpaperPreviewPanel(wx.Panel):
         # That will happen once the mouse moves, OR the mouse is released.
         if shape:
             self.drag_shape = shape
+            self.drag_started = False
             self.dragStartPos = evt.GetPosition()
+            self.dragStartShapePos = shape.pos
 
     def OnLeftUp(self, evt):
-        if not self.drag_image or not self.drag_shape:
-            self.drag_image = None
-            self.drag_shape = None
+        if not self.drag_shape:
             return
-
-        # Hide the image, end dragging, and nuke out the drag image.
-        self.drag_image.Hide()
-        self.drag_image.EndDrag()
-        self.drag_image = None
-
-        self.drag_shape.pos = (
-            self.drag_shape.pos[0] + evt.GetPosition()[0] - self.dragStartPos[0],
-            self.drag_shape.pos[1] + evt.GetPosition()[1] - self.dragStartPos[1]
-            )
-
-        self.drag_shape.shown = True
-        self.RefreshRect(self.drag_shape.GetRect())
+        if self.drag_started:
+            self.move_drag_shape(evt.GetPosition())
+            self.positions_dragged = True
         self.drag_shape = None
-        self.positions_dragged = True
-
+        self.drag_started = False
 
     def OnMotion(self, evt):
         # Ignore mouse movement if we're not dragging.
         if not self.drag_shape or not evt.Dragging() or not evt.LeftIsDown():
             return
 
-        # if we have a shape, but haven't started dragging yet
-        if self.drag_shape and not self.drag_image:
-
+        pt = evt.GetPosition()
+        if not self.drag_started:
             # only start the drag after having moved a couple pixels
             tolerance = 2
-            pt = evt.GetPosition()
             dx = abs(pt.x - self.dragStartPos.x)
             dy = abs(pt.y - self.dragStartPos.y)
             if dx <= tolerance and dy <= tolerance:
                 return
+            self.drag_started = True
+        self.move_drag_shape(pt)
 
-            # refresh the area of the window where the shape was so it
-            # will get erased.
-            self.drag_shape.shown = False
-            self.RefreshRect(self.drag_shape.GetRect(), True)
-            self.Update()
-
-            item = self.drag_shape.text if self.drag_shape.text else self.drag_shape.bmp
-            self.drag_image = wx.DragImage(item,
-                                         wx.Cursor(wx.CURSOR_HAND))
-
-            hotspot = self.dragStartPos - self.drag_shape.pos
-            self.drag_image.BeginDrag(hotspot, self, self.drag_shape.fullscreen)
-
-            self.drag_image.Move(pt)
-            self.drag_image.Show()
-
-        # if we have shape and image then move it, posibly highlighting another shape.
-        elif self.drag_shape and self.drag_image:
-            # now move it and show it again if needed
-            self.drag_image.Move(evt.GetPosition())
+    def move_drag_shape(self, pt):
+        """Move the dragged shape to follow pt, repainting only the area it covered and covers."""
+        old_rect = self.drag_shape.GetRect()
+        self.drag_shape.pos = (
+            self.dragStartShapePos[0] + pt[0] - self.dragStartPos[0],
+            self.dragStartShapePos[1] + pt[1] - self.dragStartPos[1]
+            )
+        self.RefreshRect(old_rect.Union(self.drag_shape.GetRect()), False)
 
 
     def OnLeaveWindow(self, evt):
@@ -0,0 +1,219 @@
+"""
+History of recently applied wallpapers.
+
+Every wallpaper that is set is recorded by copying its composed image
+and per display pieces into the history folder of the render directory,
+so that they survive the -a/-b alternation of the render outputs. The
+history is a ring bounded by a byte budget and an entry count, oldest
+entries are dropped first.
+
+Stepping back and forth in the history re-applies the stored files and
+never renders. The index is kept in index.json so the history survives
+restarts.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import superpaper.sp_logging as sp_logging
+from superpaper.sp_paths import TEMP_PATH
+
+HISTORY_PATH = os.path.join(TEMP_PATH, "history")
+HISTORY_MAX_MB = 256        # set from general_settings, 0 disables the history
+HISTORY_MAX_ENTRIES = 50
+
+G_HISTORY = None
+G_HISTORY_LOCK = threading.Lock()
+
+
+class HistoryEntry():
+    """
+    Stored wallpaper in the history.
+
+    outputfile  copy of the composed wallpaper image, or None
+    pieces      copies of the per display pieces, if set piecewise
+    sources     source images the wallpaper was made of
+    profile     name of the profile
+    """
+    def __init__(self, entry_id, profile, sources, outputfile, pieces, nbytes, created=None):
+        self.entry_id = entry_id
+        self.profile = profile
+        self.sources = list(sources) if sources else []
+        self.outputfile = outputfile
+        self.pieces = list(pieces) if pieces else []
+        self.nbytes = nbytes
+        self.created = created if created is not None else time.time()
+
+    def __str__(self):
+        return (
+            f"HistoryEntry("
+            f"entry_id={self.entry_id}, "
+            f"profile={self.profile!r}, "
+            f"sources={self.sources}"
+            f")"
+        )
+
+    @property
+    def name(self):
+        """Profile name, so that the entry can stand in for a profile in a RenderJob."""
+        return self.profile
+
+    def files(self):
+        """Return the stored files of the entry."""
+        return ([self.outputfile] if self.outputfile else []) + self.pieces
+
+    def as_dict(self):
+        return {
+            "entry_id": self.entry_id,
+            "profile": self.profile,
+            "sources": self.sources,
+            "outputfile": self.outputfile,
+            "pieces": self.pieces,
+            "nbytes": self.nbytes,
+            "created": self.created,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["entry_id"], data.get("profile"), data.get("sources"),
+                   data.get("outputfile"), data.get("pieces"), data.get("nbytes", 0),
+                   data.get("created"))
+
+
+class WallpaperHistory():
+    """
+    Bounded ring of HistoryEntries with a cursor.
+
+    The cursor is None while the latest wallpaper is shown and otherwise
+    points to the entry that was stepped to.
+    """
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self.index_file = os.path.join(path, "index.json")
+        self.entries = []
+        self.cursor = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the index, dropping entries whose files have gone missing."""
+        try:
+            with open(self.index_file, "r") as index:
+                data = json.load(index)
+        except (OSError, ValueError):
+            return
+        self.entries = [HistoryEntry.from_dict(entry) for entry in data.get("entries", [])]
+        self.entries = [entry for entry in self.entries
+                        if all(os.path.isfile(fname) for fname in entry.files())]
+        self.next_id = max([entry.entry_id + 1 for entry in self.entries] + [0])
+
+    def save(self):
+        """Write the index, replacing the old one atomically."""
+        tmp_file = self.index_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as index:
+                json.dump({"entries": [entry.as_dict() for entry in self.entries]}, index)
+            os.replace(tmp_file, self.index_file)
+        except OSError as excep:
+            sp_logging.G_LOGGER.info("Could not save the wallpaper history: %s", excep)
+
+    def record(self, outputfile, sources, piece_files, profile):
+        """Store the files of a wallpaper that was just set. Returns the HistoryEntry."""
+        if not HISTORY_MAX_MB:
+            return None
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            entry_id = self.next_id
+            self.next_id += 1
+            stored_output = None
+            stored_pieces = []
+            nbytes = 0
+            try:
+                if outputfile:
+                    stored_output = os.path.join(
+                        self.path, "{}-canvas{}".format(entry_id, os.path.splitext(outputfile)[1]))
+                    _store_file(outputfile, stored_output)
+                    nbytes += os.path.getsize(stored_output)
+                for index, piece in enumerate(piece_files or []):
+                    stored_piece = os.path.join(
+                        self.path, "{}-piece-{}{}".format(entry_id, index,
+                                                          os.path.splitext(piece)[1]))
+                    _store_file(piece, stored_piece)
+                    stored_pieces.append(stored_piece)
+                    nbytes += os.path.getsize(stored_piece)
+            except OSError as excep:
+                sp_logging.G_LOGGER.info("Could not store wallpaper in the history: %s", excep)
+                _remove_files(([stored_output] if stored_output else []) + stored_pieces)
+                return None
+            entry = HistoryEntry(entry_id, profile, sources, stored_output, stored_pieces, nbytes)
+            self.entries.append(entry)
+            self.cursor = None
+            self._prune()
+            self.save()
+            if sp_logging.DEBUG:
+                sp_logging.G_LOGGER.info("Recorded %s, %d entries in the history.",
+                                         entry, len(self.entries))
+            return entry
+
+    def _prune(self):
+        budget = HISTORY_MAX_MB * 1024 * 1024
+        while len(self.entries) > 1 and (len(self.entries) > HISTORY_MAX_ENTRIES
+                                         or sum(ent.nbytes for ent in self.entries) > budget):
+            _remove_files(self.entries.pop(0).files())
+            if self.cursor is not None:
+                self.cursor = max(0, self.cursor - 1)
+
+    def step(self, offset, move=True):
+        """Move the cursor by offset entries and return the entry there.
+
+        Returns None and keeps the cursor if there is no such entry. With
+        move=False only looks.
+        """
+        with self.lock:
+            if not self.entries:
+                return None
+            current = self.cursor if self.cursor is not None else len(self.entries) - 1
+            target = current + offset
+            if not 0 <= target < len(self.entries):
+                return None
+            if move:
+                self.cursor = target if target < len(self.entries) - 1 else None
+            return self.entries[target]
+
+    def at_latest(self):
+        """Test if the latest wallpaper is shown, i.e. no step back has been taken."""
+        return self.cursor is None
+
+
+def _store_file(src, dst):
+    """Hard link src to dst, copying it if the filesystem doesn't allow that.
+
+    Wallpaper outputs are never written to again once set, see
+    wallpaper_processing.write_new_file, so a link is as good as a copy.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. the history is on another filesystem
+        shutil.copyfile(src, dst)
+
+
+def _remove_files(files):
+    for fname in files:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+
+def get_history():
+    """Return the application wide WallpaperHistory."""
+    global G_HISTORY
+    with G_HISTORY_LOCK:
+        if G_HISTORY is None:
+            G_HISTORY = WallpaperHistory()
+        return G_HISTORY
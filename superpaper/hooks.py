@@ -0,0 +1,227 @@
+"""
+Post wallpaper change hooks.
+
+Hooks are Python callables that get a WallpaperChangeEvent after every
+wallpaper change. They are loaded in process from
+
+  - the 'superpaper.hooks' entry point group of installed packages, and
+  - the modules listed in the 'hook_modules' general setting. A module
+    entry is either 'module' that defines on_wallpaper_change(event),
+    or 'module:function'. Modules are also looked for in the 'hooks'
+    folder in the Superpaper config folder.
+
+Each hook call runs on its own thread so the render thread never waits
+for them. A hook that is still running after HOOK_TIMEOUT seconds is
+reported and skipped for new events until it returns. The threads are
+not daemon threads, so that a one-shot CLI run does not cut the hooks
+short; it waits for them with wait_for_hooks before returning.
+
+The old run-after-wp-change.py script in the config folder is still run
+if it exists, as a separate process with the same timeout.
+"""
+
+import importlib
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import superpaper.sp_logging as sp_logging
+from superpaper.sp_paths import CONFIG_PATH
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
+
+HOOK_ENTRY_POINT_GROUP = "superpaper.hooks"
+HOOK_FUNCTION = "on_wallpaper_change"
+HOOK_PATH = os.path.join(CONFIG_PATH, "hooks")
+LEGACY_SCRIPT = os.path.join(CONFIG_PATH, "run-after-wp-change.py")
+
+# Set from general_settings.
+HOOK_MODULES = []
+HOOK_TIMEOUT = 30
+
+G_HOOK_RUNNER = None
+G_HOOK_RUNNER_LOCK = threading.Lock()
+
+
+class WallpaperChangeEvent():
+    """
+    Data passed to hooks after a wallpaper change.
+
+    outputfile  path of the composed wallpaper image
+    pieces      per display image pieces, if the wallpaper was set piecewise
+    sources     source images the wallpaper was made of
+    profile     name of the profile
+    timings     dict of durations in seconds, e.g. 'render' and 'set'
+    """
+    def __init__(self, outputfile, sources=None, pieces=None, profile=None, timings=None):
+        self.outputfile = outputfile
+        self.sources = list(sources) if sources else []
+        self.pieces = list(pieces) if pieces else []
+        self.profile = profile
+        self.timings = dict(timings) if timings else {}
+        self.time = time.time()
+
+    def __str__(self):
+        return (
+            f"WallpaperChangeEvent("
+            f"outputfile={self.outputfile!r}, "
+            f"profile={self.profile!r}, "
+            f"sources={self.sources}, "
+            f"pieces={self.pieces}, "
+            f"timings={self.timings}"
+            f")"
+        )
+
+    def as_dict(self):
+        return {
+            "outputfile": self.outputfile,
+            "sources": self.sources,
+            "pieces": self.pieces,
+            "profile": self.profile,
+            "timings": self.timings,
+            "time": self.time,
+        }
+
+
+def _entry_point_hooks():
+    if entry_points is None:
+        return []
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        group = eps.select(group=HOOK_ENTRY_POINT_GROUP)
+    else:
+        group = eps.get(HOOK_ENTRY_POINT_GROUP, [])
+    hooks = []
+    for entry in group:
+        try:
+            hooks.append((entry.name, entry.load()))
+        except Exception as excep:
+            sp_logging.G_LOGGER.info("Loading hook entry point '%s' failed: %s",
+                                     entry.name, excep)
+    return hooks
+
+
+def _module_hooks(module_names):
+    if os.path.isdir(HOOK_PATH) and HOOK_PATH not in sys.path:
+        sys.path.append(HOOK_PATH)
+    hooks = []
+    for entry in module_names:
+        mod_name, _, func_name = entry.partition(":")
+        try:
+            module = importlib.import_module(mod_name)
+            func = getattr(module, func_name or HOOK_FUNCTION)
+        except (ImportError, AttributeError) as excep:
+            sp_logging.G_LOGGER.info("Loading hook module '%s' failed: %s", entry, excep)
+            continue
+        hooks.append((entry, func))
+    return hooks
+
+
+class HookRunner():
+    """Loads the hooks and dispatches events to them."""
+    def __init__(self):
+        self.hooks = None
+        self.loaded_modules = None
+        self.busy = set()
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def get_hooks(self):
+        """Return list of (name, callable), reloading if the module list changed."""
+        with self.lock:
+            if self.hooks is None or self.loaded_modules != tuple(HOOK_MODULES):
+                self.loaded_modules = tuple(HOOK_MODULES)
+                self.hooks = _entry_point_hooks() + _module_hooks(self.loaded_modules)
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Loaded hooks: %s",
+                                             [name for name, _ in self.hooks])
+            return self.hooks
+
+    def dispatch(self, event):
+        """Start the hooks and the legacy script for event. Does not block."""
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Dispatching %s", event)
+        for name, func in self.get_hooks():
+            with self.lock:
+                if name in self.busy:
+                    sp_logging.G_LOGGER.info("Hook '%s' is still running, skipped.", name)
+                    continue
+                self.busy.add(name)
+            self._start(name, self._call_hook, name, func, event)
+        if os.path.isfile(LEGACY_SCRIPT):
+            self._start(LEGACY_SCRIPT, self._run_legacy_script, event)
+
+    def _start(self, name, target, *args):
+        thread = threading.Thread(target=self._track, args=(target,) + args,
+                                  name="sp-hook " + name)
+        with self.lock:
+            self.threads.add(thread)
+        thread.start()
+
+    def _track(self, target, *args):
+        try:
+            target(*args)
+        finally:
+            with self.lock:
+                self.threads.discard(threading.current_thread())
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the running hooks, return True if they finished."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def _call_hook(self, name, func, event):
+        timer = threading.Timer(HOOK_TIMEOUT, sp_logging.G_LOGGER.info,
+                                args=("Hook '%s' exceeded %s s timeout.", name, HOOK_TIMEOUT))
+        timer.daemon = True
+        timer.start()
+        try:
+            func(event)
+        except Exception:
+            sp_logging.G_LOGGER.exception("Hook '%s' failed.", name)
+        finally:
+            timer.cancel()
+            with self.lock:
+                self.busy.discard(name)
+
+    @staticmethod
+    def _run_legacy_script(event):
+        try:
+            subprocess.run(["python3", LEGACY_SCRIPT, event.outputfile] + event.sources,
+                           timeout=HOOK_TIMEOUT, check=False)
+        except subprocess.TimeoutExpired:
+            sp_logging.G_LOGGER.info("'%s' killed after %s s timeout.",
+                                     LEGACY_SCRIPT, HOOK_TIMEOUT)
+        except OSError as excep:
+            sp_logging.G_LOGGER.info("Running '%s' failed: %s", LEGACY_SCRIPT, excep)
+
+
+def get_hook_runner():
+    """Return the application wide HookRunner."""
+    global G_HOOK_RUNNER
+    with G_HOOK_RUNNER_LOCK:
+        if G_HOOK_RUNNER is None:
+            G_HOOK_RUNNER = HookRunner()
+        return G_HOOK_RUNNER
+
+
+def run_hooks(event):
+    """Send event to the hooks without waiting for them."""
+    get_hook_runner().dispatch(event)
+
+
+def wait_for_hooks(timeout=None):
+    """Wait for the running hooks, at most HOOK_TIMEOUT seconds by default."""
+    if timeout is None:
+        timeout = HOOK_TIMEOUT
+    if not get_hook_runner().wait(timeout):
+        sp_logging.G_LOGGER.info("Hooks still running after %s s.", timeout)
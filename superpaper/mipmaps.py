@@ -0,0 +1,206 @@
+"""
+Mipmap cache of downscaled source images.
+
+Slideshow sources are often much larger than the desktop, yet every
+showing decodes them at full size. With mipmap_cache enabled a
+background job stores a small pyramid of downscaled copies of the shown
+and upcoming sources, at the canvas size and at a half and a quarter of
+it. The levels are uncompressed PPM files, which decode at the speed of
+a memory copy. Renders read the smallest level that still fills the
+area they need without upscaling, see find_level.
+
+Levels are keyed by the path, size and modification time of the source,
+so finding a level takes a single stat of the source and never reads
+it. This keeps the cache useful for sources on slow or network
+filesystems, which are read once when the levels are built. Levels are
+stored upright with the EXIF orientation applied. The cache is kept
+within mipmap_max_mb, dropping the least recently used levels first.
+"""
+
+import hashlib
+import math
+import os
+import tempfile
+import threading
+
+from PIL import Image, UnidentifiedImageError
+
+import superpaper.governor as governor
+import superpaper.sp_logging as sp_logging
+from superpaper.render_process import EXIF_TRANSPOSE, image_orientation, oriented_size
+from superpaper.sp_paths import TEMP_PATH
+
+MIPMAP_PATH = os.path.join(TEMP_PATH, "mipmaps")
+MIPMAP_CACHE = False            # set from general_settings
+MIPMAP_MAX_MB = 512             # set from general_settings
+LEVEL_DIVISORS = (1, 2, 4)      # levels at the canvas size, its half and its quarter
+
+G_LEVELS = None                 # source key -> {level size: level file}
+G_MIPMAP_LOCK = threading.Lock()
+
+
+def source_key(path):
+    """Return the cache key of the source at path, None if it can't be stat'd."""
+    try:
+        src_stat = os.stat(path)
+    except OSError:
+        return None
+    identity = "{}\0{}\0{}".format(os.path.abspath(path), src_stat.st_size,
+                                   src_stat.st_mtime_ns)
+    return hashlib.sha1(identity.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def level_file(key, size):
+    return os.path.join(MIPMAP_PATH, "{}-{}x{}.ppm".format(key, size[0], size[1]))
+
+
+def _levels():
+    """Return the level index, scanning the cache folder on first use."""
+    global G_LEVELS
+    if G_LEVELS is None:
+        G_LEVELS = {}
+        try:
+            names = os.listdir(MIPMAP_PATH)
+        except OSError:
+            names = []
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            key, _, size = stem.rpartition("-")
+            try:
+                size = tuple(int(val) for val in size.split("x"))
+            except ValueError:
+                continue
+            if ext == ".ppm" and key and len(size) == 2:
+                G_LEVELS.setdefault(key, {})[size] = os.path.join(MIPMAP_PATH, name)
+    return G_LEVELS
+
+
+def find_level(path, fill_size):
+    """Return the smallest cached level of the source at path that fills
+    fill_size without upscaling, None if there is none.
+
+    fill_size is in upright image coordinates, like the levels.
+    """
+    if not MIPMAP_CACHE:
+        return None
+    key = source_key(path)
+    if key is None:
+        return None
+    with G_MIPMAP_LOCK:
+        levels = _levels().get(key, {})
+        fitting = [(size[0] * size[1], fname) for size, fname in levels.items()
+                   if size[0] >= fill_size[0] and size[1] >= fill_size[1]]
+    if not fitting:
+        return None
+    fname = min(fitting)[1]
+    try:
+        os.utime(fname)     # the modification time orders the levels for pruning
+    except OSError:
+        # removed behind our back
+        with G_MIPMAP_LOCK:
+            for size, level in list(levels.items()):
+                if level == fname:
+                    del levels[size]
+        return None
+    return fname
+
+
+def level_sizes(upright_size, canvas_size):
+    """Return the sizes of the levels of a source of upright_size, largest first.
+
+    Each level fills a box of the canvas size divided by a LEVEL_DIVISOR,
+    keeping the aspect ratio of the source. Levels that would not be
+    smaller than the source are left out.
+    """
+    sizes = []
+    for divisor in LEVEL_DIVISORS:
+        box = (canvas_size[0] / divisor, canvas_size[1] / divisor)
+        scale = max(box[0] / upright_size[0], box[1] / upright_size[1])
+        if scale >= 1:
+            continue
+        size = (math.ceil(upright_size[0] * scale), math.ceil(upright_size[1] * scale))
+        if size not in sizes:
+            sizes.append(size)
+    return sizes
+
+
+def build_levels(path, canvas_size, checkpoint=None):
+    """Store the missing levels of the source at path for canvas_size.
+
+    The source is decoded once, at a reduced scale if the format allows,
+    and each level is resampled from the previous larger one. checkpoint
+    is called between levels and may raise to stop.
+    """
+    if not MIPMAP_CACHE:
+        return
+    key = source_key(path)
+    if key is None:
+        return
+    try:
+        img = Image.open(path)
+        orientation = image_orientation(img)
+        sizes = level_sizes(oriented_size(img.size, orientation), canvas_size)
+        with G_MIPMAP_LOCK:
+            existing = _levels().get(key, {})
+            sizes = [size for size in sizes if size not in existing]
+        if not sizes:
+            return
+        if img.format == "JPEG":
+            img.draft("RGB", oriented_size(sizes[0], orientation))
+        governor.fit_image(img, oriented_size(sizes[0], orientation))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if orientation != 1:
+            img = img.transpose(EXIF_TRANSPOSE[orientation])
+    except (OSError, UnidentifiedImageError, governor.MemoryBudgetExceeded) as excep:
+        sp_logging.G_LOGGER.info("Could not build mipmaps of '%s': %s", path, excep)
+        return
+    os.makedirs(MIPMAP_PATH, exist_ok=True)
+    for size in sizes:
+        if checkpoint is not None:
+            checkpoint()
+        img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        fname = level_file(key, size)
+        # Write to a temp file first so that renders never see partial levels.
+        tmp_name = None
+        try:
+            fdesc, tmp_name = tempfile.mkstemp(suffix=".ppm", dir=MIPMAP_PATH)
+            with os.fdopen(fdesc, "wb") as tmp_file:
+                img.save(tmp_file, "PPM")
+            os.replace(tmp_name, fname)
+        except OSError as excep:
+            sp_logging.G_LOGGER.info("Could not write mipmap of '%s': %s", path, excep)
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return
+        with G_MIPMAP_LOCK:
+            _levels().setdefault(key, {})[size] = fname
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Stored %s mipmap of %s", size, path)
+    prune()
+
+
+def prune():
+    """Remove the least recently used levels until the cache fits MIPMAP_MAX_MB."""
+    budget = MIPMAP_MAX_MB * 1024 * 1024
+    with G_MIPMAP_LOCK:
+        files = []
+        for key, levels in _levels().items():
+            for size, fname in levels.items():
+                try:
+                    level_stat = os.stat(fname)
+                except OSError:
+                    continue
+                files.append((level_stat.st_mtime, level_stat.st_size, key, size, fname))
+        total = sum(entry[1] for entry in files)
+        for _, nbytes, key, size, fname in sorted(files):
+            if total <= budget:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= nbytes
+            del _levels()[key][size]
+            if not _levels()[key]:
+                del _levels()[key]
@@ -0,0 +1,118 @@
+"""
+Compact image path lists for large wallpaper libraries.
+
+PackedPathList stores paths as an interned directory prefix plus the file
+name bytes in one packed buffer with an offsets array, instead of one
+Python string per file. IndexPermutation is a seeded pseudorandom
+permutation of range(n) that is evaluated one index at a time, so
+shuffled slideshows neither copy nor reshuffle the list.
+"""
+
+import os
+import random
+from array import array
+
+MASK64 = (1 << 64) - 1
+
+
+class PackedPathList():
+    """Append only list of file paths stored in packed buffers."""
+    def __init__(self, paths=None):
+        self._dirs = []
+        self._dir_index = {}
+        self._names = bytearray()
+        self._offsets = array("Q", [0])
+        self._dir_of = array("I")
+        if paths:
+            for path in paths:
+                self.append(path)
+
+    def __len__(self):
+        return len(self._dir_of)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self._dir_of):
+            raise IndexError("PackedPathList index out of range")
+        name = os.fsdecode(bytes(self._names[self._offsets[index]:self._offsets[index + 1]]))
+        return os.path.join(self._dirs[self._dir_of[index]], name)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, path):
+        """Add a full path."""
+        directory, name = os.path.split(path)
+        self.append_name(directory, name)
+
+    def append_name(self, directory, name):
+        """Add a file name in directory without building the full path."""
+        dir_i = self._dir_index.get(directory)
+        if dir_i is None:
+            dir_i = len(self._dirs)
+            self._dirs.append(directory)
+            self._dir_index[directory] = dir_i
+        self._names += os.fsencode(name)
+        self._offsets.append(len(self._names))
+        self._dir_of.append(dir_i)
+
+    def sort(self):
+        """Sort the paths alphabetically, as a list of full path strings would sort.
+
+        The full paths exist only while sorting.
+        """
+        order = sorted(range(len(self)), key=self.__getitem__)
+        names = self._names
+        offsets = self._offsets
+        dir_of = self._dir_of
+        self._names = bytearray()
+        self._offsets = array("Q", [0])
+        self._dir_of = array("I")
+        for index in order:
+            self._names += names[offsets[index]:offsets[index + 1]]
+            self._offsets.append(len(self._names))
+            self._dir_of.append(dir_of[index])
+
+
+class IndexPermutation():
+    """
+    Seeded pseudorandom permutation of range(size).
+
+    A balanced Feistel network permutes the smallest even-bit power of two
+    domain covering size, and cycle walking maps it back into range(size).
+    Each lookup takes constant time and no per element memory is used.
+    """
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64) for _ in range(self.ROUNDS)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("IndexPermutation index out of range")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def _round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B97F4A7C15) & MASK64
+        value ^= value >> 32
+        value = (value * 0xD6E8FEB86659FD93) & MASK64
+        return value >> (64 - self.half_bits)
+
+    def _encrypt(self, value):
+        left = value >> self.half_bits
+        right = value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
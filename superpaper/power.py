@@ -0,0 +1,123 @@
+"""
+Power supply and idle state for power aware slideshows.
+
+On Linux the power supply state is read from /sys/class/power_supply,
+the display power state from the DRM connectors in /sys/class/drm, and
+the session lock state from logind. Elsewhere the state is unknown and
+the slideshow runs as configured.
+
+The sysfs root is SYSFS_ROOT, or the root argument, so that a fake tree
+can stand in for /sys.
+"""
+
+import os
+import platform
+import subprocess
+
+import superpaper.sp_logging as sp_logging
+
+SYSFS_ROOT = "/sys"
+
+# Set from general_settings.
+POWER_AWARE = True
+BATTERY_INTERVAL_FACTOR = 2     # slideshow interval multiplier on battery
+
+LOGINCTL_TIMEOUT = 2    # seconds
+
+
+class PowerState():
+    """
+    Snapshot of the power and idle state.
+
+    on_battery      running on battery power
+    screen_locked   the session is locked
+    displays_off    all connected displays are powered down
+    """
+    def __init__(self, on_battery=False, screen_locked=False, displays_off=False):
+        self.on_battery = on_battery
+        self.screen_locked = screen_locked
+        self.displays_off = displays_off
+
+    def __str__(self):
+        return (
+            f"PowerState("
+            f"on_battery={self.on_battery}, "
+            f"screen_locked={self.screen_locked}, "
+            f"displays_off={self.displays_off}"
+            f")"
+        )
+
+    @property
+    def idle(self):
+        """True if nobody can see the wallpaper."""
+        return self.screen_locked or self.displays_off
+
+
+def _read_attr(path):
+    try:
+        with open(path, "r") as attr_file:
+            return attr_file.read().strip()
+    except OSError:
+        return None
+
+
+def on_battery(root=None):
+    """Test if the system runs on battery, i.e. no mains supply is online
+    and a battery is discharging."""
+    supply_dir = os.path.join(root or SYSFS_ROOT, "class", "power_supply")
+    try:
+        supplies = os.listdir(supply_dir)
+    except OSError:
+        return False
+    discharging = False
+    for supply in supplies:
+        supply_path = os.path.join(supply_dir, supply)
+        supply_type = _read_attr(os.path.join(supply_path, "type"))
+        if supply_type in ("Mains", "USB", "UPS"):
+            if _read_attr(os.path.join(supply_path, "online")) == "1":
+                return False
+        elif supply_type == "Battery":
+            if _read_attr(os.path.join(supply_path, "status")) == "Discharging":
+                discharging = True
+    return discharging
+
+
+def displays_off(root=None):
+    """Test if every connected display connector reports DPMS off."""
+    drm_dir = os.path.join(root or SYSFS_ROOT, "class", "drm")
+    try:
+        connectors = os.listdir(drm_dir)
+    except OSError:
+        return False
+    dpms_states = []
+    for connector in connectors:
+        connector_path = os.path.join(drm_dir, connector)
+        if _read_attr(os.path.join(connector_path, "status")) != "connected":
+            continue
+        dpms = _read_attr(os.path.join(connector_path, "dpms"))
+        if dpms is not None:
+            dpms_states.append(dpms)
+    return bool(dpms_states) and all(dpms != "On" for dpms in dpms_states)
+
+
+def screen_locked():
+    """Test if logind reports the session as locked."""
+    session = os.environ.get("XDG_SESSION_ID", "auto")
+    try:
+        result = subprocess.run(["loginctl", "show-session", session,
+                                 "--property=LockedHint", "--value"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=LOGINCTL_TIMEOUT, check=False)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.stdout.decode("utf-8", "replace").strip() == "yes"
+
+
+def read_power_state(root=None):
+    """Return the current PowerState, all False where it can't be read."""
+    if platform.system() != "Linux":
+        return PowerState()
+    state = PowerState(on_battery(root), screen_locked(), displays_off(root))
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("%s", state)
+    return state
@@ -0,0 +1,155 @@
+"""
+Background preview rendering for the wallpaper configuration GUI.
+
+Preview images are produced on a single worker thread from reduced size
+copies of the source images, which are kept in a small cache so that
+window resizes and profile switches don't decode the full sources again.
+Only the newest request is rendered, superseded ones are dropped.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import superpaper.sp_logging as sp_logging
+from superpaper.wallpaper_processing import resize_to_fill
+
+# Longest edge of the cached preview sources; previews never exceed the
+# size of the configuration window so this leaves plenty of margin.
+PREVIEW_SOURCE_MAX = 2048
+PREVIEW_CACHE_ENTRIES = 16
+
+# Dimmed canvas background in a single pass: the old
+# ImageEnhance.Color(0.25) followed by ImageEnhance.Brightness(0.45)
+# is the affine map 0.45 * (0.25 * rgb + 0.75 * luma(rgb)), which can be
+# given as a RGB->RGB conversion matrix.
+_DIM_COLOR = 0.25
+_DIM_BRIGHTNESS = 0.45
+_LUMA = (0.299, 0.587, 0.114)
+
+
+def _dim_matrix():
+    keep = _DIM_BRIGHTNESS * _DIM_COLOR
+    gray = _DIM_BRIGHTNESS * (1 - _DIM_COLOR)
+    matrix = []
+    for channel in range(3):
+        row = [gray * wgt for wgt in _LUMA]
+        row[channel] += keep
+        matrix += row + [0]
+    return tuple(matrix)
+
+DIM_MATRIX = _dim_matrix()
+
+
+def dim_image(img):
+    """Return a desaturated and darkened copy of an RGB image."""
+    return img.convert("RGB", DIM_MATRIX)
+
+
+class PreviewSourceCache():
+    """Small LRU cache of preview sized source images."""
+    def __init__(self, max_entries=PREVIEW_CACHE_ENTRIES, max_edge=PREVIEW_SOURCE_MAX):
+        self.max_entries = max_entries
+        self.max_edge = max_edge
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, fname):
+        """Return a reduced RGB copy of image fname, decoding it if needed."""
+        stat = os.stat(fname)
+        key = (fname, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        img = Image.open(fname)
+        img.draft("RGB", (self.max_edge, self.max_edge))
+        img.thumbnail((self.max_edge, self.max_edge), Image.BICUBIC, reducing_gap=2.0)
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        with self.lock:
+            self.cache[key] = img
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return img
+
+
+class PreviewRenderer():
+    """
+    Renders preview images on a single background thread.
+
+    A request is a list of (filename, size, dimmed) items. For every item
+    the result is a PIL image of the requested size, or a (color, dimmed)
+    tuple if a dimmed version was also asked for, or None if the image
+    couldn't be opened. Results are handed to the callback on the worker
+    thread, together with the request id, and only if no newer request
+    has been submitted in the meantime.
+    """
+    def __init__(self):
+        self.sources = PreviewSourceCache()
+        self.cond = threading.Condition()
+        self.request_id = 0
+        self.pending = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="sp-preview", daemon=True)
+        self.thread.start()
+
+    def submit(self, items, callback):
+        """Queue a render request replacing any pending one. Returns request id."""
+        with self.cond:
+            self.request_id += 1
+            self.pending = (self.request_id, list(items), callback)
+            self.cond.notify()
+            return self.request_id
+
+    def cancel(self):
+        """Supersede the pending and running requests."""
+        with self.cond:
+            self.request_id += 1
+            self.pending = None
+
+    def stop(self):
+        """Drop pending work and let the worker thread exit."""
+        with self.cond:
+            self.request_id += 1
+            self.pending = None
+            self.stopped = True
+            self.cond.notify()
+
+    def is_current(self, request_id):
+        """Test if request_id is still the newest request."""
+        return request_id == self.request_id
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                request_id, items, callback = self.pending
+                self.pending = None
+            results = []
+            for fname, size, dimmed in items:
+                if not self.is_current(request_id):
+                    break
+                results.append(self._render_item(fname, size, dimmed))
+            else:
+                if self.is_current(request_id):
+                    callback(request_id, results)
+
+    def _render_item(self, fname, size, dimmed):
+        size = (max(1, round(size[0])), max(1, round(size[1])))
+        try:
+            pil = resize_to_fill(self.sources.get(fname), size, quality="fast")
+        except (OSError, UnidentifiedImageError):
+            sp_logging.G_LOGGER.info(
+                "Opening image '%s' failed with PIL.UnidentifiedImageError."
+                "It could be corrupted or is of foreign type.", fname)
+            return None
+        if dimmed:
+            return (pil, dim_image(pil))
+        return pil
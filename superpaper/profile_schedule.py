@@ -0,0 +1,139 @@
+"""
+Time of day profile switching.
+
+The profile_schedule general setting lists the times of day at which a
+profile takes over, e.g.
+
+    profile_schedule=07:00=day;19:30=night
+
+The rule with the latest time not after the current time is in effect,
+wrapping around midnight. The first frame of the next profile is
+rendered profile_schedule_lead seconds before its switch so that the
+switch itself only sets the ready wallpaper. A profile started by hand
+stays until the next switch.
+"""
+
+import datetime
+
+import superpaper.sp_logging as sp_logging
+import superpaper.wallpaper_processing as wpproc
+
+CHECK_INTERVAL = 60     # seconds, the schedule is also checked at its switch times
+
+
+class ScheduleRule():
+    """Profile that takes over at a time of day."""
+    def __init__(self, start, profile_name):
+        self.start = start      # datetime.time
+        self.profile_name = profile_name
+
+    def __str__(self):
+        return "{}={}".format(self.start.strftime("%H:%M"), self.profile_name)
+
+
+def parse_profile_schedule(text):
+    """Return the ScheduleRules of a 'HH:MM=profile;...' string, sorted by time."""
+    rules = []
+    for entry in text.split(";"):
+        if not entry.strip():
+            continue
+        start, _, profile_name = entry.partition("=")
+        try:
+            start = datetime.datetime.strptime(start.strip(), "%H:%M").time()
+        except ValueError:
+            sp_logging.G_LOGGER.info("Invalid profile_schedule entry: %s", entry)
+            continue
+        if not profile_name.strip():
+            sp_logging.G_LOGGER.info("Invalid profile_schedule entry: %s", entry)
+            continue
+        rules.append(ScheduleRule(start, profile_name.strip()))
+    rules.sort(key=lambda rule: rule.start)
+    return rules
+
+
+def profile_schedule_str(rules):
+    """Format ScheduleRules for general_settings."""
+    return ";".join(str(rule) for rule in rules)
+
+
+def rule_at(rules, moment):
+    """Return the rule in effect at datetime moment."""
+    in_effect = rules[-1]   # from the previous day
+    for rule in rules:
+        if rule.start <= moment.time():
+            in_effect = rule
+    return in_effect
+
+
+def next_switch(rules, moment):
+    """Return (datetime, rule) of the first switch after datetime moment."""
+    for rule in rules:
+        if rule.start > moment.time():
+            return datetime.datetime.combine(moment.date(), rule.start), rule
+    tomorrow = moment.date() + datetime.timedelta(days=1)
+    return datetime.datetime.combine(tomorrow, rules[0].start), rules[0]
+
+
+class ProfileScheduler():
+    """
+    Switches profiles by the schedule on the slideshow scheduler.
+
+    get_profile(name) returns a profile object, active_profile_name()
+    the name of the running profile and start_profile(profile) starts a
+    profile, e.g. by handing it to the GUI thread.
+    """
+    def __init__(self, rules, lead_time, get_profile, active_profile_name, start_profile):
+        self.rules = rules
+        self.lead_time = lead_time
+        self.get_profile = get_profile
+        self.active_profile_name = active_profile_name
+        self.start_profile = start_profile
+        self.rule = None
+        self.prerendered = None     # (switch time, profile name)
+        self.job = None
+
+    def start(self):
+        """Apply the rule in effect now and follow the schedule."""
+        if not self.rules:
+            return
+        self.job = wpproc.ScheduledJob(wpproc.get_scheduler(), CHECK_INTERVAL, self.check,
+                                       late_policy="run", max_lead=0)
+        self.job.start(0)
+
+    def stop(self):
+        if self.job is not None:
+            self.job.stop()
+            self.job = None
+
+    def check(self):
+        """Switch to the rule in effect, prerender ahead of the next switch."""
+        now = datetime.datetime.now()
+        rule = rule_at(self.rules, now)
+        if rule is not self.rule:
+            self.rule = rule
+            if rule.profile_name != self.active_profile_name():
+                profile = self.get_profile(rule.profile_name)
+                if profile is None:
+                    sp_logging.G_LOGGER.info("Scheduled profile '%s' was not found.",
+                                             rule.profile_name)
+                else:
+                    sp_logging.G_LOGGER.info("Switching to scheduled profile %s.", rule)
+                    self.start_profile(profile)
+        switch_time, next_rule = next_switch(self.rules, now)
+        prerender_time = switch_time - datetime.timedelta(seconds=self.lead_time)
+        if (now >= prerender_time
+                and self.prerendered != (switch_time, next_rule.profile_name)):
+            self.prerendered = (switch_time, next_rule.profile_name)
+            profile = self.get_profile(next_rule.profile_name)
+            if profile is not None and profile.name != rule.profile_name:
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Prerendering %s for the switch at %s",
+                                             profile.name, switch_time)
+                wpproc.prerender_first_frame(profile)
+        # wake up at the next prerender or switch time
+        if now < prerender_time:
+            next_event = prerender_time
+        else:
+            next_event = switch_time
+        if self.job is not None:
+            self.job.start(max(0.2, min(CHECK_INTERVAL, (next_event - now).total_seconds())))
@@ -0,0 +1,364 @@
+"""
+Out of process rendering of display pieces.
+
+Resampling the source images into display pieces is the heavy part of a
+render. With render_processes set it runs in a small pool of worker
+processes instead of the render thread of the tray process, so that the
+GUI does not stall on the GIL, the large decode buffers are given back
+to the system with the worker, and an image that crashes the decoder
+takes down only a worker. A dead worker is replaced and the workers are
+recycled after render_process_jobs renders each.
+
+When a worker dies every render queued in the pool fails with it, not
+only the one that crashed it. The failed renders are therefore tried
+once more, each alone in a fresh worker, and only a render that crashes
+its own worker is given up on.
+
+The pieces come back through multiprocessing.shared_memory: the tray
+process allocates a block for each piece, the worker writes the pixels
+into it and only the block names cross the process boundary. It is new
+in Python 3.8, on older versions the pieces are always rendered in the
+render thread.
+
+The workers import this module, so it must not import wx or other GUI
+modules.
+"""
+
+import concurrent.futures
+import multiprocessing
+import sys
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+import superpaper.governor as governor
+import superpaper.sp_logging as sp_logging
+
+HAVE_SHARED_MEMORY = sys.version_info >= (3, 8)
+
+# Set from general_settings. Worker processes, 0 renders in the render thread.
+RENDER_PROCESSES = 1 if HAVE_SHARED_MEMORY else 0
+RENDER_PROCESS_JOBS = 100       # renders per worker before it is recycled
+
+POLL_INTERVAL = 0.1             # seconds between cancellation checks while waiting
+
+# EXIF orientation values and the transposes that make such images upright.
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+G_POOL = None
+G_POOL_LOCK = threading.Lock()
+
+
+class RenderProcessCrashed(Exception):
+    """Raised when an image crashed a render process of its own."""
+
+
+def image_orientation(img):
+    """Return the EXIF orientation of an opened image, 1 if it is upright or unknown."""
+    try:
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    except (AttributeError, OSError, ValueError):
+        return 1
+    return orientation if orientation in EXIF_TRANSPOSE else 1
+
+
+def oriented_size(size, orientation):
+    """Return the upright size of an image of stored size with the given orientation."""
+    if orientation in (5, 6, 7, 8):
+        return (size[1], size[0])
+    return tuple(size)
+
+
+def stored_box(box, stored_size, orientation):
+    """Map a box in upright image coordinates to the stored pixel coordinates."""
+    width, height = stored_size
+    to_stored = {
+        1: lambda x, y: (x, y),
+        2: lambda x, y: (width - x, y),
+        3: lambda x, y: (width - x, height - y),
+        4: lambda x, y: (x, height - y),
+        5: lambda x, y: (y, x),
+        6: lambda x, y: (y, height - x),
+        7: lambda x, y: (width - y, height - x),
+        8: lambda x, y: (width - y, x),
+    }[orientation]
+    (x_0, y_0), (x_1, y_1) = to_stored(box[0], box[1]), to_stored(box[2], box[3])
+    return (min(x_0, x_1), min(y_0, y_1), max(x_0, x_1), max(y_0, y_1))
+
+
+def fill_source_box(image_size, res):
+    """Return the box of an image of image_size that resize_to_fill shows at res.
+
+    Also returns the scale from target pixels to source pixels.
+    """
+    image_ratio = image_size[0] / image_size[1]
+    target_ratio = res[0] / res[1]
+    if image_ratio < target_ratio:      # img not wide enough / is too tall
+        scale = image_size[0] / res[0]
+        visible_height = res[1] * scale
+        top = (image_size[1] - visible_height) / 2
+        return (0, top, image_size[0], top + visible_height), scale
+    scale = image_size[1] / res[1]
+    visible_width = res[0] * scale
+    left = (image_size[0] - visible_width) / 2
+    return (left, 0, left + visible_width, image_size[1]), scale
+
+
+def region_size(region, size=None):
+    """Return the output size of a region, size if it is given."""
+    if size is not None:
+        return tuple(size)
+    return (region[2] - region[0], region[3] - region[1])
+
+
+def resample_region(img, res, region, size, orientation, resample, reducing_gap, draft):
+    """Resample region of resize_to_fill(img, res) to size, see
+    wallpaper_processing.resize_region_to_fill."""
+    if draft and img.format == "JPEG":
+        img.draft("RGB", oriented_size(res, orientation))
+    governor.fit_image(img, oriented_size(res, orientation))
+    if not img.mode == "RGB":
+        img = img.convert("RGB")
+    size = region_size(region, size)
+    width, height = oriented_size(img.size, orientation)
+    (left, top, _, _), scale = fill_source_box((width, height), res)
+    box = (left + region[0] * scale,
+           top + region[1] * scale,
+           left + region[2] * scale,
+           top + region[3] * scale)
+    inner = (max(box[0], 0), max(box[1], 0), min(box[2], width), min(box[3], height))
+    if inner == box:
+        return _resample_box(img, box, size, orientation, resample, reducing_gap)
+    # A region reaching past the image, e.g. by a negative manual offset,
+    # is black outside of it, as Image.crop would leave it.
+    piece = Image.new("RGB", size)
+    scale_x = size[0] / (box[2] - box[0])
+    scale_y = size[1] / (box[3] - box[1])
+    dest = (round((inner[0] - box[0]) * scale_x),
+            round((inner[1] - box[1]) * scale_y),
+            round((inner[2] - box[0]) * scale_x),
+            round((inner[3] - box[1]) * scale_y))
+    if dest[2] > dest[0] and dest[3] > dest[1]:
+        piece.paste(_resample_box(img, inner, (dest[2] - dest[0], dest[3] - dest[1]),
+                                  orientation, resample, reducing_gap),
+                    dest[:2])
+    return piece
+
+
+def _resample_box(img, box, size, orientation, resample, reducing_gap):
+    """Resample box of the upright image to size."""
+    if orientation == 1:
+        return img.resize(size, resample=resample, box=box, reducing_gap=reducing_gap)
+    piece = img.resize(oriented_size(size, orientation), resample=resample,
+                       box=stored_box(box, img.size, orientation),
+                       reducing_gap=reducing_gap)
+    return piece.transpose(EXIF_TRANSPOSE[orientation])
+
+
+def _attach_block(name):
+    """Attach to a shared memory block owned by the tray process."""
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 the block is registered with the resource tracker,
+        # which spawned workers share with the tray process that unlinks it.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(limits):
+    """Set up a worker process with the governor limits of the tray process."""
+    for attr, value in limits.items():
+        setattr(governor, attr, value)
+    Image.MAX_IMAGE_PIXELS = None
+    governor.lower_thread_priority()
+
+
+def _render_pieces(file, res, regions, draft, resample, reducing_gap, block_names):
+    """Worker side of RenderProcessPool.submit."""
+    img = Image.open(file)
+    orientation = image_orientation(img)
+    for (region, size), name in zip(regions, block_names):
+        piece = resample_region(img, res, region, size, orientation,
+                                resample, reducing_gap, draft)
+        data = piece.tobytes()
+        block = _attach_block(name)
+        try:
+            block.buf[:len(data)] = data
+        finally:
+            block.close()
+
+
+def _shutdown_executor(executor):
+    """Shut down an executor without waiting, dropping the renders it has not started."""
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        executor.shutdown(wait=False)
+
+
+class PendingPieces():
+    """
+    Pieces being rendered in the render process pool.
+
+    The shared memory blocks of the pieces are owned by this object,
+    release frees them once the pieces have been read or are no longer
+    wanted.
+    """
+    def __init__(self, pool, args, sizes):
+        self.pool = pool
+        self.args = args
+        self.sizes = sizes
+        from multiprocessing import shared_memory
+        self.blocks = [shared_memory.SharedMemory(create=True, size=size[0] * size[1] * 3)
+                       for size in sizes]
+        self.isolated = None    # executor of the retry of the pieces alone
+        try:
+            self.future = pool.run(args + ([block.name for block in self.blocks],))
+        except Exception:
+            self.release()
+            raise
+
+    def result(self, poll=None):
+        """Wait for the pieces and return them as images.
+
+        poll is called while waiting and may raise to stop waiting, e.g.
+        on cancellation. If the pool breaks the pieces are rendered once
+        more alone in a fresh worker, RenderProcessCrashed is raised if
+        that worker dies too.
+        """
+        while True:
+            try:
+                self.future.result(timeout=POLL_INTERVAL)
+                break
+            except concurrent.futures.TimeoutError:
+                if poll is not None:
+                    poll()
+            except BrokenProcessPool:
+                if self.isolated is not None:
+                    raise RenderProcessCrashed(
+                        "Render process died rendering {}".format(self.args[0]))
+                # Any render of the pool may have crashed it, retrying alone
+                # tells whether it was this one.
+                sp_logging.G_LOGGER.info("Render process died while rendering %s, "
+                                         "retrying it alone.", self.args[0])
+                self.isolated = self.pool.start_executor(1)
+                self.future = self.isolated.submit(
+                    _render_pieces, *self.args, [block.name for block in self.blocks])
+        images = [Image.frombytes("RGB", size, bytes(block.buf[:size[0] * size[1] * 3]))
+                  for block, size in zip(self.blocks, self.sizes)]
+        self.release()
+        return images
+
+    def release(self):
+        """Free the shared memory of the pieces."""
+        if self.isolated is not None:
+            _shutdown_executor(self.isolated)
+        for block in self.blocks:
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self.blocks = []
+
+
+class RenderProcessPool():
+    """
+    Pool of render worker processes.
+
+    Workers are started with the spawn method so that they do not
+    inherit the GUI state and threads of the tray process. After
+    RENDER_PROCESS_JOBS renders per worker the pool is replaced by a
+    fresh one, letting the running renders of the old pool finish.
+    """
+    def __init__(self):
+        self.executor = None
+        self.jobs = 0
+        self.lock = threading.Lock()
+
+    def _limits(self):
+        return {attr: getattr(governor, attr)
+                for attr in ("RENDER_NICE", "RENDER_IOPRIO", "JOB_MEMORY_MB")}
+
+    def start_executor(self, processes):
+        """Return a new executor of render worker processes."""
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(self._limits(),))
+
+    def _start(self, processes):
+        self.executor = self.start_executor(processes)
+        self.jobs = 0
+
+    def run(self, args):
+        """Run _render_pieces(*args) in a worker and return its Future."""
+        with self.lock:
+            processes = governor.worker_limit(RENDER_PROCESSES)
+            if (self.executor is not None
+                    and self.jobs >= processes * max(1, RENDER_PROCESS_JOBS)):
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Recycling the render processes after %d renders.",
+                                             self.jobs)
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            if self.executor is None:
+                self._start(processes)
+            self.jobs += 1
+            try:
+                return self.executor.submit(_render_pieces, *args)
+            except BrokenProcessPool:
+                # a worker died, the pool has to be replaced
+                self.executor.shutdown(wait=False)
+                self._start(processes)
+                self.jobs += 1
+                return self.executor.submit(_render_pieces, *args)
+
+    def submit(self, file, res, regions, draft, resample, reducing_gap):
+        """Start rendering the regions of an image file and return PendingPieces.
+
+        regions is a list of (region, size) as for resample_region.
+        """
+        regions = [(tuple(region), tuple(size) if size is not None else None)
+                   for region, size in regions]
+        sizes = [region_size(region, size) for region, size in regions]
+        return PendingPieces(self, (file, tuple(res), regions, draft, resample, reducing_gap),
+                             sizes)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                _shutdown_executor(self.executor)
+                self.executor = None
+
+
+def enabled():
+    """Test if pieces are rendered in worker processes."""
+    return HAVE_SHARED_MEMORY and RENDER_PROCESSES > 0
+
+
+def get_pool():
+    """Return the render process pool, creating it on first use."""
+    global G_POOL
+    with G_POOL_LOCK:
+        if G_POOL is None:
+            G_POOL = RenderProcessPool()
+        return G_POOL
+
+
+def shutdown_pool():
+    """Stop the render processes, e.g. at exit."""
+    with G_POOL_LOCK:
+        if G_POOL is not None:
+            G_POOL.shutdown()
@@ -0,0 +1,610 @@
+"""
+Reentrant wallpaper rendering.
+
+    import superpaper
+    layout = superpaper.DisplayLayout.from_resolutions([(2560, 1440), (1920, 1080)],
+                                                       [(0, 0), (2560, 360)])
+    result = superpaper.render(["mountain.jpg"], layout, superpaper.RenderOptions())
+    result.compose().save("wallpaper.png")
+
+A render works on a DisplayLayout, an immutable snapshot of a display
+system, and on RenderOptions, and keeps all of its state in its
+arguments and its result. Renders for different layouts can run in many
+threads at once, e.g. for batch rendering. The span functions of
+wallpaper_processing are thin wrappers that snapshot the current
+displays and render into the piece cache of the application.
+
+The pipelines hand their pieces to a sink, see RenderResult for the
+methods a sink has.
+"""
+
+import copy
+import zlib
+from collections import namedtuple
+from operator import itemgetter
+
+from PIL import Image, UnidentifiedImageError
+
+import superpaper.governor as governor
+import superpaper.mipmaps as mipmaps
+import superpaper.perspective as persp
+import superpaper.render_process as render_process
+import superpaper.sp_logging as sp_logging
+from superpaper.render_process import image_orientation
+
+# Layouts whose displays cover less of the bounding canvas than this are sparse.
+SPARSE_LAYOUT_COVERAGE = 0.75
+
+
+def compute_canvas(res_array, offset_array):
+    """Computes the size of the total desktop area from monitor resolutions and offsets."""
+    # Take the subtractions of right-most right - left-most left
+    # and bottom-most bottom - top-most top (=0).
+    leftmost = 0
+    topmost = 0
+    right_edges = []
+    bottom_edges = []
+    for res, off in zip(res_array, offset_array):
+        right_edges.append(off[0]+res[0])
+        bottom_edges.append(off[1]+res[1])
+    # Right-most edge.
+    rightmost = max(right_edges)
+    # Bottom-most edge.
+    bottommost = max(bottom_edges)
+    canvas_size = [rightmost - leftmost, bottommost - topmost]
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("Canvas size: %s", canvas_size)
+    return canvas_size
+
+
+def compute_working_canvas(crop_tuples):
+    """Computes effective size of the desktop are taking into account PPI/offsets/bezels."""
+    # Take the subtractions of right-most right - left-most left
+    # and bottom-most bottom - top-most top (=0).
+    leftmost = 0
+    topmost = 0
+    # Right-most edge of the crop tuples.
+    rightmost = max(crop_tuples, key=itemgetter(2))[2]
+    # Bottom-most edge of the crop tuples.
+    bottommost = max(crop_tuples, key=itemgetter(3))[3]
+    canvas_size = [rightmost - leftmost, bottommost - topmost]
+    return canvas_size
+
+
+def layout_coverage(res_array, offset_array):
+    """Return the fraction of the desktop canvas that is covered by displays."""
+    canvas = compute_canvas(res_array, offset_array)
+    covered = sum(res[0] * res[1] for res in res_array)
+    return min(1.0, covered / (canvas[0] * canvas[1]))
+
+
+def group_persp_data(persp_dat, groups):
+    """Rerturn list of grouped perspective data objects."""
+    if not persp_dat:
+        return [None] * len(groups)
+    group_persp_data_list = []
+    for grp in groups:
+        group_data = {
+            "central_disp": persp_dat["central_disp"],
+            "viewer_pos": persp_dat["viewer_pos"],
+            "swivels": [persp_dat["swivels"][index] for index in grp],
+            "tilts": [persp_dat["tilts"][index] for index in grp]
+        }
+        group_persp_data_list.append(group_data)
+    return group_persp_data_list
+
+
+def translate_to_group_coordinates(group_crop_list):
+    """Translates lists of group crops into groups internal coordinates."""
+    if len(group_crop_list) == 1:
+        return group_crop_list
+    else:
+        group_crop_list_transl = []
+        for grp_crops in group_crop_list:
+            left_anch = min([crp[0] for crp in grp_crops])
+            top_anch = min([crp[1] for crp in grp_crops])
+            transl_crops = []
+            for crp in grp_crops:
+                transl_crops.append(
+                    (crp[0] - left_anch,
+                     crp[1] - top_anch,
+                     crp[2] - left_anch,
+                     crp[3] - top_anch)
+                )
+            group_crop_list_transl.append(transl_crops)
+        return group_crop_list_transl
+
+
+class DisplayLayout(namedtuple("DisplayLayout", [
+        "resolutions", "offsets", "ppi_norm_resolutions", "ppi_norm_offsets",
+        "use_perspective", "default_perspective", "perspectives"])):
+    """
+    Immutable snapshot of a display system.
+
+    resolutions             display resolutions in pixels
+    offsets                 non-negative desktop offsets of the displays
+    ppi_norm_resolutions    resolutions normalized to the highest pixel density
+    ppi_norm_offsets        offsets of the displays on the ppi normalized canvas
+    use_perspective         perspective corrections are enabled
+    default_perspective     name of the perspective that 'default' refers to
+    perspectives            tuple of (name, perspective data) pairs
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_display_system(cls, display_system, resolutions=None, offsets=None):
+        """Snapshot a wallpaper_processing.DisplaySystem.
+
+        resolutions and offsets default to those of its displays.
+        """
+        disp_list = display_system.disp_list
+        if resolutions is None:
+            resolutions = [dsp.resolution for dsp in disp_list]
+        if offsets is None:
+            offsets = [dsp.digital_offset for dsp in disp_list]
+        return cls(
+            tuple(tuple(res) for res in resolutions),
+            tuple(tuple(off) for off in offsets),
+            tuple(tuple(dsp.ppi_norm_resolution) for dsp in disp_list),
+            tuple(tuple(dsp.ppi_norm_offset) for dsp in disp_list),
+            display_system.use_perspective,
+            display_system.default_perspective,
+            tuple((name, copy.deepcopy(data))
+                  for name, data in sorted(display_system.perspective_dict.items())),
+        )
+
+    @classmethod
+    def from_resolutions(cls, resolutions, offsets):
+        """Layout of displays of equal pixel density and no perspectives."""
+        resolutions = tuple(tuple(res) for res in resolutions)
+        offsets = tuple(tuple(off) for off in offsets)
+        return cls(resolutions, offsets, resolutions, offsets, False, None, ())
+
+    @property
+    def num_displays(self):
+        return len(self.resolutions)
+
+    def canvas_size(self):
+        """Return the size of the desktop canvas."""
+        return tuple(compute_canvas(self.resolutions, self.offsets))
+
+    def ppi_norm_crops(self, manual_offsets):
+        """Return the ppi_norm crop tuples to cut from the ppi_norm canvas.
+
+        A valid crop is a 4-tuple: (left, top, right, bottom).
+        """
+        crops = []
+        for index, (ppi_norm_res, ppi_norm_off) in enumerate(zip(self.ppi_norm_resolutions,
+                                                                 self.ppi_norm_offsets)):
+            try:
+                off = manual_offsets[index]
+            except IndexError:
+                off = (0, 0)
+            left_top = (
+                round(ppi_norm_off[0] + off[0]),
+                round(ppi_norm_off[1] + off[1])
+            )
+            right_btm = (
+                round(ppi_norm_res[0]) + left_top[0],
+                round(ppi_norm_res[1]) + left_top[1],
+            )
+            crops.append(left_top + right_btm)
+        return crops
+
+    def persp_data(self, persp_name):
+        """Return the perspective settings dict of persp_name, None if disabled."""
+        if persp_name == "default":
+            get_id = self.default_perspective
+        else:
+            get_id = persp_name
+        if not get_id or get_id == "disabled":
+            return None
+        return dict(self.perspectives).get(get_id)
+
+
+class RenderOptions(namedtuple("RenderOptions", [
+        "spanmode", "ppimode", "perspective", "spangroups", "manual_offsets", "draft"])):
+    """
+    How to render, the profile settings of a render.
+
+    spanmode        'single' spans one image over all displays, 'advanced'
+                    is 'single' with ppimode, 'multi' shows one image per display
+    ppimode         correct for pixel density, bezels and offsets
+    perspective     perspective name, 'default' or 'disabled'
+    spangroups      lists of display indices that each span an image, None for one group
+    manual_offsets  per display offsets in ppi normalized pixels
+    draft           fast resampling, e.g. for a quick first pass
+    """
+    __slots__ = ()
+
+    def __new__(cls, spanmode="single", ppimode=False, perspective="default",
+                spangroups=None, manual_offsets=(), draft=False):
+        if spangroups is not None:
+            spangroups = tuple(tuple(grp) for grp in spangroups)
+        return super().__new__(cls, spanmode, ppimode, perspective, spangroups,
+                               tuple(tuple(off) for off in manual_offsets), draft)
+
+
+class RenderResult():
+    """
+    Display pieces of a render, and the sink that collects them.
+
+    pieces      one image per display, None if its source could not be read
+    sources     source image files of the render
+
+    A sink has get(index, source), which may return a piece rendered
+    earlier from source, put(index, source, img), progress(stage, display)
+    called after each pipeline stage, and checkpoint() called while
+    waiting, which may raise to stop the render.
+    """
+    def __init__(self, layout, sources):
+        self.layout = layout
+        self.sources = list(sources)
+        self.pieces = [None] * layout.num_displays
+
+    def __str__(self):
+        return (
+            f"RenderResult("
+            f"sources={self.sources}, "
+            f"pieces={sum(piece is not None for piece in self.pieces)}"
+            f"/{len(self.pieces)}"
+            f")"
+        )
+
+    def get(self, index, source):
+        return None
+
+    def put(self, index, source, img):
+        self.pieces[index] = img
+
+    def progress(self, stage, display=None):
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def compose(self):
+        """Return the pieces pasted on the desktop canvas."""
+        return compose_canvas(dict(enumerate(self.pieces)), self.layout)
+
+
+def resample_filter(draft):
+    """Return the resampling filter and reducing gap of a render."""
+    if draft:
+        return Image.HAMMING, 1.5
+    return Image.LANCZOS, None
+
+
+def resize_region_to_fill(img, res, region, size=None, orientation=1, draft=False):
+    """Return the region of resize_to_fill(img, res) without rendering the rest.
+
+    region is a (left, top, right, bottom) box in the res sized result and
+    size is the output size, by default the size of region. The source
+    pixels of the region are resampled straight to size, so displays far
+    apart on a large canvas cost only their own area.
+
+    orientation is the EXIF orientation of img. The plan is made for the
+    upright image and mapped to the stored pixels, and only the resampled
+    result is transposed upright.
+
+    Draft renders let a JPEG decode at a reduced scale that still covers
+    res, and resample with a faster filter. The decode is kept within the
+    job memory budget, see governor.fit_image.
+    """
+    resample, reducing_gap = resample_filter(draft)
+    return render_process.resample_region(img, res, region, size, orientation,
+                                          resample, reducing_gap, draft)
+
+
+class LocalPieces():
+    """Pieces rendered in the calling thread once their result is asked for.
+
+    Stands in for render_process.PendingPieces when render processes are
+    not used.
+    """
+    def __init__(self, img, res, regions, orientation, draft):
+        self.img = img
+        self.res = res
+        self.regions = regions
+        self.orientation = orientation
+        self.draft = draft
+
+    def result(self, poll=None):
+        images = []
+        for region, size in self.regions:
+            if poll is not None:
+                poll()
+            images.append(resize_region_to_fill(self.img, self.res, region, size,
+                                                self.orientation, self.draft))
+        return images
+
+    def release(self):
+        pass
+
+
+def start_regions(img, file, res, regions, orientation, draft=False):
+    """Start rendering the regions of resize_to_fill(img, res).
+
+    regions is a list of (region, size) as for resize_region_to_fill,
+    img is the opened file. Returns an object whose result(poll) returns
+    the pieces and whose release() must be called once they are no longer
+    needed. With render processes the pieces are rendered by the pool
+    right away, see render_process, so that several started renders run
+    in parallel. Otherwise they are rendered in the calling thread when
+    the result is asked for.
+    """
+    if not render_process.enabled():
+        return LocalPieces(img, res, regions, orientation, draft)
+    resample, reducing_gap = resample_filter(draft)
+    return render_process.get_pool().submit(file, res, regions, draft,
+                                            resample, reducing_gap)
+
+
+def compose_canvas(images, layout):
+    """Return the desktop canvas of layout with images {display index: image} pasted."""
+    canvas_tuple = layout.canvas_size()
+    governor.check_memory(governor.image_memory(canvas_tuple), "Composing the wallpaper")
+    combined_image = Image.new("RGB", canvas_tuple, color=0)
+    combined_image.load()
+    for index, img in images.items():
+        if img is not None:
+            combined_image.paste(img, layout.offsets[index])
+    return combined_image
+
+
+def canvas_save_options(outputfile, layout, draft=False):
+    """Encoder options for saving the composed canvas.
+
+    On sparse layouts most of the canvas is black, and run-length
+    deflate handles such long empty rows much faster than the default
+    strategy. Drafts are saved with the fastest compression.
+    """
+    options = {"quality": 95}  # set quality if jpg is used, png unaffected
+    if draft:
+        options["quality"] = 75
+        options["compress_level"] = 1
+    coverage = layout_coverage(layout.resolutions, layout.offsets)
+    if outputfile.endswith(".png") and coverage < SPARSE_LAYOUT_COVERAGE:
+        options["compress_type"] = zlib.Z_RLE
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("Layout coverage %.2f, canvas save options %s",
+                                 coverage, options)
+    return options
+
+
+def open_source(file, fill_size):
+    """Open a source image that is resized to fill fill_size.
+
+    Opens the smallest mipmap level of the source that is large enough
+    if there is one, see mipmaps. Returns (image, orientation, path of
+    the opened file), or Nones if the image can't be read.
+    """
+    level = mipmaps.find_level(file, fill_size)
+    if level is not None:
+        try:
+            return Image.open(level), 1, level
+        except (OSError, UnidentifiedImageError) as excep:
+            sp_logging.G_LOGGER.info("Could not open mipmap '%s': %s", level, excep)
+    try:
+        img = Image.open(file)
+        return img, image_orientation(img), file
+    except UnidentifiedImageError:
+        sp_logging.G_LOGGER.info(("Opening image '%s' failed with PIL.UnidentifiedImageError."
+                                  "It could be corrupted or is of foreign type."), file)
+        return None, None, None
+
+
+def render_simple(sources, layout, options, sink):
+    """
+    Spans a single image across all monitors. No corrections.
+
+    This simple method resizes the source image so it fills the whole
+    desktop canvas. Since no corrections are applied, no offset dependent
+    cuts are needed and so this should work on any monitor arrangement.
+    Only the parts of the canvas covered by displays are rendered, as one
+    piece per display.
+    """
+    file = sources[0]
+    if all(sink.get(index, file) is not None for index in range(layout.num_displays)):
+        return
+    canvas_tuple = layout.canvas_size()
+    img, orientation, path = open_source(file, canvas_tuple)
+    if img is None:
+        return
+    sink.progress("load")
+    regions = [((off[0], off[1], off[0] + res[0], off[1] + res[1]), None)
+               for res, off in zip(layout.resolutions, layout.offsets)]
+    pending = start_regions(img, path, canvas_tuple, regions, orientation, options.draft)
+    try:
+        images = pending.result(sink.checkpoint)
+    except render_process.RenderProcessCrashed as excep:
+        sp_logging.G_LOGGER.info("%s", excep)
+        return
+    finally:
+        pending.release()
+    for index, piece in enumerate(images):
+        sink.put(index, file, piece)
+        sink.progress("display", index)
+
+
+# Take pixel densities of displays into account to have the image match
+# physically between displays.
+def render_advanced(sources, layout, options, sink):
+    """
+    Applies wallpaper using PPI, bezel, offset corrections.
+
+    Each span group gets its own image from sources. Groups whose pieces
+    the sink already has for their image are not rendered again.
+    """
+    # Cropping now sections of the image to be shown, USE EFFECTIVE WORKING
+    # SIZES. Also EFFECTIVE SIZE Offsets are now required.
+    crop_tuples = layout.ppi_norm_crops(options.manual_offsets)
+    sp_logging.G_LOGGER.info("use_perspective: %s, perspective: %s",
+                             layout.use_perspective, options.perspective)
+    persp_dat = None
+    if layout.use_perspective:
+        persp_dat = layout.persp_data(options.perspective)
+
+    if options.spangroups:
+        spangroups = options.spangroups
+    else:
+        spangroups = [list(range(layout.num_displays))]
+
+    grp_crop_tuples = translate_to_group_coordinates(
+        [[crop_tuples[index] for index in grp] for grp in spangroups])
+    grp_res_array = [[layout.resolutions[index] for index in grp] for grp in spangroups]
+    grp_persp_dat = group_persp_data(persp_dat, spangroups)
+    resample, reducing_gap = resample_filter(options.draft)
+
+    for fil, grp, grp_p_dat, grp_crops, grp_res_arr in zip(sources,
+                                                           spangroups,
+                                                           grp_persp_dat,
+                                                           grp_crop_tuples,
+                                                           grp_res_array):
+        if all(sink.get(index, fil) is not None for index in grp):
+            for index in grp:
+                sink.progress("display", index)
+            continue
+        sink.checkpoint()
+        if persp_dat:
+            proj_plane_crops, persp_coeffs = persp.get_backprojected_display_system(grp_crops,
+                                                                                    grp_p_dat)
+            # Canvas containing back-projected displays
+            canvas_tuple_proj = tuple(compute_working_canvas(proj_plane_crops))
+            fill_size = canvas_tuple_proj
+        else:
+            # larger working size needed to fill all the normalized lower density
+            # displays. Takes account manual offsets that might require extra space.
+            canvas_tuple_eff = tuple(compute_working_canvas(grp_crops))
+            fill_size = canvas_tuple_eff
+        img, orientation, path = open_source(fil, fill_size)
+        if img is None:
+            continue
+        sink.progress("load")
+        if persp_dat:
+            # Canvas containing ppi normalized displays
+            canvas_tuple_trgt = tuple(compute_working_canvas(grp_crops))
+            sp_logging.G_LOGGER.info("Back-projected canvas size: %s", canvas_tuple_proj)
+            governor.check_memory(governor.image_memory(canvas_tuple_proj)
+                                  + governor.image_memory(canvas_tuple_trgt),
+                                  "Perspective working canvases")
+            img_workingsize = resize_region_to_fill(img, canvas_tuple_proj,
+                                                    (0, 0) + canvas_tuple_proj,
+                                                    orientation=orientation,
+                                                    draft=options.draft)
+            for crop_tup, coeffs, ppin_crop, (i_res, res) in zip(proj_plane_crops,
+                                                                 persp_coeffs,
+                                                                 grp_crops,
+                                                                 enumerate(grp_res_arr)):
+                # Whole image needs to be transformed for each display separately
+                # since the coeffs live between the full back-projected plane
+                # containing all displays and the full 'target' working canvas
+                # size canvas_tuple_trgt containing ppi normalized displays.
+                sink.checkpoint()
+                persp_crop = img_workingsize.transform(canvas_tuple_trgt,
+                                                       Image.PERSPECTIVE, coeffs,
+                                                       Image.BILINEAR if options.draft
+                                                       else Image.BICUBIC)
+                ## persp_crop.save(str(canvas_tuple_trgt)+str(crop_tup), "PNG")
+                # Crop desired region from transformed image which is now in
+                # ppi normalized resolution
+                crop_img = persp_crop.crop(ppin_crop)
+                # Resize correct crop to actual display resolution
+                crop_img = crop_img.resize(res, resample=resample, reducing_gap=reducing_gap)
+                sink.put(grp[i_res], fil, crop_img)
+                sink.progress("display", grp[i_res])
+        else:
+            # The working canvas is the height of the eff tallest display + possible
+            # manual offsets and the width of the combined eff widths + possible manual
+            # offsets. Each display crop of it is resampled from the source straight
+            # to the actual resolution, the working canvas itself is never rendered.
+            pending = start_regions(img, path, canvas_tuple_eff,
+                                    list(zip(grp_crops, grp_res_arr)), orientation,
+                                    options.draft)
+            try:
+                crop_imgs = pending.result(sink.checkpoint)
+            except render_process.RenderProcessCrashed as excep:
+                sp_logging.G_LOGGER.info("%s", excep)
+                continue
+            finally:
+                pending.release()
+            for i_res, crop_img in enumerate(crop_imgs):
+                sink.put(grp[i_res], fil, crop_img)
+                sink.progress("display", grp[i_res])
+    sink.checkpoint()
+
+
+def render_multi(sources, layout, options, sink):
+    """Renders a distinct image for each display.
+
+    Displays whose piece the sink already has for their image are not
+    rendered again.
+    """
+    started = []
+    try:
+        for index, (file, res) in enumerate(zip(sources, layout.resolutions)):
+            if sink.get(index, file) is not None:
+                sink.progress("display", index)
+                continue
+            image, orientation, path = open_source(file, res)
+            if image is None:
+                continue
+            started.append((index, file, start_regions(image, path, res,
+                                                       [((0, 0, res[0], res[1]), None)],
+                                                       orientation, options.draft)))
+        # with render processes the displays render in parallel
+        for index, file, pending in started:
+            try:
+                piece = pending.result(sink.checkpoint)[0]
+            except render_process.RenderProcessCrashed as excep:
+                sp_logging.G_LOGGER.info("%s", excep)
+                continue
+            sink.put(index, file, piece)
+            sink.progress("display", index)
+    finally:
+        for _, _, pending in started:
+            pending.release()
+
+
+def pipeline(options):
+    """Return the render pipeline function of options, None if the spanmode is unknown."""
+    if options.spanmode.startswith("single") and not options.ppimode:
+        return render_simple
+    if ((options.spanmode.startswith("single") and options.ppimode) or
+            options.spanmode.startswith("advanced")):
+        return render_advanced
+    if options.spanmode.startswith("multi"):
+        return render_multi
+    return None
+
+
+def fill_size(layout, options):
+    """Return the largest area a render of options fills with a source image.
+
+    The perspective canvas is left out, it depends on the viewer.
+    """
+    if pipeline(options) is render_advanced:
+        return tuple(compute_working_canvas(layout.ppi_norm_crops(options.manual_offsets)))
+    return layout.canvas_size()
+
+
+def render(sources, display_system, options=None):
+    """Render the display pieces of a wallpaper and return a RenderResult.
+
+    sources         image files, one for 'single', one per span group for
+                    'advanced' and one per display for 'multi' spanmode
+    display_system  DisplayLayout, or a DisplaySystem that is snapshotted
+    options         RenderOptions, the defaults span one image without corrections
+
+    Safe to call from many threads at once.
+    """
+    if not isinstance(display_system, DisplayLayout):
+        display_system = DisplayLayout.from_display_system(display_system)
+    if options is None:
+        options = RenderOptions()
+    render_func = pipeline(options)
+    if render_func is None:
+        raise ValueError("Unknown spanmode: {}".format(options.spanmode))
+    result = RenderResult(display_system, sources)
+    render_func(list(sources), display_system, options, result)
+    return result
@@ -0,0 +1,63 @@
+"""
+Timing instrumentation for Superpaper.
+
+Collects running statistics of named timings, e.g. how long the
+wallpaper setter backends take, so they can be logged and inspected.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import superpaper.sp_logging as sp_logging
+
+G_METRICS = {}
+G_METRICS_LOCK = threading.Lock()
+
+
+class TimingStat():
+    """Running statistics of a named timing."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "last": round(self.last, 4),
+            "mean": round(self.total / self.count, 4) if self.count else 0.0,
+            "max": round(self.max, 4),
+        }
+
+
+def record(name, seconds):
+    """Add a timing measurement under name."""
+    with G_METRICS_LOCK:
+        stat = G_METRICS.setdefault(name, TimingStat())
+        stat.add(seconds)
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("timing %s: %.3f s", name, seconds)
+
+
+@contextmanager
+def timed(name):
+    """Context manager that records the wall time spent in its block."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def snapshot():
+    """Return a dict of all timings as plain dicts."""
+    with G_METRICS_LOCK:
+        return {name: stat.as_dict() for name, stat in G_METRICS.items()}
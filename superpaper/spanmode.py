@@ -1,7 +1,7 @@
 """Control host OS desktop background spanning mode when needed."""
-import os
 import platform
-import subprocess
+
+from superpaper.wallpaper_setters import get_backend
 
 if platform.system() == "Windows":
     import winreg
@@ -25,31 +25,7 @@ def set_spanmode():
         winreg.SetValueEx(reg_key_desktop, "WallpaperStyle", 0, winreg.REG_SZ, "22")
         winreg.SetValueEx(reg_key_desktop, "TileWallpaper", 0, winreg.REG_SZ, "0")
     elif pltf == "Linux":
-        desk_env = os.environ.get("DESKTOP_SESSION")
-        if desk_env:
-            if desk_env in ["gnome", "gnome-wayland", "gnome-xorg",
-                            "unity", "ubuntu",
-                            "pantheon", "budgie-desktop",
-                            "pop"]:
-                subprocess.run(["/usr/bin/gsettings", "set",
-                                "org.gnome.desktop.background", "picture-options",
-                                "spanned"])
-            elif desk_env in ["cinnamon"]:
-                subprocess.run(["/usr/bin/gsettings", "set",
-                                "org.cinnamon.desktop.background", "picture-options",
-                                "spanned"])
-            elif desk_env in ["mate"]:
-                subprocess.run(["/usr/bin/gsettings", "set",
-                                "org.mate.background", "picture-options",
-                                "spanned"])
-            elif desk_env.lower() == "lubuntu" or "lxqt" in desk_env.lower():
-                try:
-                    subprocess.run(["pcmanfm", "--wallpaper-mode=stretch"])
-                except OSError:
-                    try:
-                        subprocess.run(["pcmanfm-qt", "--wallpaper-mode=stretch"])
-                    except OSError:
-                        pass
+        get_backend().set_spanmode()
     elif pltf == "Darwin":
         # Mac support TODO
         pass
@@ -0,0 +1,188 @@
+"""
+Thumbnail service for the Superpaper configuration GUI.
+
+Thumbnails are generated on a small worker pool using reduced resolution
+decoding and are stored on disk so that the dialogs do not need to decode
+the full size images again the next time they are opened.
+
+On Linux the shared freedesktop.org thumbnail cache is used
+($XDG_CACHE_HOME/thumbnails/normal), elsewhere a private store with
+the same layout is kept in the Superpaper cache folder.
+"""
+
+import hashlib
+import os
+import platform
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, PngImagePlugin, UnidentifiedImageError
+
+import superpaper.governor as governor
+import superpaper.sp_logging as sp_logging
+from superpaper.sp_paths import TEMP_PATH
+
+# Size of the 'normal' freedesktop thumbnail flavor.
+THUMB_SIZE = 128
+THUMB_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+G_THUMBNAIL_SERVICE = None
+G_THUMBNAIL_SERVICE_LOCK = threading.Lock()
+
+
+def thumbnail_dir():
+    """Return the folder the thumbnails are stored in, creating it if needed.
+
+    Uses the freedesktop.org shared thumbnail cache on Linux outside of
+    the snap sandbox and a private store in the Superpaper cache otherwise.
+    """
+    if platform.system() == "Linux" and not os.environ.get("SNAP_USER_COMMON"):
+        xdg_cache = os.environ.get("XDG_CACHE_HOME")
+        if not xdg_cache or not os.path.isdir(xdg_cache):
+            xdg_cache = os.path.join(os.path.expanduser("~"), ".cache")
+        thumb_path = os.path.join(xdg_cache, "thumbnails", "normal")
+    else:
+        thumb_path = os.path.join(TEMP_PATH, "thumbnails", "normal")
+    try:
+        os.makedirs(thumb_path, mode=0o700, exist_ok=True)
+    except OSError:
+        thumb_path = os.path.join(TEMP_PATH, "thumbnails", "normal")
+        os.makedirs(thumb_path, mode=0o700, exist_ok=True)
+    return thumb_path
+
+
+def file_uri(path):
+    """Return the canonical file:// URI of path as required by the thumbnail spec."""
+    return urllib.parse.urljoin("file:", urllib.request.pathname2url(os.path.abspath(path)))
+
+
+def thumbnail_path(path, thumb_folder=None):
+    """Return the cache file name of the thumbnail of the image at path."""
+    if thumb_folder is None:
+        thumb_folder = thumbnail_dir()
+    digest = hashlib.md5(file_uri(path).encode("utf-8")).hexdigest()
+    return os.path.join(thumb_folder, digest + ".png")
+
+
+def load_cached_thumbnail(path, thumb_folder=None):
+    """Return the cached thumbnail of path as a PIL image if it is valid, otherwise None.
+
+    A cached thumbnail is valid if it was made of the same file URI
+    and the modification time of the source has not changed since.
+    """
+    thumb_file = thumbnail_path(path, thumb_folder)
+    if not os.path.isfile(thumb_file):
+        return None
+    try:
+        src_mtime = int(os.stat(path).st_mtime)
+        thumb = Image.open(thumb_file)
+        thumb.load()
+    except (OSError, UnidentifiedImageError):
+        return None
+    if (thumb.info.get("Thumb::URI") != file_uri(path)
+            or thumb.info.get("Thumb::MTime") != str(src_mtime)):
+        return None
+    return thumb
+
+
+def create_thumbnail(path, size=THUMB_SIZE, thumb_folder=None):
+    """Decode image at reduced resolution, store it in the cache and return it.
+
+    Image.draft lets the JPEG decoder skip most of the work by decoding
+    straight into a reduced scale, other formats are decoded normally.
+    Orientation is applied only to the small result.
+    """
+    if thumb_folder is None:
+        thumb_folder = thumbnail_dir()
+    try:
+        src_stat = os.stat(path)
+        img = Image.open(path)
+        img.draft("RGB", (size, size))
+        img.thumbnail((size, size), Image.BILINEAR, reducing_gap=2.0)
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    except (OSError, UnidentifiedImageError, ValueError) as excep:
+        sp_logging.G_LOGGER.info("Thumbnail creation failed for '%s': %s", path, excep)
+        return None
+
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("Thumb::URI", file_uri(path))
+    pnginfo.add_text("Thumb::MTime", str(int(src_stat.st_mtime)))
+    pnginfo.add_text("Thumb::Size", str(src_stat.st_size))
+    pnginfo.add_text("Software", "Superpaper")
+    # Write to a temp file first and then move it in place so that
+    # other readers of the shared cache never see partial files.
+    try:
+        fdesc, tmp_name = tempfile.mkstemp(suffix=".png", dir=thumb_folder)
+        with os.fdopen(fdesc, "wb") as tmp_file:
+            img.save(tmp_file, "PNG", pnginfo=pnginfo)
+        os.chmod(tmp_name, 0o600)
+        os.replace(tmp_name, thumbnail_path(path, thumb_folder))
+    except OSError as excep:
+        sp_logging.G_LOGGER.info("Could not write thumbnail of '%s': %s", path, excep)
+    return img
+
+
+class ThumbnailService():
+    """
+    Creates and caches thumbnails on a worker pool.
+
+    Requests are served from the disk cache when possible, otherwise a
+    thumbnail is generated and stored. The callback given with a request
+    is called on a worker thread with (path, PIL image or None), GUI
+    users must move the result to the UI thread themselves.
+    """
+    def __init__(self, size=THUMB_SIZE, max_workers=THUMB_WORKERS):
+        self.size = size
+        self.thumb_folder = thumbnail_dir()
+        self.executor = ThreadPoolExecutor(max_workers=governor.worker_limit(max_workers),
+                                           thread_name_prefix="sp-thumbnail",
+                                           initializer=governor.lower_thread_priority)
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+
+    def get_thumbnail(self, path):
+        """Return thumbnail of path from cache or by creating it. Blocks."""
+        thumb = load_cached_thumbnail(path, self.thumb_folder)
+        if thumb is None:
+            thumb = create_thumbnail(path, self.size, self.thumb_folder)
+        return thumb
+
+    def request(self, path, callback):
+        """Queue a thumbnail request, callback(path, image) is run once done."""
+        future = self.executor.submit(self._serve, path, callback)
+        with self.pending_lock:
+            self.pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def cancel_pending(self):
+        """Drop queued requests that have not started yet."""
+        with self.pending_lock:
+            for future in list(self.pending):
+                future.cancel()
+
+    def _serve(self, path, callback):
+        thumb = self.get_thumbnail(path)
+        try:
+            callback(path, thumb)
+        except Exception as excep:
+            sp_logging.G_LOGGER.info("Thumbnail callback failed for '%s': %s", path, excep)
+        return thumb
+
+    def _discard(self, future):
+        with self.pending_lock:
+            self.pending.discard(future)
+
+
+def get_thumbnail_service():
+    """Return the application wide ThumbnailService, creating it on first use."""
+    global G_THUMBNAIL_SERVICE
+    with G_THUMBNAIL_SERVICE_LOCK:
+        if G_THUMBNAIL_SERVICE is None:
+            G_THUMBNAIL_SERVICE = ThumbnailService()
+        return G_THUMBNAIL_SERVICE
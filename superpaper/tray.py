@@ -8,11 +8,15 @@ import sys
 from threading import Lock
 
 from superpaper.__version__ import __version__
+import superpaper.history as history
+import superpaper.render_process as render_process
 import superpaper.sp_logging as sp_logging
 import superpaper.sp_paths as sp_paths
 import superpaper.wallpaper_processing as wpproc
 from superpaper.gui import ConfigFrame
 from superpaper.configuration_dialogs import SettingsFrame, HelpFrame
+from superpaper.control import ControlServer, TrayControlHandler
+from superpaper.profile_schedule import ProfileScheduler
 from superpaper.message_dialog import show_message_dialog
 from superpaper.data import (GeneralSettingsData,
     list_profiles, open_profile, read_active_profile, write_active_profile)
@@ -99,6 +103,19 @@ class TaskBarIcon(wx.adv.TaskBarIcon):
         if self.active_profile:
             wpproc.G_ACTIVE_PROFILE = self.active_profile.name
         self.start_prev_profile(self.active_profile)
+        # Let CLI calls be served by this instance.
+        self.control_server = ControlServer(TrayControlHandler(self))
+        self.control_server.start()
+        # Follow display hotplugs, with the frame prerendered for known topologies.
+        wpproc.start_topology_watch()
+        # Switch profiles by the time of day schedule.
+        self.profile_scheduler = ProfileScheduler(
+            self.g_settings.profile_schedule,
+            self.g_settings.profile_schedule_lead,
+            self.get_profile_by_name,
+            lambda: self.active_profile.name if self.active_profile else None,
+            lambda profile: wx.CallAfter(self.start_profile, None, profile))
+        self.profile_scheduler.start()
         # if self.active_profile is None:
         #     sp_logging.G_LOGGER.info("Starting up the first profile found.")
         #     self.start_profile(wx.EVT_MENU, self.list_of_profiles[0])
@@ -192,6 +209,21 @@ Check that it is formatted properly and valid keys.".format(self.g_settings.hk_b
                             sp_logging.G_LOGGER.info(msg)
                             sp_logging.G_LOGGER.info(sys.exc_info()[0])
                             show_message_dialog(msg, "Error")
+                    if (self.g_settings.hk_binding_previous is not None
+                            and self.g_settings.hk_binding_previous not in self.seen_binding):
+                        try:
+                            self.hk.register(
+                                self.g_settings.hk_binding_previous,
+                                callback=lambda x: self.previous_wallpaper(wx.EVT_MENU),
+                                overwrite=False)
+                            self.seen_binding.add(self.g_settings.hk_binding_previous)
+                        # except (SystemHotkeyError, SystemRegisterError, InvalidKeyError):
+                        except:
+                            msg = "Error: could not register hotkey {}. \
+Check that it is formatted properly and valid keys.".format(self.g_settings.hk_binding_previous)
+                            sp_logging.G_LOGGER.info(msg)
+                            sp_logging.G_LOGGER.info(sys.exc_info()[0])
+                            show_message_dialog(msg, "Error")
                     if self.g_settings.hk_binding_pause not in self.seen_binding:
                         try:
                             self.hk.register(
@@ -214,6 +246,8 @@ Check that it is formatted properly and valid keys.".format(self.g_settings.hk_b
 
                     # register profile specific bindings
                     self.list_of_profiles = list_profiles()
+                    # Keep the hotkey profiles ready for an instant switch.
+                    wpproc.set_warm_profiles(self.hotkey_profiles())
                     for profile in self.list_of_profiles:
                         if sp_logging.DEBUG:
                             sp_logging.G_LOGGER.info(
@@ -302,6 +336,7 @@ Check that it is formatted properly and valid keys.".format(profile.hk_binding)
         for item in self.list_of_profiles:
             create_menu_item(menu, item.name, self.start_profile, item)
         menu.AppendSeparator()
+        create_menu_item(menu, "Previous Wallpaper", self.previous_wallpaper)
         create_menu_item(menu, "Next Wallpaper", self.next_wallpaper)
         self.pause_item = create_menu_item(
             menu, "Pause Timer", self.pause_timer, kind=wx.ITEM_CHECK)
@@ -349,6 +384,13 @@ Check that it is formatted properly and valid keys.".format(profile.hk_binding)
     def reload_profiles(self, event):
         """Reloads profiles from disk."""
         self.list_of_profiles = list_profiles()
+        wpproc.set_warm_profiles(self.hotkey_profiles())
+
+    def hotkey_profiles(self):
+        """Return the profiles that have a hotkey binding."""
+        if not self.g_settings.use_hotkeys:
+            return []
+        return [prof for prof in self.list_of_profiles if prof.hk_binding is not None]
 
     def start_prev_profile(self, profile):
         """Checks if a previously running profile has been recorded and starts it."""
@@ -427,15 +469,40 @@ Check that it is formatted properly and valid keys.".format(profile.hk_binding)
                 return thrd
 
     def next_wallpaper(self, event):
-        """Calls the next wallpaper changer method of the running profile."""
+        """Calls the next wallpaper changer method of the running profile.
+
+        After stepping back in the history, steps forward in it instead.
+        """
         with self.job_lock:
-            if (self.repeating_timer is not None
+            if not history.get_history().at_latest():
+                self.step_history(1)
+            elif (self.repeating_timer is not None
                     and self.repeating_timer.is_running):
                 self.repeating_timer.stop()
-                change_wallpaper_job(self.active_profile)
+                change_wallpaper_job(self.active_profile, progressive=True)
                 self.repeating_timer.start()
             else:
-                change_wallpaper_job(self.active_profile)
+                change_wallpaper_job(self.active_profile, progressive=True)
+
+    def previous_wallpaper(self, event):
+        """Sets the previous wallpaper from the history."""
+        with self.job_lock:
+            self.step_history(-1)
+
+    def step_history(self, offset):
+        """Set the wallpaper offset steps away in the history, restarting the slideshow timer."""
+        entry = history.get_history().step(offset)
+        if entry is None:
+            sp_logging.G_LOGGER.info("No wallpaper in the history in that direction.")
+            return None
+        if (self.repeating_timer is not None
+                and self.repeating_timer.is_running):
+            self.repeating_timer.stop()
+            job = wpproc.show_history_entry(entry)
+            self.repeating_timer.start()
+        else:
+            job = wpproc.show_history_entry(entry)
+        return job
 
     def rt_stop(self):
         """Stops running slideshow timer if one is active."""
@@ -445,20 +512,32 @@ Check that it is formatted properly and valid keys.".format(profile.hk_binding)
 
     def pause_timer(self, event):
         """Check if a slideshow timer is running and if it is, then try to stop/start."""
-        if (self.repeating_timer is not None
-                and self.repeating_timer.is_running):
-            self.repeating_timer.stop()
-            self.is_paused = True
-            if sp_logging.DEBUG:
-                sp_logging.G_LOGGER.info("Paused timer")
-        elif (self.repeating_timer is not None
-              and not self.repeating_timer.is_running):
-            self.repeating_timer.start()
-            self.is_paused = False
-            if sp_logging.DEBUG:
-                sp_logging.G_LOGGER.info("Resumed timer")
-        else:
-            sp_logging.G_LOGGER.info("Current profile isn't using a timer.")
+        with self.job_lock:
+            if (self.repeating_timer is not None
+                    and self.repeating_timer.is_running):
+                self.repeating_timer.pause()
+                self.is_paused = True
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Paused timer")
+            elif (self.repeating_timer is not None
+                  and not self.repeating_timer.is_running):
+                self.repeating_timer.resume()
+                self.is_paused = False
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Resumed timer")
+            else:
+                sp_logging.G_LOGGER.info("Current profile isn't using a timer.")
+        self.update_pause_item()
+
+    def update_pause_item(self):
+        """Match the Pause Timer check item to the pause state, e.g. after a control command."""
+        if self.pause_item is None:
+            return
+        try:
+            self.pause_item.Check(self.is_paused)
+        except RuntimeError:
+            # the menu of the item has been closed and destroyed
+            self.pause_item = None
 
     def on_about(self, event):
         """Opens About dialog."""
@@ -502,6 +581,10 @@ Check that it is formatted properly and valid keys.".format(profile.hk_binding)
     def on_exit(self, event):
         """Exits Superpaper."""
         self.rt_stop()
+        self.control_server.stop()
+        self.profile_scheduler.stop()
+        wpproc.stop_topology_watch()
+        render_process.shutdown_pool()
         wx.CallAfter(self.Destroy)
         self.frame.Close()
 
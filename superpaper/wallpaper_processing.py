@@ -8,44 +8,37 @@ Written by Henri Hänninen, copyright 2022 under MIT licence.
 """
 
 import configparser
+import heapq
 import math
 import os
 import platform
 import subprocess
-import sys
+import time
+from collections import OrderedDict
 from operator import itemgetter
-from threading import Lock, Thread, Timer
+from threading import Condition, Event, Lock, RLock, Thread, local
 
-from PIL import Image, ImageOps, UnidentifiedImageError
+from PIL import Image
 from screeninfo import get_monitors
 
-import superpaper.perspective as persp
+import superpaper.governor as governor
+import superpaper.history as history
+import superpaper.mipmaps as mipmaps
+import superpaper.power as power
+import superpaper.renderer as renderer
 import superpaper.sp_logging as sp_logging
+from superpaper.hooks import LEGACY_SCRIPT, WallpaperChangeEvent, run_hooks
 from superpaper.message_dialog import show_message_dialog
+from superpaper.renderer import compute_canvas, compute_working_canvas
 from superpaper.sp_paths import CONFIG_PATH, TEMP_PATH
+from superpaper.wallpaper_setters import get_backend, run_set_command
 
 # Disables PIL.Image.DecompressionBombError.
 Image.MAX_IMAGE_PIXELS = None # 715827880 would be 4x default max.
 
 
-def running_kde():
-    """Detect if running in a KDE session."""
-    d_ses = os.environ.get("DESKTOP_SESSION")
-    if d_ses and ("plasma" in d_ses or "kde" in d_ses):
-        return True
-    kde_f_ses = os.environ.get("KDE_FULL_SESSION")
-    xdg_ses_dtop = os.environ.get("XDG_SESSION_DESKTOP")
-    if kde_f_ses == "true" or xdg_ses_dtop == "KDE":
-        return True
-    return False
-
 if platform.system() == "Windows":
     from superpaper.wallpaper_windows import set_wallpaper_win
-elif platform.system() == "Linux":
-    # KDE has special needs
-    # if os.environ.get("DESKTOP_SESSION") in ["/usr/share/xsessions/plasma", "plasma"]:
-    if running_kde():
-        import dbus
 elif platform.system() == "Darwin":
     from AppKit import NSScreen, NSWorkspace
     from Foundation import NSURL
@@ -62,6 +55,26 @@ DISPLAY_OFFSET_ARRAY = []
 G_ACTIVE_DISPLAYSYSTEM = None
 G_ACTIVE_PROFILE = None
 G_WALLPAPER_CHANGE_LOCK = Lock()
+# Held while the display globals are replaced, see topology_context.
+G_DISPLAY_DATA_LOCK = RLock()
+G_RENDER_WORKER = None
+G_SCHEDULER = None
+# Per display pieces of recently rendered profiles, see PieceSet.
+G_PIECE_SETS = OrderedDict()
+G_PIECE_SETS_MAX = 2        # besides the pinned sets of warm profiles
+TOPOLOGY_FILE = os.path.join(CONFIG_PATH, "display_topologies.dat")
+TOPOLOGY_VARIANTS_MAX = 3       # set from general_settings, 0 disables
+# Apply hotkey changes and profile starts as a fast draft first, see change_wallpaper_job.
+PROGRESSIVE_APPLY = False       # set from general_settings
+TOPOLOGY_CHECK_INTERVAL = 5     # seconds
+G_TOPOLOGY_VARIANTS = OrderedDict()     # topology key -> TopologyVariant
+G_CURRENT_FRAME = None                  # (profile, files) last set
+G_TOPOLOGY_WATCH = None
+G_PRERENDERED_FRAMES = {}   # profile name -> files of its next start, see prerender_first_frame
+G_WARM_PROFILES = []        # hotkey profiles whose next frame is kept prerendered
+WARM_CACHE_DELAY = 30       # seconds from a profile or display change to the warm up
+WARM_CACHE_INTERVAL = 600   # seconds between checks that the warm frames are still valid
+G_WARM_CACHE_JOB = None
 G_SUPPORTED_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff", ".webp")
 G_SET_COMMAND_STRING = ""
 
@@ -70,36 +83,617 @@ USER_TOLD_OF_PHYS_FAIL = False
 
 
 
-class RepeatedTimer(object):
-    """Threaded timer used for slideshow."""
-    # Credit:
-    # https://stackoverflow.com/questions/3393612/run-certain-code-every-n-seconds/13151299#13151299
-    def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
+if hasattr(time, "CLOCK_BOOTTIME"):
+    def scheduler_clock():
+        """Monotonic clock for the slideshow scheduler.
+
+        CLOCK_BOOTTIME keeps counting while the system is suspended. Where
+        it is not available, suspends are detected by the scheduler from
+        the wall clock instead.
+        """
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    CLOCK_COUNTS_SUSPEND = True
+else:
+    scheduler_clock = time.monotonic
+    CLOCK_COUNTS_SUSPEND = False
+
+
+class ScheduledJob():
+    """
+    A repeating job of the SlideshowScheduler.
+
+    Deadlines advance by the interval from the previous deadline, not from
+    when the job happened to run, so the slideshow does not drift. The job
+    is started lead_time seconds ahead of its deadline, where the lead time
+    follows the measured duration of previous runs if the job function
+    returns a handle with add_done_callback, e.g. a RenderJob.
+
+    late_policy decides what happens if a deadline was missed by more than
+    an interval, e.g. during a suspend: "run" runs the job once right away,
+    "skip" drops the missed run and waits for the next interval. In both
+    cases missed runs are never queued up.
+
+    A power_aware job skips its runs while the screen is locked or the
+    displays are off. On battery its interval is stretched and the job
+    function is called with low_power=True. Under CPU pressure its run is
+    retried a little later, see governor.under_pressure, without moving
+    its deadline.
+    """
+    def __init__(self, scheduler, interval, function, args=(), kwargs=None,
+                 late_policy="run", max_lead=None, power_aware=False):
+        self.scheduler = scheduler
         self.interval = interval
         self.function = function
         self.args = args
-        self.kwargs = kwargs
-        self.is_running = False
-        self.start()
+        self.kwargs = kwargs if kwargs else {}
+        self.late_policy = late_policy
+        self.power_aware = power_aware
+        self.deferred_since = None
+        self.max_lead = max_lead if max_lead is not None else interval / 4
+        self.lead_time = 0
+        self.deadline = None
+        self.remaining = None
+        self.retry_seq = None   # heap entry of a pending retry, see SlideshowScheduler.retry
+        self.state = "stopped"  # scheduled / paused / stopped
+
+    @property
+    def is_running(self):
+        """True if the job is scheduled, i.e. not paused or stopped."""
+        return self.state == "scheduled"
+
+    def start(self, delay=None):
+        """(Re)schedule the job to run after delay, default is one interval."""
+        if delay is None:
+            delay = self.interval
+        self.scheduler.schedule(self, scheduler_clock() + delay)
+
+    def stop(self):
+        """Unschedule the job."""
+        self.scheduler.unschedule(self, "stopped")
+
+    def pause(self):
+        """Unschedule the job keeping the remaining time until its deadline."""
+        if self.state == "scheduled":
+            self.remaining = max(0, self.deadline - scheduler_clock())
+            self.scheduler.unschedule(self, "paused")
+
+    def resume(self):
+        """Reschedule a paused job with the time it had remaining."""
+        if self.state == "paused":
+            self.start(self.remaining)
+
+    def fire_time(self):
+        """Time at which the job needs to be started to finish by its deadline."""
+        return self.deadline - min(self.lead_time, self.max_lead)
+
+    def run(self, retry=False):
+        """Run job function and measure its duration for the lead time.
+
+        retry is set when a run deferred under CPU pressure is tried again.
+        """
+        kwargs = self.kwargs
+        if self.power_aware and power.POWER_AWARE:
+            state = power.read_power_state()
+            if state.idle:
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Wallpaper not visible, skipping %s", self.function)
+                return
+            if state.on_battery:
+                if not retry:
+                    # the deadline was stretched when the run was first due
+                    self.scheduler.postpone(
+                        self, self.interval * (power.BATTERY_INTERVAL_FACTOR - 1))
+                kwargs = dict(kwargs, low_power=True)
+        if self.power_aware and self._defer():
+            return
+        started = scheduler_clock()
+        try:
+            handle = self.function(*self.args, **kwargs)
+        except Exception:
+            sp_logging.G_LOGGER.exception("Scheduled job failed: %s", self.function)
+            return
+        if handle is not None and hasattr(handle, "add_done_callback"):
+            handle.add_done_callback(lambda hndl: self._measure(started, hndl))
+
+    def _defer(self):
+        """Retry the run later if the CPU is under pressure, for a limited time."""
+        now = scheduler_clock()
+        if self.deferred_since is None:
+            self.deferred_since = now
+        if (now - self.deferred_since < governor.PRESSURE_MAX_DEFER
+                and governor.under_pressure()):
+            if sp_logging.DEBUG:
+                sp_logging.G_LOGGER.info("Deferring %s under CPU pressure.", self.function)
+            self.scheduler.retry(self, min(self.interval, governor.PRESSURE_RETRY_DELAY))
+            return True
+        self.deferred_since = None
+        return False
+
+    def _measure(self, started, handle):
+        if getattr(handle, "state", "done") != "done":
+            return
+        duration = scheduler_clock() - started
+        # exponential moving average of the run times
+        if self.lead_time:
+            self.lead_time = 0.7 * self.lead_time + 0.3 * duration
+        else:
+            self.lead_time = duration
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Scheduled job took %.2f s, lead time is %.2f s",
+                                     duration, self.lead_time)
+
+
+class SlideshowScheduler():
+    """
+    Single thread scheduler for slideshow and other timed jobs.
+
+    Jobs wait in a priority queue ordered by the time they need to be
+    started. Suspends are handled by the clock choice or by detecting
+    wall clock jumps, see scheduler_clock and ScheduledJob.late_policy.
+    """
+    # A wall clock jump this big compared to the monotonic clock is
+    # taken to be a system suspend.
+    SUSPEND_DETECT_THRESHOLD = 5
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.cond = Condition()
+        self.wall_offset = time.time() - scheduler_clock()
+        self.thread = Thread(target=self._run, name="sp-scheduler", daemon=True)
+        self.thread.start()
+
+    def add_job(self, interval, function, *args, start_delay=None, power_aware=False,
+                **kwargs):
+        """Create a repeating job and schedule it."""
+        job = ScheduledJob(self, interval, function, args, kwargs, power_aware=power_aware)
+        job.start(start_delay)
+        return job
+
+    def schedule(self, job, deadline):
+        with self.cond:
+            job.deadline = deadline
+            job.remaining = None
+            job.retry_seq = None
+            job.state = "scheduled"
+            self.seq += 1
+            # Stale heap entries are recognized by their sequence number.
+            job.seq = self.seq
+            heapq.heappush(self.heap, (job.fire_time(), self.seq, job))
+            self.cond.notify()
+
+    def postpone(self, job, delay):
+        """Move the next deadline of a scheduled job later by delay seconds."""
+        with self.cond:
+            if job.state != "scheduled" or delay <= 0:
+                return
+            job.deadline += delay
+            self.seq += 1
+            job.seq = self.seq
+            heapq.heappush(self.heap, (job.fire_time(), self.seq, job))
+            self.cond.notify()
+
+    def retry(self, job, delay):
+        """Run a scheduled job once more after delay seconds, keeping its deadline."""
+        with self.cond:
+            if job.state != "scheduled":
+                return
+            self.seq += 1
+            job.retry_seq = self.seq
+            heapq.heappush(self.heap, (scheduler_clock() + delay, self.seq, job))
+            self.cond.notify()
+
+    def unschedule(self, job, state):
+        with self.cond:
+            job.state = state
+            job.seq = None
+            job.retry_seq = None
+            self.cond.notify()
+
+    def _account_suspend(self, now):
+        """Move deadlines earlier by the suspended time if the clock missed it."""
+        offset = time.time() - now
+        jump = offset - self.wall_offset
+        self.wall_offset = offset
+        if CLOCK_COUNTS_SUSPEND or jump < self.SUSPEND_DETECT_THRESHOLD:
+            return
+        sp_logging.G_LOGGER.info("Detected a suspend of %.0f seconds.", jump)
+        entries = self.heap
+        self.heap = []
+        for fire_time, seq, job in entries:
+            if job.seq == seq:
+                job.deadline -= jump
+                heapq.heappush(self.heap, (job.fire_time(), seq, job))
+            elif job.retry_seq == seq:
+                heapq.heappush(self.heap, (fire_time, seq, job))
 
     def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
-    def start(self):
-        """Starts timer."""
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.daemon = True
-            self._timer.start()
-            self.is_running = True
+        while True:
+            with self.cond:
+                now = scheduler_clock()
+                self._account_suspend(now)
+                while self.heap and self.heap[0][1] not in (self.heap[0][2].seq,
+                                                            self.heap[0][2].retry_seq):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                fire_time, seq, job = self.heap[0]
+                if fire_time > now:
+                    # Wake up at least once a minute to notice suspends.
+                    self.cond.wait(min(fire_time - now, 60))
+                    continue
+                heapq.heappop(self.heap)
+                # A retry or a regular run supersedes a pending retry.
+                retry = seq == job.retry_seq
+                job.retry_seq = None
+                missed = False
+                if not retry:
+                    # Next deadline is counted from the previous one to avoid drift.
+                    missed = now - job.deadline > job.interval
+                    next_deadline = job.deadline + job.interval
+                    if missed:
+                        next_deadline = now + job.interval
+                    self.seq += 1
+                    job.seq = self.seq
+                    job.deadline = next_deadline
+                    heapq.heappush(self.heap, (job.fire_time(), self.seq, job))
+            if missed and job.late_policy == "skip":
+                if sp_logging.DEBUG:
+                    sp_logging.G_LOGGER.info("Skipping a missed run of %s", job.function)
+                continue
+            job.run(retry=retry)
+
+
+class ScheduledJobGroup():
+    """Controls several ScheduledJobs as one, e.g. per display slideshows."""
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    @property
+    def is_running(self):
+        """True if any of the jobs is scheduled."""
+        return any(job.is_running for job in self.jobs)
+
+    def start(self, delay=None):
+        for job in self.jobs:
+            job.start(delay)
 
     def stop(self):
-        """Stops timer."""
-        self._timer.cancel()
-        self.is_running = False
+        for job in self.jobs:
+            job.stop()
+
+    def pause(self):
+        for job in self.jobs:
+            job.pause()
+
+    def resume(self):
+        for job in self.jobs:
+            job.resume()
+
+
+def get_scheduler():
+    """Return the application wide SlideshowScheduler, starting it on first use."""
+    global G_SCHEDULER
+    with G_WALLPAPER_CHANGE_LOCK:
+        if G_SCHEDULER is None:
+            G_SCHEDULER = SlideshowScheduler()
+        return G_SCHEDULER
+
+
+class RenderCancelled(Exception):
+    """Raised at a render pipeline checkpoint once the job has been cancelled."""
+
+
+class RenderProgress():
+    """
+    Progress event of a running RenderJob.
+
+    stage       'load', 'display', 'compose' or 'set'
+    display     index of the display a 'display' stage finished, else None
+    completed   number of displays rendered so far
+    total       number of displays
+    """
+    def __init__(self, job, stage, display, completed, total):
+        self.job = job
+        self.stage = stage
+        self.display = display
+        self.completed = completed
+        self.total = total
+
+    def __str__(self):
+        return (
+            f"RenderProgress("
+            f"stage={self.stage!r}, "
+            f"display={self.display}, "
+            f"completed={self.completed}/{self.total}"
+            f")"
+        )
+
+    @property
+    def fraction(self):
+        """Estimated share of the render that is done, from 0 to 1."""
+        if self.stage == "set":
+            return 0.95
+        if self.stage == "compose":
+            return 0.9
+        if not self.total:
+            return 0.0
+        return 0.85 * min(self.completed, self.total) / self.total
+
+
+class RenderJob():
+    """
+    Handle to a queued or running wallpaper render.
+
+    Cancellation is cooperative: a queued job is dropped right away and
+    a running one stops at the next pipeline checkpoint. The pipeline
+    reports a RenderProgress at its checkpoints, see add_progress_callback.
+
+    A draft job renders with fast resampling and cheap encoding, see
+    render_is_draft. If a full quality pass follows the draft,
+    refine_pending is set and the wallpaper change is announced by the
+    refine instead, see refine_draft_job.
+    """
+    def __init__(self, func, profile, force=False, key="wallpaper", indices=None,
+                 background=False, draft=False):
+        self.func = func
+        self.profile = profile
+        self.force = force
+        self.key = key
+        self.indices = indices  # image lists to advance, None for all
+        self.background = background    # yields to other jobs, e.g. prerenders
+        self.draft = draft
+        self.refine_pending = False
+        self.deferred_since = None
+        self.state = "queued"   # queued / running / done / cancelled / failed
+        self.started = None
+        self.result = None
+        self.exception = None
+        self._cancel_requested = False
+        self._done_event = Event()
+        self._callbacks = []
+        self._progress_callbacks = []
+        self._displays_done = set()
+        self.progress = None
+        self._lock = Lock()
+
+    def __str__(self):
+        return (
+            f"RenderJob("
+            f"func={self.func.__name__}, "
+            f"profile={getattr(self.profile, 'name', None)!r}, "
+            f"key={self.key!r}, "
+            f"indices={self.indices}, "
+            f"draft={self.draft}, "
+            f"state={self.state!r}"
+            f")"
+        )
+
+    def cancel(self):
+        """Request cancellation of the job."""
+        self._cancel_requested = True
+
+    def merge_indices(self, other):
+        """Take over the image lists of a superseded job."""
+        if self.indices is None or other.indices is None:
+            self.indices = None
+        else:
+            self.indices = tuple(sorted(set(self.indices) | set(other.indices)))
+
+    def cancelled(self):
+        """Test if cancellation has been requested."""
+        return self._cancel_requested
+
+    def checkpoint(self):
+        """Stop the pipeline here if the job has been cancelled."""
+        if self._cancel_requested:
+            raise RenderCancelled(str(self))
+
+    def is_alive(self):
+        """Thread like test if job has not finished yet."""
+        return not self._done_event.is_set()
+
+    def done(self):
+        """Test if job has finished, in any way."""
+        return self._done_event.is_set()
+
+    def join(self, timeout=None):
+        """Thread like wait for the job to finish."""
+        return self._done_event.wait(timeout)
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish and return the render result."""
+        self._done_event.wait(timeout)
+        return self.result
+
+    def add_done_callback(self, callback):
+        """Call callback(job) once the job finishes, in the thread that finishes it."""
+        with self._lock:
+            if not self._done_event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def add_progress_callback(self, callback):
+        """Call callback(RenderProgress) at each stage, in the render thread.
+
+        Keep the callback short, e.g. hand the event over with wx.CallAfter.
+        """
+        with self._lock:
+            if not self._done_event.is_set():
+                self._progress_callbacks.append(callback)
+
+    def report_progress(self, stage, display=None):
+        """Publish a RenderProgress to the progress callbacks."""
+        with self._lock:
+            if display is not None:
+                self._displays_done.add(display)
+            self.progress = RenderProgress(self, stage, display,
+                                           len(self._displays_done), NUM_DISPLAYS)
+            callbacks = list(self._progress_callbacks)
+        for callback in callbacks:
+            try:
+                callback(self.progress)
+            except Exception:
+                sp_logging.G_LOGGER.exception("RenderJob progress callback failed.")
+
+    def _finish(self, state, result=None, exception=None):
+        with self._lock:
+            self.state = state
+            self.result = result
+            self.exception = exception
+            self._done_event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._progress_callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                sp_logging.G_LOGGER.exception("RenderJob done callback failed.")
+
+
+_RENDER_THREAD_STATE = local()
+
+
+def render_checkpoint():
+    """Cancellation checkpoint between render pipeline stages.
+
+    Does nothing when called outside of the render worker.
+    """
+    job = getattr(_RENDER_THREAD_STATE, "job", None)
+    if job is not None:
+        job.checkpoint()
+
+
+def render_is_draft():
+    """Test if the current render is the fast first pass of a progressive change."""
+    job = getattr(_RENDER_THREAD_STATE, "job", None)
+    return job is not None and job.draft
+
+
+def render_progress(stage, display=None, checkpoint=True):
+    """Report a finished render stage of the current job and checkpoint.
+
+    Stages past the point of no return, where a cancel would leave the
+    new output files behind, pass checkpoint=False.
+    Does nothing when called outside of the render worker.
+    """
+    job = getattr(_RENDER_THREAD_STATE, "job", None)
+    if job is not None:
+        job.report_progress(stage, display)
+        if checkpoint:
+            job.checkpoint()
+
+
+class RenderWorker():
+    """
+    Runs wallpaper renders one at a time on a dedicated thread.
+
+    Jobs are queued by key and a new job supersedes a queued or running
+    job with the same key, so only the latest request of e.g. a spammed
+    next wallpaper hotkey is rendered to completion. Jobs that advance only
+    some of the image lists, see RenderJob.indices, take over the lists of
+    the queued jobs they supersede and let a running job finish. The queue
+    is bounded: if it is full the oldest queued job is dropped.
+
+    Background jobs run only when no other job is queued, and a new
+    foreground job cancels a running background job. Under CPU pressure
+    background jobs wait, see governor.under_pressure. The worker thread
+    runs at a lowered priority.
+    """
+    def __init__(self, max_queued=4):
+        self.max_queued = max_queued
+        self.queue = []
+        self.running_job = None
+        self.cond = Condition()
+        self.thread = Thread(target=self._run, name="sp-render", daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        """Queue a RenderJob, superseding older jobs with the same key."""
+        with self.cond:
+            for old_job in [qjob for qjob in self.queue if qjob.key == job.key]:
+                self.queue.remove(old_job)
+                job.merge_indices(old_job)
+                old_job.cancel()
+                old_job._finish("cancelled")
+            if (self.running_job is not None and self.running_job.key == job.key
+                    and job.indices is None):
+                self.running_job.cancel()
+            if (self.running_job is not None and self.running_job.background
+                    and not job.background):
+                self.running_job.cancel()
+            while len(self.queue) >= self.max_queued:
+                background_jobs = [qjob for qjob in self.queue if qjob.background]
+                old_job = background_jobs[0] if background_jobs else self.queue[0]
+                self.queue.remove(old_job)
+                old_job.cancel()
+                old_job._finish("cancelled")
+            self.queue.append(job)
+            self.cond.notify()
+        return job
+
+    def _run(self):
+        governor.lower_thread_priority()
+        while True:
+            with self.cond:
+                while True:
+                    while not self.queue:
+                        self.cond.wait()
+                    foreground_jobs = [qjob for qjob in self.queue if not qjob.background]
+                    job = foreground_jobs[0] if foreground_jobs else self.queue[0]
+                    if not (job.background and self._defer(job)):
+                        break
+                    self.cond.wait(governor.PRESSURE_RETRY_DELAY)
+                self.queue.remove(job)
+                self.running_job = job
+            self._execute(job)
+            with self.cond:
+                self.running_job = None
+
+    @staticmethod
+    def _defer(job):
+        """Test if a background job should wait for the CPU pressure to ease."""
+        now = time.monotonic()
+        if job.deferred_since is None:
+            job.deferred_since = now
+        return (now - job.deferred_since < governor.PRESSURE_MAX_DEFER
+                and governor.under_pressure())
+
+    def _execute(self, job):
+        _RENDER_THREAD_STATE.job = job
+        job.state = "running"
+        job.started = time.perf_counter()
+        try:
+            job.checkpoint()
+            if job.indices is None:
+                result = job.func(job.profile, job.force)
+            else:
+                result = job.func(job.profile, job.force, indices=job.indices)
+            job._finish("done", result)
+        except RenderCancelled:
+            if sp_logging.DEBUG:
+                sp_logging.G_LOGGER.info("Render cancelled: %s", job)
+            job._finish("cancelled")
+        except governor.MemoryBudgetExceeded as excep:
+            sp_logging.G_LOGGER.info("Render failed: %s: %s", job, excep)
+            job._finish("failed", exception=excep)
+        except Exception as excep:
+            sp_logging.G_LOGGER.exception("Render failed: %s", job)
+            job._finish("failed", exception=excep)
+        finally:
+            _RENDER_THREAD_STATE.job = None
+
+
+def get_render_worker():
+    """Return the render worker, starting it on first use."""
+    global G_RENDER_WORKER
+    with G_WALLPAPER_CHANGE_LOCK:
+        if G_RENDER_WORKER is None:
+            G_RENDER_WORKER = RenderWorker()
+        return G_RENDER_WORKER
 
 
 class Display():
@@ -260,8 +854,12 @@ class DisplaySystem():
     in advanced mode.
     """
 
-    def __init__(self):
-        self.disp_list = get_display_data()
+    def __init__(self, disp_list=None):
+        """Set up the current displays, or the given Display list of another topology."""
+        if disp_list is None:
+            self.disp_list = get_display_data()
+        else:
+            self.disp_list = disp_list
         self.compute_ppinorm_resolutions()
 
         # Data
@@ -275,7 +873,7 @@ class DisplaySystem():
 
         # if user diags are not entered, tell about failed physical sizes
         global USER_TOLD_OF_PHYS_FAIL
-        if not self.use_user_diags:
+        if not self.use_user_diags and disp_list is None:
             for dsp in self.disp_list:
                 if dsp.phys_size_failed and not USER_TOLD_OF_PHYS_FAIL:
                     msg = ("Detection of the diagonal size of a display has failed. "
@@ -323,21 +921,7 @@ class DisplaySystem():
 
         A valid crop is a 4-tuple: (left, top, right, bottom).
         """
-        crops = []
-        for dsp in self.disp_list:
-            try:
-                off = manual_offsets[self.disp_list.index(dsp)]
-            except IndexError:
-                off = (0, 0)
-            left_top = (
-                round(dsp.ppi_norm_offset[0] + off[0]),
-                round(dsp.ppi_norm_offset[1] + off[1])
-            )
-            right_btm = (
-                round(dsp.ppi_norm_resolution[0]) + left_top[0],
-                round(dsp.ppi_norm_resolution[1]) + left_top[1],
-            )
-            crops.append(left_top + right_btm)
+        crops = renderer.DisplayLayout.from_display_system(self).ppi_norm_crops(manual_offsets)
         sp_logging.G_LOGGER.info("get_ppi_norm_offsets: %s", self.get_ppinorm_offsets())
         sp_logging.G_LOGGER.info("get_ppi_norm_crops: %s", crops)
         return crops
@@ -842,6 +1426,21 @@ def extract_global_vars(disp_list):
         off_arr.append(disp.digital_offset)
     return [res_arr, off_arr]
 
+def displays_from_monitors(monitors):
+    """Return the sorted Display list of monitors with non-negative offsets."""
+    display_list = []
+    for monitor in monitors:
+        display_list.append(Display(monitor))
+    # Check that there are no negative offsets and fix if any are found.
+    leftmost_offset = min([disp.digital_offset[0] for disp in display_list])
+    topmost_offset = min([disp.digital_offset[1] for disp in display_list])
+    if leftmost_offset < 0 or topmost_offset < 0:
+        for disp in display_list:
+            disp.translate_offset((leftmost_offset, topmost_offset))
+    # sort display list by digital offsets
+    display_list.sort(key=lambda x: x.digital_offset)
+    return display_list
+
 def get_display_data():
     """
     Updates global display variables: number of displays, resolutions and offsets.
@@ -859,17 +1458,7 @@ def get_display_data():
         sp_logging.G_LOGGER.info("Had to re-query for display data.")
     NUM_DISPLAYS = len(monitors)
 
-    display_list = []
-    for monitor in monitors:
-        display_list.append(Display(monitor))
-    # Check that there are no negative offsets and fix if any are found.
-    leftmost_offset = min([disp.digital_offset[0] for disp in display_list])
-    topmost_offset = min([disp.digital_offset[1] for disp in display_list])
-    if leftmost_offset < 0 or topmost_offset < 0:
-        for disp in display_list:
-            disp.translate_offset((leftmost_offset, topmost_offset))
-    # sort display list by digital offsets
-    display_list.sort(key=lambda x: x.digital_offset)
+    display_list = displays_from_monitors(monitors)
     # extract global variables for legacy compatibility
     RESOLUTION_ARRAY, DISPLAY_OFFSET_ARRAY = extract_global_vars(display_list)
     
@@ -886,28 +1475,9 @@ def get_display_data():
 
 def refresh_display_data():
     global G_ACTIVE_DISPLAYSYSTEM
-    G_ACTIVE_DISPLAYSYSTEM = DisplaySystem()
-
-def compute_canvas(res_array, offset_array):
-    """Computes the size of the total desktop area from monitor resolutions and offsets."""
-    # Take the subtractions of right-most right - left-most left
-    # and bottom-most bottom - top-most top (=0).
-    leftmost = 0
-    topmost = 0
-    right_edges = []
-    bottom_edges = []
-    for res, off in zip(res_array, offset_array):
-        right_edges.append(off[0]+res[0])
-        bottom_edges.append(off[1]+res[1])
-    # Right-most edge.
-    rightmost = max(right_edges)
-    # Bottom-most edge.
-    bottommost = max(bottom_edges)
-    canvas_size = [rightmost - leftmost, bottommost - topmost]
-    if sp_logging.DEBUG:
-        sp_logging.G_LOGGER.info("Canvas size: %s", canvas_size)
-    return canvas_size
-
+    with G_DISPLAY_DATA_LOCK:
+        G_ACTIVE_DISPLAYSYSTEM = DisplaySystem()
+        remember_topology(G_ACTIVE_DISPLAYSYSTEM.disp_list)
 
 def compute_ppi_corrected_res_array(res_array, ppi_list_rel_density):
     """Return ppi density normalized sizes of the real resolutions."""
@@ -1098,18 +1668,15 @@ def translate_crops(crop_tuples, translate_tuple):
     return crop_tuples_translated
 
 
-def compute_working_canvas(crop_tuples):
-    """Computes effective size of the desktop are taking into account PPI/offsets/bezels."""
-    # Take the subtractions of right-most right - left-most left
-    # and bottom-most bottom - top-most top (=0).
-    leftmost = 0
-    topmost = 0
-    # Right-most edge of the crop tuples.
-    rightmost = max(crop_tuples, key=itemgetter(2))[2]
-    # Bottom-most edge of the crop tuples.
-    bottommost = max(crop_tuples, key=itemgetter(3))[3]
-    canvas_size = [rightmost - leftmost, bottommost - topmost]
-    return canvas_size
+def write_new_file(fname):
+    """Remove fname so that it is written to a new file instead of in place.
+
+    The wallpaper history may hold a hard link to an earlier file of the
+    same name, which must not change.
+    """
+    if os.path.exists(fname):
+        os.remove(fname)
+
 
 def alternating_outputfile(prof_name):
     """Return alternating output filename and old filename.
@@ -1131,215 +1698,260 @@ def alternating_outputfile(prof_name):
         outputfile_old = os.path.join(TEMP_PATH, prof_name + "-b." + ftype)
     return (outputfile, outputfile_old)
 
+class PieceSet():
+    """
+    Per display pieces of the latest wallpaper of a profile.
+
+    Each piece is kept with the source file it was rendered from so that
+    a render can reuse the pieces of the displays whose image did not
+    change. Pieces changed since the wallpaper was last set are dirty.
+    For piecewise setters the pieces are saved to per display files that
+    alternate between -a and -b names like the composed images do.
+
+    Pieces of a draft render are reused only by other drafts, so that the
+    full quality pass renders them again.
+
+    A PieceSet is the sink of the renderer pipelines in the render worker.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.sources = {}
+        self.images = {}
+        self.files = {}
+        self.dirty = set()
+        self.drafts = set()
+        self.frame_files = None     # source files of the wallpaper last set
+        self.old_files = []
+
+    def get(self, index, source):
+        """Return the piece of display index if it was rendered from source."""
+        if (self.sources.get(index) == source
+                and (index not in self.drafts or render_is_draft())):
+            return self.images[index]
+        return None
+
+    def put(self, index, source, img):
+        self.sources[index] = source
+        self.images[index] = img
+        self.dirty.add(index)
+        if render_is_draft():
+            self.drafts.add(index)
+        else:
+            self.drafts.discard(index)
+
+    def fill_missing(self, layout):
+        """Give displays of layout that have no piece a black one.
+
+        A display has no piece e.g. if its source failed to open. The
+        piece files are handed out as a list indexed by display, so every
+        display needs one.
+        """
+        for index, res in enumerate(layout.resolutions):
+            if index not in self.images:
+                self.sources[index] = None
+                self.images[index] = Image.new("RGB", res, color=0)
+                self.dirty.add(index)
+                self.drafts.discard(index)
+
+    def save_files(self, prof_name):
+        """Save the dirty pieces to new files and return the files of all pieces."""
+        for index in sorted(self.dirty):
+            name_a = os.path.join(TEMP_PATH, "{}-a-crop-{}.png".format(prof_name, index))
+            name_b = os.path.join(TEMP_PATH, "{}-b-crop-{}.png".format(prof_name, index))
+            previous = self.files.get(index)
+            if previous == name_a or (previous is None and os.path.isfile(name_a)):
+                fname, old_fname = name_b, name_a
+            else:
+                fname, old_fname = name_a, name_b
+            write_new_file(fname)
+            if render_is_draft():
+                self.images[index].save(fname, "PNG", compress_level=1)
+            else:
+                self.images[index].save(fname, "PNG")
+            self.files[index] = fname
+            self.old_files.append(old_fname)
+        return [self.files[index] for index in sorted(self.files)]
+
+    def progress(self, stage, display=None):
+        render_progress(stage, display)
+
+    def checkpoint(self):
+        render_checkpoint()
+
+    def mark_set(self):
+        """Pieces have been set as the wallpaper, delete replaced piece files."""
+        self.dirty.clear()
+        for fname in self.old_files:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        self.old_files = []
+
+
+def current_layout():
+    """Return a DisplayLayout snapshot of the displays the current render targets.
+
+    Renders of a topology variant target the layout of the variant.
+    """
+    layout = getattr(_RENDER_THREAD_STATE, "layout", None)
+    if layout is not None:
+        return layout
+    with G_DISPLAY_DATA_LOCK:
+        if G_ACTIVE_DISPLAYSYSTEM is None:
+            return renderer.DisplayLayout.from_resolutions(RESOLUTION_ARRAY,
+                                                           DISPLAY_OFFSET_ARRAY)
+        return renderer.DisplayLayout.from_display_system(G_ACTIVE_DISPLAYSYSTEM,
+                                                          RESOLUTION_ARRAY,
+                                                          DISPLAY_OFFSET_ARRAY)
+
+
+def render_options(profile):
+    """Return the RenderOptions of profile for the current render."""
+    return renderer.RenderOptions(profile.spanmode, profile.ppimode, profile.perspective,
+                                  profile.spangroups, profile.manual_offsets,
+                                  render_is_draft())
+
+
+def piece_layout(profile, layout=None):
+    """Everything besides the source image that the pieces of profile depend on."""
+    if layout is None:
+        layout = current_layout()
+    return (profile.spanmode, profile.ppimode, profile.perspective,
+            str(profile.spangroups), tuple(profile.manual_offsets), layout)
+
+
+def get_piece_set(profile, layout=None):
+    """Return the PieceSet of profile, a new one if its layout changed.
+
+    Renders of a topology variant use the PieceSet of the variant. The
+    sets of warm profiles are not counted in G_PIECE_SETS_MAX.
+    """
+    layout = piece_layout(profile, layout)
+    variant = getattr(_RENDER_THREAD_STATE, "variant", None)
+    if variant is not None:
+        if variant.pieces is None or variant.pieces.layout != layout:
+            variant.pieces = PieceSet(layout)
+        return variant.pieces
+    pieces = G_PIECE_SETS.pop(profile.name, None)
+    if pieces is None or pieces.layout != layout:
+        pieces = PieceSet(layout)
+    G_PIECE_SETS[profile.name] = pieces
+    warm_names = set(prof.name for prof in G_WARM_PROFILES)
+    unpinned = [name for name in G_PIECE_SETS if name not in warm_names]
+    for name in unpinned[:max(0, len(unpinned) - G_PIECE_SETS_MAX)]:
+        del G_PIECE_SETS[name]
+    return pieces
+
+
+def needs_canvas():
+    """Test if the composed wallpaper image is needed, or if pieces are enough."""
+    return (not use_image_pieces()
+            or G_SET_COMMAND_STRING != ""
+            or os.path.isfile(LEGACY_SCRIPT))
+
+
+def set_pieces_wallpaper(profile, force, files, pieces, layout=None):
+    """Compose the wallpaper of a PieceSet on layout and set it.
+
+    Only dirty pieces are saved and handed to piecewise setters, and if
+    no piece changed the wallpaper is not set again unless forced. The
+    full canvas is composed only if it is needed, see needs_canvas.
+
+    Renders of a topology variant stop here, the pieces are kept by the
+    variant until its topology shows up.
+    """
+    if getattr(_RENDER_THREAD_STATE, "variant", None) is not None:
+        return 0
+    if not pieces.dirty and not force:
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("No display image changed, wallpaper not set.")
+        return 0
+    outputfile = outputfile_old = None
+    if layout is None:
+        layout = current_layout()
+    if needs_canvas():
+        combined_image = renderer.compose_canvas(pieces.images, layout)
+        outputfile, outputfile_old = alternating_outputfile(profile.name)
+        write_new_file(outputfile)
+        combined_image.save(outputfile, **renderer.canvas_save_options(outputfile, layout,
+                                                                       render_is_draft()))
+        # The new file has to be set, or the next alternating_outputfile
+        # could overwrite the file that is up.
+        render_progress("compose", checkpoint=False)
+    if profile.name == G_ACTIVE_PROFILE or force:
+        render_progress("set", checkpoint=False)
+        job = getattr(_RENDER_THREAD_STATE, "job", None)
+        if job is not None and not pieces.drafts:
+            # every piece was reused at full quality, there is nothing to refine
+            job.refine_pending = False
+        if use_image_pieces():
+            pieces.fill_missing(layout)
+            changed = None if force else sorted(pieces.dirty)
+            piece_files = pieces.save_files(profile.name)
+            set_wallpaper(outputfile, force, files, piece_files=piece_files, changed=changed)
+        else:
+            set_wallpaper(outputfile, force, files)
+        pieces.mark_set()
+        pieces.frame_files = list(files)
+        if profile.name == G_ACTIVE_PROFILE:
+            frame_shown(profile, files, prerender=not render_is_draft())
+    if outputfile_old and os.path.exists(outputfile_old):
+        os.remove(outputfile_old)
+    return 0
+
+
+def render_profile(profile, files, force, render_func):
+    """Render files into the PieceSet of profile with a renderer pipeline and set it.
+
+    The render works on a snapshot of the displays, see current_layout.
+    """
+    layout = current_layout()
+    pieces = get_piece_set(profile, layout)
+    render_func(files, layout, render_options(profile), pieces)
+    return set_pieces_wallpaper(profile, force, files, pieces, layout)
+
+
 def span_single_image_simple(profile, force):
     """
     Spans a single image across all monitors. No corrections.
 
-    This simple method resizes the source image so it fills the whole
-    desktop canvas. Since no corrections are applied, no offset dependent
-    cuts are needed and so this should work on any monitor arrangement.
+    See renderer.render_simple.
     """
     file = profile.next_wallpaper_files()[0]
     if sp_logging.DEBUG:
         sp_logging.G_LOGGER.info(file)
-    try:
-        img = Image.open(file)
-        img = ImageOps.exif_transpose(img)
-    except UnidentifiedImageError:
-        sp_logging.G_LOGGER.info(("Opening image '%s' failed with PIL.UnidentifiedImageError."
-                                  "It could be corrupted or is of foreign type."), file)
-    canvas_tuple = tuple(compute_canvas(RESOLUTION_ARRAY, DISPLAY_OFFSET_ARRAY))
-    img_resize = resize_to_fill(img, canvas_tuple)
-
-    outputfile, outputfile_old = alternating_outputfile(profile.name)
-    img_resize.save(outputfile, quality=95) # set quality if jpg is used, png unaffected
-    if profile.name == G_ACTIVE_PROFILE or force:
-        set_wallpaper(outputfile, force, [file])
-    if os.path.exists(outputfile_old):
-        os.remove(outputfile_old)
-    return 0
+    return render_profile(profile, [file], force, renderer.render_simple)
 
-def group_persp_data(persp_dat, groups):
-    """Rerturn list of grouped perspective data objects."""
-    if not persp_dat:
-        return [None] * len(groups)
-    group_persp_data_list = []
-    for grp in groups:
-        group_data = {
-            "central_disp": persp_dat["central_disp"],
-            "viewer_pos": persp_dat["viewer_pos"],
-            "swivels": [persp_dat["swivels"][index] for index in grp],
-            "tilts": [persp_dat["tilts"][index] for index in grp]
-        }
-        group_persp_data_list.append(group_data)
-    return group_persp_data_list
 
-def translate_to_group_coordinates(group_crop_list):
-    """Translates lists of group crops into groups internal coordinates."""
-    if len(group_crop_list) == 1:
-        return group_crop_list
-    else:
-        group_crop_list_transl = []
-        for grp_crops in group_crop_list:
-            left_anch = min([crp[0] for crp in grp_crops])
-            top_anch = min([crp[1] for crp in grp_crops])
-            transl_crops = []
-            for crp in grp_crops:
-                transl_crops.append(
-                    (crp[0] - left_anch,
-                     crp[1] - top_anch,
-                     crp[2] - left_anch,
-                     crp[3] - top_anch)
-                )
-            group_crop_list_transl.append(transl_crops)
-        return group_crop_list_transl
-
-# Take pixel densities of displays into account to have the image match
-# physically between displays.
-def span_single_image_advanced(profile, force):
+def span_single_image_advanced(profile, force, indices=None):
     """
     Applies wallpaper using PPI, bezel, offset corrections.
 
-    Further description todo.
+    Each span group gets its own image. If indices is given only those
+    groups get a new image, and groups whose image did not change reuse
+    their previous display pieces. See renderer.render_advanced.
     """
-    files = profile.next_wallpaper_files()
+    files = profile.next_wallpaper_files(indices=indices)
     if sp_logging.DEBUG:
         sp_logging.G_LOGGER.info(files)
-    try:
-        img_list = [Image.open(fil) for fil in files]
-        img_list = [ImageOps.exif_transpose(img) for img in img_list]
-    except UnidentifiedImageError:
-        sp_logging.G_LOGGER.info(("Opening image '%s' failed with PIL.UnidentifiedImageError."
-                                  "It could be corrupted or is of foreign type."), files)
-
-    # Cropping now sections of the image to be shown, USE EFFECTIVE WORKING
-    # SIZES. Also EFFECTIVE SIZE Offsets are now required.
-    manual_offsets = profile.manual_offsets
-    cropped_images = {}
-    crop_tuples = G_ACTIVE_DISPLAYSYSTEM.get_ppi_norm_crops(manual_offsets)
-    sp_logging.G_LOGGER.info("G_A_DSYS.use_perspective: %s, prof.perspective: %s",
-                             G_ACTIVE_DISPLAYSYSTEM.use_perspective,
-                             profile.perspective)
-    persp_dat = None
-    if G_ACTIVE_DISPLAYSYSTEM.use_perspective:
-        persp_dat = G_ACTIVE_DISPLAYSYSTEM.get_persp_data(profile.perspective)
-
-    if profile.spangroups:
-        spangroups = profile.spangroups
-    else:
-        spangroups = [list(range(NUM_DISPLAYS))]
-
-    grp_crop_tuples = translate_to_group_coordinates(
-        [[crop_tuples[index] for index in grp] for grp in spangroups])
-    grp_res_array = [[RESOLUTION_ARRAY[index] for index in grp] for grp in spangroups]
-    grp_persp_dat = group_persp_data(persp_dat, spangroups)
-
-    for img, grp, grp_p_dat, grp_crops, grp_res_arr in zip(img_list,
-                                                           spangroups,
-                                                           grp_persp_dat,
-                                                           grp_crop_tuples,
-                                                           grp_res_array):
-        if persp_dat:
-            proj_plane_crops, persp_coeffs = persp.get_backprojected_display_system(grp_crops,
-                                                                                    grp_p_dat)
-            # Canvas containing back-projected displays
-            canvas_tuple_proj = tuple(compute_working_canvas(proj_plane_crops))
-            # Canvas containing ppi normalized displays
-            canvas_tuple_trgt = tuple(compute_working_canvas(grp_crops))
-            sp_logging.G_LOGGER.info("Back-projected canvas size: %s", canvas_tuple_proj)
-            img_workingsize = resize_to_fill(img, canvas_tuple_proj)
-            for crop_tup, coeffs, ppin_crop, (i_res, res) in zip(proj_plane_crops,
-                                                                 persp_coeffs,
-                                                                 grp_crops,
-                                                                 enumerate(grp_res_arr)):
-                # Whole image needs to be transformed for each display separately
-                # since the coeffs live between the full back-projected plane
-                # containing all displays and the full 'target' working canvas
-                # size canvas_tuple_trgt containing ppi normalized displays.
-                persp_crop = img_workingsize.transform(canvas_tuple_trgt,
-                                                       Image.PERSPECTIVE, coeffs,
-                                                       Image.BICUBIC)
-                ## persp_crop.save(str(canvas_tuple_trgt)+str(crop_tup), "PNG")
-                # Crop desired region from transformed image which is now in
-                # ppi normalized resolution
-                crop_img = persp_crop.crop(ppin_crop)
-                # Resize correct crop to actual display resolution
-                crop_img = crop_img.resize(res, resample=Image.LANCZOS)
-                # cropped_images.append(crop_img) #old
-                cropped_images[grp[i_res]] = crop_img
-        else:
-            # larger working size needed to fill all the normalized lower density
-            # displays. Takes account manual offsets that might require extra space.
-            canvas_tuple_eff = tuple(compute_working_canvas(grp_crops))
-            # Image is now the height of the eff tallest display + possible manual
-            # offsets and the width of the combined eff widths + possible manual
-            # offsets.
-            img_workingsize = resize_to_fill(img, canvas_tuple_eff)
-            # Simultaneously make crops at working size and then resize down to actual
-            # resolution from RESOLUTION_ARRAY as needed.
-            for crop_tup, (i_res, res) in zip(grp_crops, enumerate(grp_res_arr)):
-                crop_img = img_workingsize.crop(crop_tup)
-                if crop_img.size == res:
-                    # cropped_images.append(crop_img)
-                    cropped_images[grp[i_res]] = crop_img
-                else:
-                    crop_img = crop_img.resize(res, resample=Image.LANCZOS)
-                    # cropped_images.append(crop_img)
-                    cropped_images[grp[i_res]] = crop_img
-    # Combine crops to a single canvas of the size of the actual desktop
-    # actual combined size of the display resolutions
-    canvas_tuple_fin = tuple(compute_canvas(RESOLUTION_ARRAY, DISPLAY_OFFSET_ARRAY))
-    combined_image = Image.new("RGB", canvas_tuple_fin, color=0)
-    combined_image.load()
-    # for i in range(len(cropped_images)):
-        # combined_image.paste(cropped_images[i], DISPLAY_OFFSET_ARRAY[i])
-    for crp_id in cropped_images:
-        combined_image.paste(cropped_images[crp_id], DISPLAY_OFFSET_ARRAY[crp_id])
-
-    # Saving combined image
-    outputfile, outputfile_old = alternating_outputfile(profile.name)
-    combined_image.save(outputfile, quality=95) # set quality if jpg is used, png unaffected
-    if profile.name == G_ACTIVE_PROFILE or force:
-        set_wallpaper(outputfile, force, files)
-    if os.path.exists(outputfile_old):
-        os.remove(outputfile_old)
-    return 0
+    return render_profile(profile, files, force, renderer.render_advanced)
 
 
-def set_multi_image_wallpaper(profile, force):
+def set_multi_image_wallpaper(profile, force, indices=None):
     """Sets a distinct image on each monitor.
 
     Since most platforms only support setting a single image
     as the wallpaper this has to be accomplished by creating a
     composite image based on the monitor offsets and then setting
     the resulting image as the wallpaper.
+
+    If indices is given only those displays get a new image. Displays
+    whose image did not change reuse their previous piece. See
+    renderer.render_multi.
     """
-    files = profile.next_wallpaper_files()
+    files = profile.next_wallpaper_files(indices=indices)
     if sp_logging.DEBUG:
         sp_logging.G_LOGGER.info(str(files))
-    img_resized = []
-    for file, res in zip(files, RESOLUTION_ARRAY):
-        # image = Image.open(file)
-        try:
-            image = Image.open(file)
-            image = ImageOps.exif_transpose(image)
-        except UnidentifiedImageError:
-            sp_logging.G_LOGGER.info(("Opening image '%s' failed with PIL.UnidentifiedImageError."
-                                      "It could be corrupted or is of foreign type."), file)
-        img_resized.append(resize_to_fill(image, res))
-    canvas_tuple = tuple(compute_canvas(RESOLUTION_ARRAY, DISPLAY_OFFSET_ARRAY))
-    combined_image = Image.new("RGB", canvas_tuple, color=0)
-    combined_image.load()
-    for i in range(len(files)):
-        combined_image.paste(img_resized[i], DISPLAY_OFFSET_ARRAY[i])
-
-    outputfile, outputfile_old = alternating_outputfile(profile.name)
-    combined_image.save(outputfile, quality=95) # set quality if jpg is used, png unaffected
-    if profile.name == G_ACTIVE_PROFILE or force:
-        set_wallpaper(outputfile, force, files)
-    if os.path.exists(outputfile_old):
-        os.remove(outputfile_old)
-    return 0
+    return render_profile(profile, files, force, renderer.render_multi)
 
 
 # def errcheck(result, func, args):
@@ -1347,15 +1959,24 @@ def set_multi_image_wallpaper(profile, force):
 #     if not result:
 #         raise ctypes.WinError(ctypes.get_last_error())
 
-def set_wallpaper(outputfile, force=False, source_files=None):
+def set_wallpaper(outputfile, force=False, source_files=None, piece_files=None, changed=None):
     """
     Master method to set the composed image as wallpaper.
 
     After the final background image is created, this method
     is called to communicate with the host system to set the
     desktop background. For Linux hosts there is a separate method.
+
+    On systems that set the wallpaper piecewise, existing per display
+    piece_files can be given, in which case outputfile may be None.
+    changed lists the displays whose piece changed, None for all.
+
+    Once the wallpaper is set, it is recorded in the history and the
+    post change hooks are started.
     """
     pltform = platform.system()
+    set_start = time.perf_counter()
+    pieces = None
     if pltform == "Windows":
         set_wallpaper_win(outputfile)
     # Old wallpaper setting code with no transition
@@ -1380,7 +2001,7 @@ def set_wallpaper(outputfile, force=False, source_files=None):
 #             sp_logging.G_LOGGER.info("SystemParametersInfo wallpaper set failed with \
 # spi_success: '%s'", spi_success)
     elif pltform == "Linux":
-        set_wallpaper_linux(outputfile, force)
+        pieces = set_wallpaper_linux(outputfile, force, piece_files, changed)
     elif pltform == "Darwin":
         # script = """/usr/bin/osascript<<END
         #             tell application "Finder"
@@ -1388,17 +2009,49 @@ def set_wallpaper(outputfile, force=False, source_files=None):
         #             end tell
         #             END"""
         # subprocess.Popen(script % outputfile, shell=True)
-        set_wallpaper_macos(outputfile, image_piece_list=None, force=force)
+        if piece_files is not None:
+            pieces = set_wallpaper_macos(None, image_piece_list=piece_files)
+        else:
+            pieces = set_wallpaper_macos(outputfile, image_piece_list=None, force=force)
     else:
         sp_logging.G_LOGGER.info("Unknown platform.system(): %s", pltform)
-    script_file = os.path.join(CONFIG_PATH, "run-after-wp-change.py")
-    if os.path.isfile(script_file):
-        subprocess.run(["python3",
-                        script_file,
-                        outputfile,
-                        source_files])
+    timings = {"set": time.perf_counter() - set_start}
+    job = getattr(_RENDER_THREAD_STATE, "job", None)
+    if job is not None and job.started:
+        timings["render"] = set_start - job.started
+    if job is not None and job.refine_pending:
+        # hooks get the full quality wallpaper of a progressive change
+        return 0
+    if job is not None:
+        profname = job.profile.name
+    else:
+        profname = os.path.splitext(os.path.basename(outputfile or piece_files[0]))[0][:-2]
+    if job is not None and job.func is not apply_history_entry:
+        history.get_history().record(outputfile, source_files, piece_files, profname)
+    run_hooks(WallpaperChangeEvent(outputfile, source_files, pieces, profname, timings))
     return 0
 
+def apply_history_entry(entry, force=True):
+    """Set the stored files of a HistoryEntry as the wallpaper, without rendering."""
+    render_progress("set")
+    if use_image_pieces() and entry.pieces:
+        set_wallpaper(entry.outputfile, True, entry.sources, piece_files=entry.pieces)
+    elif entry.outputfile:
+        set_wallpaper(entry.outputfile, True, entry.sources)
+    else:
+        sp_logging.G_LOGGER.info("%s has no files the current wallpaper setter can use.", entry)
+        return 0
+    # Displays now show the history pieces, so the next render sets all of them.
+    for pieces in G_PIECE_SETS.values():
+        pieces.dirty = set(pieces.images)
+    return 0
+
+
+def show_history_entry(entry):
+    """Queue setting a HistoryEntry as the wallpaper and return the RenderJob."""
+    return get_render_worker().submit(RenderJob(apply_history_entry, entry, True))
+
+
 def set_wallpaper_macos(outputfile, image_piece_list = None, force = False):
     """
     MacOS has a separate desktop for each screen, each of which has their own
@@ -1452,92 +2105,50 @@ def set_wallpaper_macos(outputfile, image_piece_list = None, force = False):
     # Delete old images after new ones are set
     if outputfile:
         remove_old_temp_files(outputfile)
+    return img_names
 
 
-def set_wallpaper_linux(outputfile, force=False):
+def set_wallpaper_linux(outputfile, force=False, piece_files=None, changed=None):
     """
     Wallpaper setter for Linux hosts.
 
-    Functionality is based on the DESKTOP_SESSION environment variable,
-    if it is not set, like often on window managers such as i3, the default
+    The desktop is detected once from the DESKTOP_SESSION environment
+    variable and the matching backend of wallpaper_setters is used, if it
+    is not set, like often on window managers such as i3, the default
     behavior is to attempt to use feh as the communication layer with the
-    desktop.
+    desktop. A user given 'set_command' is run in addition.
 
-    On systems where the variable is set, a native way of setting the
-    wallpaper can be used. These are DE specific.
+    Backends that set the wallpaper display by display get the image
+    cut into per display pieces, which are returned, unless existing
+    piece_files are given. Then only the changed displays are updated.
     """
-    file = "file://" + outputfile
     set_command = G_SET_COMMAND_STRING
     if sp_logging.DEBUG:
-        sp_logging.G_LOGGER.info(file)
-
-    desk_env = os.environ.get("DESKTOP_SESSION")
-    if sp_logging.DEBUG:
-        sp_logging.G_LOGGER.info("DESKTOP_SESSION is: '%s'", desk_env)
-
-    if set_command != "":
-        if set_command == "feh":
-            sp_logging.G_LOGGER.info("Using 'feh' command mode!")
-            subprocess.run(["feh", "--bg-scale", "--no-xinerama", outputfile])
-        else:
-            command_string_list = set_command.split()
-            formatted_command = []
-            for term in command_string_list:
-                formatted_command.append(term.format(image=outputfile))
-            sp_logging.G_LOGGER.info("Formatted custom command is: '%s'", formatted_command)
-            subprocess.run(formatted_command)
-    if desk_env:
-        if desk_env in ["gnome", "gnome-wayland", "gnome-xorg",
-                          "unity", "ubuntu",
-                          "pantheon", "budgie-desktop",
-                          "pop"]:
-            subprocess.run(["/usr/bin/gsettings", "set",
-                            "org.gnome.desktop.background", "picture-uri-dark",
-                            file])
-            subprocess.run(["/usr/bin/gsettings", "set",
-                            "org.gnome.desktop.background", "picture-uri",
-                            file])
-        elif desk_env in ["cinnamon"] or "cinnamon" in desk_env.lower():
-            subprocess.run(["/usr/bin/gsettings", "set",
-                            "org.cinnamon.desktop.background", "picture-uri",
-                            file])
-        elif desk_env in ["mate"]:
-            subprocess.run(["/usr/bin/gsettings",
-                            "set",
-                            "org.mate.background",
-                            "picture-filename",
-                            outputfile])
-        elif desk_env in ["xfce", "xubuntu", "ubuntustudio"]:
-            xfce_actions(outputfile)
-        elif desk_env.lower() == "lubuntu" or "lxqt" in desk_env.lower():
-            try:
-                subprocess.run(["pcmanfm", "-w", outputfile])
-            except OSError:
-                try:
-                    subprocess.run(["pcmanfm-qt", "-w", outputfile])
-                except OSError:
-                    sp_logging.G_LOGGER.info("Exception: failure to find either command \
-'pcmanfm' or 'pcmanfm-qt'. Exiting.")
-                    sys.exit(1)
-        # elif desk_env in ["/usr/share/xsessions/plasma", "plasma"]:
-        elif running_kde():
-            kdeplasma_actions(outputfile, force)
-        elif "i3" in desk_env or desk_env in ["/usr/share/xsessions/bspwm"]:
-            subprocess.run(["feh", "--bg-scale", "--no-xinerama", outputfile])
-        else:
-            if set_command == "":
-                message = "Your DE could not be detected to set the wallpaper. \
+        sp_logging.G_LOGGER.info("Setting wallpaper: %s", outputfile or piece_files)
+
+    if set_command != "" and outputfile:
+        run_set_command(set_command, outputfile)
+    backend = get_backend()
+    if backend.piecewise and piece_files is not None:
+        backend.set_pieces(piece_files, display_names(), changed)
+        return piece_files
+    elif backend.piecewise:
+        profname = os.path.splitext(os.path.basename(outputfile))[0][:-2]
+        img_names = special_image_cropper(outputfile)
+        if profname == G_ACTIVE_PROFILE or force:
+            backend.set_pieces(img_names, display_names())
+        # Delete old images after new ones are set
+        remove_old_temp_files(outputfile)
+        return img_names
+    elif backend.name == "none" and set_command == "":
+        message = "Your DE could not be detected to set the wallpaper. \
 You need to set the 'set_command' option in your \
-settings file superpaper/general_settings. Exiting."
-                sp_logging.G_LOGGER.info(message)
-                show_message_dialog(message, "Error")
-                sys.exit(1)
-            else:
-                os.system(set_command.format(image=outputfile))
+settings file superpaper/general_settings."
+        sp_logging.G_LOGGER.info(message)
+        show_message_dialog(message, "Error")
     else:
-        sp_logging.G_LOGGER.info("DESKTOP_SESSION variable is empty, \
-attempting to use feh to set the wallpaper.")
-        subprocess.run(["feh", "--bg-scale", "--no-xinerama", outputfile])
+        backend.set_wallpaper(outputfile)
+    return None
 
 def set_wallpaper_piecewise(image_piece_list):
     """
@@ -1549,15 +2160,13 @@ def set_wallpaper_piecewise(image_piece_list):
     see quick_profile_job method, to improve performance on these
     systems.
 
-    Currently supported such systems are KDE Plasma and XFCE.
+    Currently supported such systems are KDE Plasma, XFCE and MacOS.
     """
     pltform = platform.system()
     if pltform == "Linux":
-        if running_kde():
-            kdeplasma_actions(None, image_piece_list)
-        # desk_env = os.environ.get("DESKTOP_SESSION")
-        # elif desk_env in ["xfce", "xubuntu", "ubuntustudio"]:
-            # xfce_actions(None, image_piece_list)
+        backend = get_backend()
+        if backend.piecewise:
+            backend.set_pieces(image_piece_list, display_names())
     elif pltform == "Darwin":
         set_wallpaper_macos(None, image_piece_list=image_piece_list)
     else:
@@ -1565,6 +2174,13 @@ def set_wallpaper_piecewise(image_piece_list):
     return 0
 
 
+def display_names():
+    """Return the names of the displays in the order of the image pieces, if known."""
+    if G_ACTIVE_DISPLAYSYSTEM is None:
+        return None
+    return [disp.name for disp in G_ACTIVE_DISPLAYSYSTEM.disp_list]
+
+
 def special_image_cropper(outputfile):
     """
     Crops input image into monitor specific pieces based on display offsets.
@@ -1625,158 +2241,101 @@ def remove_old_temp_files(outputfile):
                 # print(temp_file)
                 os.remove(os.path.join(TEMP_PATH, temp_file))
 
-def kdeplasma_actions(outputfile, image_piece_list = None, force=False):
-    """
-    Sets the multi monitor wallpaper on KDE.
 
-    Arguments are path to an image and an optional image piece
-    list when one can set the wallpaper from existing cropped
-    images. IF image pieces are to be used, call this method
-    with outputfile == None.
+def wallpaper_setter(profile):
+    """Return the render function for the spanmode of profile, None if unknown."""
+    if profile.spanmode.startswith("single") and profile.ppimode is False:
+        return span_single_image_simple
+    if ((profile.spanmode.startswith("single") and profile.ppimode is True) or
+            profile.spanmode.startswith("advanced")):
+        return span_single_image_advanced
+    if profile.spanmode.startswith("multi"):
+        return set_multi_image_wallpaper
+    sp_logging.G_LOGGER.info("Unkown profile spanmode: %s", profile.spanmode)
+    return None
 
-    This is needed since KDE uses its own scripting language to
-    set the desktop background which sets a single image on every
-    monitor. This means that the composed image must be cut into
-    correct pieces that then are set to their respective displays.
-    """
 
-    script = """
-// make an array of all desktops with a valid screen
-var desktopArray = [];
-for(var desktopIndex in desktops()) {{
-    var desktop = desktops()[desktopIndex];
-    if(desktop.screen != -1) {{
-        desktopArray.push(desktop);
-    }}
-}}
-
-// sort the array based on the (vertical) desktop position
-var i = 1;
-while(i < desktopArray.length) {{
-    var j = i;
-    while(j > 0 && screenGeometry(desktopArray[j-1].screen).top > screenGeometry(desktopArray[j].screen).top) {{
-        var temp = desktopArray[j];
-        desktopArray[j] = desktopArray[j-1];
-        desktopArray[j-1] = temp;
-        j = j-1;
-    }}
-    i = i+1;
-}}
-
-// sort the array based on the (horizontal) desktop position
-var i = 1;
-while(i < desktopArray.length) {{
-    var j = i;
-    while(j > 0 && screenGeometry(desktopArray[j-1].screen).left > screenGeometry(desktopArray[j].screen).left) {{
-        var temp = desktopArray[j];
-        desktopArray[j] = desktopArray[j-1];
-        desktopArray[j-1] = temp;
-        j = j-1;
-    }}
-    i = i+1;
-}}
-
-var imageFileArray = Array({imagelist});
-
-// set the desired wallpaper
-var k = 0;
-while(k < desktopArray.length) {{
-    var desktop = desktopArray[k];
-    desktop.wallpaperPlugin = "org.kde.image";
-    desktop.currentConfigGroup = Array("Wallpaper", "org.kde.image", "General");
-    desktop.writeConfig("Image", imageFileArray[k]);
-    k = k+1;
-}}
-"""
-    profname = None
-    if outputfile:
-        profname = os.path.splitext(os.path.basename(outputfile))[0][:-2]
-        img_names = special_image_cropper(outputfile)
-    elif not outputfile and image_piece_list:
-        if sp_logging.DEBUG:
-            sp_logging.G_LOGGER.info("KDE: Using image piece list!")
-        img_names = image_piece_list
-    else:
-        if sp_logging.DEBUG:
-            sp_logging.G_LOGGER.info("Error! KDE actions called without arguments!")
-
-    filess_img_names = []
-    for fname in img_names:
-        filess_img_names.append("file://" + fname)
-    filess_img_names_str = ', '.join('"' + item + '"' for item in filess_img_names)
-    # print(script.format(imagelist=filess_img_names_str))
-
-    sessionb = dbus.SessionBus()
-    plasma_interface = dbus.Interface(
-        sessionb.get_object(
-            "org.kde.plasmashell",
-            "/PlasmaShell"),
-        dbus_interface="org.kde.PlasmaShell")
-    if profname == G_ACTIVE_PROFILE or image_piece_list or force:
-        plasma_interface.evaluateScript(
-            script.format(imagelist=filess_img_names_str)
-        )
+def change_wallpaper_job(profile, force=False, indices=None, progressive=False,
+                         low_power=False):
+    """Centralized wallpaper method that calls setter algorithm based on input prof settings.
+    When force, skip the profile name check.
 
-    # Delete old images after new ones are set
-    if outputfile:
-        remove_old_temp_files(outputfile)
+    indices selects the image lists, i.e. displays or span groups, that
+    get a new image; None changes all of them.
 
+    progressive marks changes the user waits for, e.g. the hotkey. If the
+    progressive_apply setting is on they are first set as a draft and
+    then refined in the background, see refine_draft_job.
 
-# def xfce_actions(outputfile, image_piece_list = None):
-def xfce_actions(outputfile):
-    """
-    Sets the multi monitor wallpaper on XFCE.
+    low_power, given by power aware slideshows on battery, renders a
+    draft that is not refined and skips the topology prerenders.
 
-    This is needed since XFCE uses its own scripting interface to
-    set the desktop background which sets a single image on every
-    monitor. This means that the composed image must be cut into
-    correct pieces that then are set to their respective displays.
+    The render is queued on the render worker and a RenderJob handle is
+    returned, or None if the spanmode is unknown.
     """
+    setter = wallpaper_setter(profile)
+    if setter is None:
+        return None
+    if setter is span_single_image_simple:
+        indices = None
+    draft = low_power or (progressive and PROGRESSIVE_APPLY)
+    job = RenderJob(setter, profile, force, indices=indices, draft=draft)
+    if draft and not low_power:
+        job.refine_pending = True
+        job.add_done_callback(refine_draft_job)
+    return get_render_worker().submit(job)
+
+
+def refine_draft_job(draft_job):
+    """Queue the full quality pass of a finished draft render."""
+    if draft_job.state != "done" or not draft_job.refine_pending:
+        return
+    get_render_worker().submit(RenderJob(refine_draft_pieces, draft_job.profile,
+                                         draft_job.force,
+                                         key="refine-" + draft_job.profile.name,
+                                         background=True))
+
+
+def refine_draft_pieces(profile, force):
+    """Render the draft pieces of the wallpaper of profile again at full quality.
+
+    The wallpaper that is up now is refined, so if a newer change already
+    replaced the draft there is nothing left to do.
+    """
+    pieces = G_PIECE_SETS.get(profile.name)
+    if pieces is None or not pieces.drafts or pieces.layout != piece_layout(profile):
+        return 0
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("Refining draft pieces %s of %s.",
+                                 sorted(pieces.drafts), profile.name)
+    return wallpaper_setter(profile)(FrameProfile(profile, pieces.frame_files), force)
 
-    read_prop = subprocess.Popen(["xfconf-query",
-                                  "-c",
-                                  "xfce4-desktop",
-                                  "-p",
-                                  "/backdrop",
-                                  "-l"],
-                                 stdout=subprocess.PIPE)
-    props = read_prop.stdout.read().decode("utf-8").split("\n")
-    for prop in props:
-        if "workspace0/image-style" in prop:
-            os.system(
-                "xfconf-query -c xfce4-desktop -p "
-                + prop
-                + " -s 6")
-        elif "workspace0/last-image" in prop:
-            os.system(
-                "xfconf-query -c xfce4-desktop -p "
-                + prop
-                + " -s '%s'" % outputfile)
 
-    # Delete old images after new ones are set
-    if outputfile:
-        remove_old_temp_files(outputfile)
+def schedule_slideshow(profile):
+    """Schedule the slideshow of profile and return the timer handle.
 
-
-def change_wallpaper_job(profile, force=False):
-    """Centralized wallpaper method that calls setter algorithm based on input prof settings.
-    When force, skip the profile name check
+    With a single delay the whole wallpaper changes at once. If the profile
+    has a delay for each image list, i.e. for each display in multi image
+    mode or each span group in advanced mode, every list changes on its own
+    timer and lists with equal delays change together.
     """
-    with G_WALLPAPER_CHANGE_LOCK:
-        if profile.spanmode.startswith("single") and profile.ppimode is False:
-            thrd = Thread(target=span_single_image_simple, args=(profile, force), daemon=True)
-            thrd.start()
-        elif ((profile.spanmode.startswith("single") and profile.ppimode is True) or
-               profile.spanmode.startswith("advanced")):
-            thrd = Thread(target=span_single_image_advanced, args=(profile, force), daemon=True)
-            thrd.start()
-        elif profile.spanmode.startswith("multi"):
-            thrd = Thread(target=set_multi_image_wallpaper, args=(profile, force), daemon=True)
-            thrd.start()
-        else:
-            sp_logging.G_LOGGER.info("Unkown profile spanmode: %s", profile.spanmode)
-            return None
-        return thrd
+    num_lists = len(profile.paths_array)
+    delays = profile.delay_list
+    if len(delays) < 2 or num_lists < 2:
+        return get_scheduler().add_job(delays[0], change_wallpaper_job, profile,
+                                       power_aware=True)
+    delays = delays[:num_lists] + [delays[-1]] * (num_lists - len(delays))
+    delay_groups = OrderedDict()
+    for index, delay in enumerate(delays):
+        delay_groups.setdefault(delay, []).append(index)
+    if len(delay_groups) == 1:
+        return get_scheduler().add_job(delays[0], change_wallpaper_job, profile,
+                                       power_aware=True)
+    return ScheduledJobGroup(
+        [get_scheduler().add_job(delay, change_wallpaper_job, profile, indices=tuple(indices),
+                                 power_aware=True)
+         for delay, indices in delay_groups.items()]
+    )
 
 
 def run_profile_job(profile):
@@ -1792,16 +2351,345 @@ def run_profile_job(profile):
     if not profile.slideshow:
         # if sp_logging.DEBUG:
         #     sp_logging.G_LOGGER.info("Running a one-off wallpaper change.")
-        thrd = change_wallpaper_job(profile)
+        thrd = first_frame_job(profile)
     elif profile.slideshow:
         # if sp_logging.DEBUG:
         #     sp_logging.G_LOGGER.info("Running wallpaper slideshow.")
-        thrd = change_wallpaper_job(profile)
-        repeating_timer = RepeatedTimer(
-            profile.delay_list[0], change_wallpaper_job, profile)
+        thrd = first_frame_job(profile)
+        repeating_timer = schedule_slideshow(profile)
+    schedule_warm_cache()
     return (repeating_timer, thrd)
 
 
+def first_frame_job(profile):
+    """Set the first frame of a starting profile, the prerendered one if it exists."""
+    files = G_PRERENDERED_FRAMES.pop(profile.name, None)
+    if files is None:
+        return change_wallpaper_job(profile, progressive=True)
+    if sp_logging.DEBUG:
+        sp_logging.G_LOGGER.info("Starting %s with its prerendered frame %s", profile.name, files)
+    setter = wallpaper_setter(profile)
+    if setter is None:
+        return None
+    return get_render_worker().submit(RenderJob(setter, FrameProfile(profile, files)))
+
+
+def prerender_first_frame(profile):
+    """Render the next frame of profile in the background ahead of its start.
+
+    The pieces wait in the PieceSet of the profile and first_frame_job
+    sets them once the profile starts. Returns the RenderJob.
+    """
+    setter = wallpaper_setter(profile)
+    if setter is None:
+        return None
+    files = G_PRERENDERED_FRAMES.get(profile.name)
+    if files is None:
+        files = profile.next_wallpaper_files()
+        G_PRERENDERED_FRAMES[profile.name] = files
+    return get_render_worker().submit(RenderJob(setter, FrameProfile(profile, files),
+                                                key="prerender-" + profile.name,
+                                                background=True))
+
+
+def profile_is_warm(profile):
+    """Test if the next frame of profile is prerendered for the current displays."""
+    if profile.name not in G_PRERENDERED_FRAMES:
+        return False
+    pieces = G_PIECE_SETS.get(profile.name)
+    layout = piece_layout(profile)
+    return (pieces is not None
+            and pieces.layout == layout
+            and len(pieces.images) == layout[-1].num_displays
+            and not pieces.drafts)
+
+
+def set_warm_profiles(profiles):
+    """Keep the next frame of these profiles prerendered, e.g. the hotkey profiles."""
+    global G_WARM_PROFILES
+    G_WARM_PROFILES = list(profiles)
+    schedule_warm_cache()
+
+
+def warm_profile_cache():
+    """Prerender the next frame of warm profiles whose frame is missing or stale.
+
+    The renders are background jobs, so they run when the render worker
+    is idle and the CPU is not under pressure. Nothing is warmed up on
+    battery.
+    """
+    if power.POWER_AWARE and power.read_power_state().on_battery:
+        return None
+    for profile in list(G_WARM_PROFILES):
+        if profile.name == G_ACTIVE_PROFILE or profile_is_warm(profile):
+            continue
+        if sp_logging.DEBUG:
+            sp_logging.G_LOGGER.info("Warming up the next frame of %s.", profile.name)
+        prerender_first_frame(profile)
+    return None
+
+
+def schedule_warm_cache(delay=None):
+    """Warm up the warm profiles after delay seconds, and periodically after that."""
+    global G_WARM_CACHE_JOB
+    if not G_WARM_PROFILES:
+        return
+    if G_WARM_CACHE_JOB is None:
+        G_WARM_CACHE_JOB = ScheduledJob(get_scheduler(), WARM_CACHE_INTERVAL,
+                                        warm_profile_cache, late_policy="skip", max_lead=0)
+    G_WARM_CACHE_JOB.start(WARM_CACHE_DELAY if delay is None else delay)
+
+
+#
+# Display topology variants
+#
+class StoredMonitor():
+    """Monitor geometry of a remembered topology, stands in for a screeninfo Monitor."""
+    def __init__(self, x, y, width, height, width_mm, height_mm, name=None):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.width_mm = width_mm
+        self.height_mm = height_mm
+        self.name = name
+
+
+class FrameProfile():
+    """Stand-in of a profile that renders the given frame instead of advancing."""
+    def __init__(self, profile, files):
+        self.profile = profile
+        self.files = list(files)
+
+    def __getattr__(self, name):
+        return getattr(self.profile, name)
+
+    def next_wallpaper_files(self, peek=False, indices=None):
+        return list(self.files)
+
+
+class TopologyVariant():
+    """Pieces of the current frame rendered for another display topology."""
+    def __init__(self, key, monitors):
+        self.key = key
+        self.monitors = monitors
+        self.profile_name = None
+        self.files = None
+        self.pieces = None
+
+
+def topology_key(disp_list):
+    """Return the key of a Display list, the same as the hash of its DisplaySystem."""
+    return str(hash(tuple(disp_list)))
+
+
+def remember_topology(disp_list):
+    """Store the monitor geometry of disp_list in the topology file.
+
+    Only the most recently seen topologies are kept.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    if os.path.exists(TOPOLOGY_FILE):
+        config.read(TOPOLOGY_FILE)
+    geometry = []
+    for dsp in disp_list:
+        phys_mm = (0, 0) if dsp.phys_size_failed else dsp.detected_phys_size_mm
+        geometry.append(dsp.digital_offset + dsp.resolution + tuple(phys_mm))
+    config[topology_key(disp_list)] = {
+        "monitors": list_to_str(geometry, item_len=6),
+        "names": ",".join(str(dsp.name) for dsp in disp_list),
+        "last_seen": str(int(time.time())),
+    }
+    for key in sorted(config.sections(),
+                      key=lambda sect: int(config[sect].get("last_seen", 0)),
+                      reverse=True)[TOPOLOGY_VARIANTS_MAX + 1:]:
+        config.remove_section(key)
+    try:
+        with open(TOPOLOGY_FILE, "w") as topo_file:
+            config.write(topo_file)
+    except OSError as excep:
+        sp_logging.G_LOGGER.info("Could not save display topology: %s", excep)
+
+
+def known_topologies():
+    """Return (key, monitors) of the remembered topologies, most recently seen first."""
+    if not os.path.exists(TOPOLOGY_FILE):
+        return []
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(TOPOLOGY_FILE)
+    topologies = []
+    for key in sorted(config.sections(),
+                      key=lambda sect: int(config[sect].get("last_seen", 0)),
+                      reverse=True):
+        geometry = str_to_list(config[key]["monitors"], item_len=6)
+        names = [None if name == "None" else name
+                 for name in config[key].get("names", "").split(",")]
+        names += [None] * (len(geometry) - len(names))
+        monitors = [StoredMonitor(*(tuple(int(val) for val in geom) + (name,)))
+                    for geom, name in zip(geometry, names)]
+        topologies.append((key, monitors))
+    return topologies
+
+
+class topology_context():
+    """
+    Make the renders of this thread target another display topology.
+
+    Renders read their displays from current_layout, which returns the
+    layout of the variant while in this context.
+    """
+    def __init__(self, display_sys, variant):
+        self.display_sys = display_sys
+        self.variant = variant
+
+    def __enter__(self):
+        _RENDER_THREAD_STATE.layout = renderer.DisplayLayout.from_display_system(
+            self.display_sys)
+        _RENDER_THREAD_STATE.variant = self.variant
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _RENDER_THREAD_STATE.variant = None
+        _RENDER_THREAD_STATE.layout = None
+        return False
+
+
+def frame_shown(profile, files, prerender=True):
+    """Remember the frame that was set, prerender it for the other topologies
+    and build the mipmaps of its sources."""
+    global G_CURRENT_FRAME
+    profile = getattr(profile, "profile", profile)  # unwrap a FrameProfile
+    G_CURRENT_FRAME = (profile, list(files))
+    if prerender:
+        prerender_topology_variants()
+        prepare_mipmaps(profile, files)
+
+
+def build_mipmaps(frame_profile, force):
+    """Build the mipmap levels of the files of a FrameProfile, see mipmaps."""
+    layout = current_layout()
+    size = renderer.fill_size(layout, render_options(frame_profile))
+    for fname in frame_profile.files:
+        render_checkpoint()
+        mipmaps.build_levels(fname, size, render_checkpoint)
+    return 0
+
+
+def prepare_mipmaps(profile, files):
+    """Queue a background build of the mipmaps of the shown and the next files of profile.
+
+    Returns the RenderJob, None if the mipmap cache is disabled.
+    """
+    if not mipmaps.MIPMAP_CACHE:
+        return None
+    files = list(files)
+    if hasattr(profile, "file_handler"):
+        files += [fname for fname in profile.next_wallpaper_files(peek=True)
+                  if fname not in files]
+    return get_render_worker().submit(RenderJob(build_mipmaps, FrameProfile(profile, files),
+                                                key="mipmap-" + profile.name,
+                                                background=True))
+
+
+def prerender_topology_variants():
+    """Queue background renders of the current frame for recently seen topologies."""
+    if G_CURRENT_FRAME is None or TOPOLOGY_VARIANTS_MAX <= 0:
+        return
+    profile, files = G_CURRENT_FRAME
+    setter = wallpaper_setter(profile)
+    if setter is None:
+        return
+    current_key = topology_key(G_ACTIVE_DISPLAYSYSTEM.disp_list)
+    wanted = [(key, monitors) for key, monitors in known_topologies()
+              if key != current_key][:TOPOLOGY_VARIANTS_MAX]
+    for key in list(G_TOPOLOGY_VARIANTS):
+        if key not in dict(wanted):
+            del G_TOPOLOGY_VARIANTS[key]
+    for key, monitors in wanted:
+        variant = G_TOPOLOGY_VARIANTS.setdefault(key, TopologyVariant(key, monitors))
+        if variant.profile_name == profile.name and variant.files == files:
+            continue
+
+        def render_variant(frame_profile, force, variant=variant, setter=setter):
+            display_sys = DisplaySystem(displays_from_monitors(variant.monitors))
+            with topology_context(display_sys, variant):
+                setter(frame_profile, force)
+            variant.profile_name = frame_profile.name
+            variant.files = list(frame_profile.files)
+            if sp_logging.DEBUG:
+                sp_logging.G_LOGGER.info("Prerendered topology %s: %s", variant.key, variant.files)
+            return 0
+
+        get_render_worker().submit(RenderJob(render_variant, FrameProfile(profile, files),
+                                             force=True, key="variant-" + key,
+                                             background=True))
+
+
+def apply_topology_change():
+    """Show the current frame on the new display topology.
+
+    A prerendered variant is set right away, otherwise the frame is
+    rendered again for the new topology. Returns the RenderJob.
+    """
+    refresh_display_data()
+    if G_CURRENT_FRAME is None:
+        return None
+    profile, files = G_CURRENT_FRAME
+    key = topology_key(G_ACTIVE_DISPLAYSYSTEM.disp_list)
+    variant = G_TOPOLOGY_VARIANTS.get(key)
+    frame_profile = FrameProfile(profile, files)
+    if (variant is not None and variant.pieces is not None
+            and variant.profile_name == profile.name and variant.files == files):
+        sp_logging.G_LOGGER.info("Display topology %s changed, using prerendered variant.", key)
+
+        def set_variant(frame_profile, force, variant=variant):
+            pieces = variant.pieces
+            pieces.layout = piece_layout(frame_profile)
+            pieces.files = {}
+            pieces.dirty = set(pieces.images)
+            G_PIECE_SETS.pop(frame_profile.name, None)
+            G_PIECE_SETS[frame_profile.name] = pieces
+            return set_pieces_wallpaper(frame_profile, force, variant.files, pieces)
+
+        return get_render_worker().submit(RenderJob(set_variant, frame_profile, force=True))
+    sp_logging.G_LOGGER.info("Display topology %s changed, rendering the frame again.", key)
+    setter = wallpaper_setter(profile)
+    if setter is None:
+        return None
+    return get_render_worker().submit(RenderJob(setter, frame_profile, force=True))
+
+
+def check_topology():
+    """Look for a display topology change and apply it. Run by the topology watch."""
+    monitors = get_monitors()
+    if not monitors or G_ACTIVE_DISPLAYSYSTEM is None:
+        return None
+    key = topology_key(displays_from_monitors(monitors))
+    if key == topology_key(G_ACTIVE_DISPLAYSYSTEM.disp_list):
+        return None
+    job = apply_topology_change()
+    schedule_warm_cache()
+    return job
+
+
+def start_topology_watch():
+    """Start polling the display topology on the scheduler."""
+    global G_TOPOLOGY_WATCH
+    if G_TOPOLOGY_WATCH is None:
+        G_TOPOLOGY_WATCH = ScheduledJob(get_scheduler(), TOPOLOGY_CHECK_INTERVAL,
+                                        check_topology, late_policy="skip", max_lead=0)
+        G_TOPOLOGY_WATCH.start()
+    return G_TOPOLOGY_WATCH
+
+
+def stop_topology_watch():
+    """Stop polling the display topology."""
+    global G_TOPOLOGY_WATCH
+    if G_TOPOLOGY_WATCH is not None:
+        G_TOPOLOGY_WATCH.stop()
+        G_TOPOLOGY_WATCH = None
+
+
 def quick_profile_job(profile):
     """
     At startup and profile change, switch to old temp wallpaper.
@@ -1819,10 +2707,15 @@ def quick_profile_job(profile):
         if sp_logging.DEBUG:
             sp_logging.G_LOGGER.info("quickswitch file lookup: %s", files)
         if files:
-            image_pieces = [os.path.join(TEMP_PATH, i) for i in files
-                            if "-crop-" in i]
+            # Newest piece of each display, pieces can alternate per display.
+            latest_pieces = {}
+            for fname in sorted((os.path.join(TEMP_PATH, i) for i in files if "-crop-" in i),
+                                key=os.path.getmtime):
+                piece_id = os.path.splitext(fname)[0].rsplit("-crop-", 1)[1]
+                if piece_id.isdigit():
+                    latest_pieces[int(piece_id)] = fname
+            image_pieces = [latest_pieces[idx] for idx in sorted(latest_pieces)]
             if use_image_pieces() and image_pieces:
-                image_pieces.sort()
                 if sp_logging.DEBUG:
                     sp_logging.G_LOGGER.info("Use wallpaper crop pieces: %s",
                                              image_pieces)
@@ -1858,13 +2751,7 @@ def use_image_pieces():
     """
     pltform = platform.system()
     if pltform == "Linux":
-        if running_kde():
-            return True
-        # desk_env = os.environ.get("DESKTOP_SESSION")
-        # elif desk_env in ["xfce", "xubuntu", "ubuntustudio"]:
-            # return True
-        else:
-            return False
+        return get_backend().piecewise
     elif pltform == "Darwin":
         return True
     else:
@@ -0,0 +1,597 @@
+"""
+Wallpaper setter backends for Linux desktops.
+
+The desktop is detected once and the matching backend is kept for the
+lifetime of the process together with its connections: a D-Bus session
+connection on KDE and a GSettings handle on GNOME-like desktops when
+PyGObject is available. Backends that have to start external programs
+run them on a single worker thread with a timeout so that wallpaper
+changes never block on a hanging helper process.
+
+The backend can be forced with the SUPERPAPER_SETTER_BACKEND environment
+variable, e.g. SUPERPAPER_SETTER_BACKEND=stub records the calls without
+touching the desktop.
+"""
+
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import superpaper.sp_logging as sp_logging
+import superpaper.sp_metrics as sp_metrics
+
+# Seconds a setter command or D-Bus call may take before it is abandoned.
+SETTER_TIMEOUT = 10
+
+SETTER_BACKENDS = OrderedDict()
+G_BACKEND = None
+G_BACKEND_LOCK = threading.Lock()
+G_SETTER_EXECUTOR = None
+G_SETTER_EXECUTOR_LOCK = threading.Lock()
+
+
+def running_kde():
+    """Detect if running in a KDE session."""
+    d_ses = os.environ.get("DESKTOP_SESSION")
+    if d_ses and ("plasma" in d_ses or "kde" in d_ses):
+        return True
+    kde_f_ses = os.environ.get("KDE_FULL_SESSION")
+    xdg_ses_dtop = os.environ.get("XDG_SESSION_DESKTOP")
+    if kde_f_ses == "true" or xdg_ses_dtop == "KDE":
+        return True
+    return False
+
+
+def run_command(args, timeout=SETTER_TIMEOUT):
+    """Run a command with a timeout. Returns False if it could not be started."""
+    try:
+        subprocess.run(args, timeout=timeout, check=False)
+    except subprocess.TimeoutExpired:
+        sp_logging.G_LOGGER.info("Setter command timed out after %s s: %s", timeout, args)
+    except OSError:
+        return False
+    return True
+
+
+def run_async(metric, func, *args):
+    """Run func(*args) on the setter worker thread and time it.
+
+    Calls are executed in submission order so consecutive wallpaper
+    changes cannot overtake each other. Returns a Future.
+    """
+    global G_SETTER_EXECUTOR
+    with G_SETTER_EXECUTOR_LOCK:
+        if G_SETTER_EXECUTOR is None:
+            G_SETTER_EXECUTOR = ThreadPoolExecutor(max_workers=1,
+                                                   thread_name_prefix="sp-setter")
+    return G_SETTER_EXECUTOR.submit(_timed_call, metric, func, *args)
+
+
+def _timed_call(metric, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception as excep:
+        sp_logging.G_LOGGER.info("Wallpaper setter '%s' failed: %s", metric, excep)
+        return None
+    finally:
+        sp_metrics.record(metric, time.perf_counter() - start)
+
+
+def run_set_command(set_command, outputfile):
+    """Run the user configured 'set_command' asynchronously."""
+    if set_command == "feh":
+        sp_logging.G_LOGGER.info("Using 'feh' command mode!")
+        command = ["feh", "--bg-scale", "--no-xinerama", outputfile]
+    else:
+        command = [term.format(image=outputfile) for term in set_command.split()]
+        sp_logging.G_LOGGER.info("Formatted custom command is: '%s'", command)
+    return run_async("setter.command", run_command, command)
+
+
+def register_backend(cls):
+    """Class decorator adding a backend to the registry.
+
+    Detection tries the backends in registration order.
+    """
+    SETTER_BACKENDS[cls.name] = cls
+    return cls
+
+
+class SetterBackend():
+    """
+    Base class of the wallpaper setter backends.
+
+    Backends with piecewise = True set a separate image on each display
+    and take a list of per display image pieces, the others set the whole
+    spanned image at once.
+    """
+    name = None
+    piecewise = False
+
+    @staticmethod
+    def detect(desk_env):
+        """Test if this backend should be used in the current session."""
+        return False
+
+    def set_wallpaper(self, outputfile):
+        """Set a spanned image as the wallpaper."""
+        raise NotImplementedError
+
+    def set_pieces(self, image_piece_list, display_names=None, changed=None):
+        """Set one image per display, in the order of the display list.
+
+        display_names are the names of the displays in the same order,
+        if known, for backends that address monitors by name. changed
+        lists the indices of the displays whose piece changed, the other
+        displays are left alone; None updates all of them.
+        """
+        raise NotImplementedError
+
+    def set_spanmode(self):
+        """Make the desktop span one image over all displays, if needed."""
+
+
+class GSettingsBackend(SetterBackend):
+    """
+    Backend for desktops configured through GSettings.
+
+    Uses a Gio.Settings handle if PyGObject is installed, otherwise falls
+    back to calling the gsettings tool asynchronously.
+    """
+    schema = None
+    keys = ()
+    use_uri = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gio = None
+        self.settings = None
+        try:
+            from gi.repository import Gio
+            source = Gio.SettingsSchemaSource.get_default()
+            if source is not None and source.lookup(self.schema, True) is not None:
+                self.gio = Gio
+                self.settings = Gio.Settings.new(self.schema)
+        except (ImportError, ValueError) as excep:
+            if sp_logging.DEBUG:
+                sp_logging.G_LOGGER.info("Gio not available, using gsettings: %s", excep)
+
+    def set_wallpaper(self, outputfile):
+        value = "file://" + outputfile if self.use_uri else outputfile
+        self.set_keys([(key, value) for key in self.keys])
+
+    def set_spanmode(self):
+        self.set_keys([("picture-options", "spanned")])
+
+    def set_keys(self, key_values):
+        """Write string values to the schema of this backend."""
+        if self.settings is not None:
+            start = time.perf_counter()
+            with self.lock:
+                schema = self.settings.props.settings_schema
+                for key, value in key_values:
+                    if schema.has_key(key):
+                        self.settings.set_string(key, value)
+                # Flush the writes to dconf before returning.
+                self.gio.Settings.sync()
+            sp_metrics.record("setter." + self.name, time.perf_counter() - start)
+            return None
+        commands = [["/usr/bin/gsettings", "set", self.schema, key, value]
+                    for key, value in key_values]
+        return run_async("setter." + self.name, self._run_commands, commands)
+
+    @staticmethod
+    def _run_commands(commands):
+        for command in commands:
+            run_command(command)
+
+
+@register_backend
+class GnomeBackend(GSettingsBackend):
+    name = "gnome"
+    schema = "org.gnome.desktop.background"
+    keys = ("picture-uri-dark", "picture-uri")
+
+    @staticmethod
+    def detect(desk_env):
+        return desk_env in ["gnome", "gnome-wayland", "gnome-xorg",
+                            "unity", "ubuntu",
+                            "pantheon", "budgie-desktop",
+                            "pop"]
+
+
+@register_backend
+class CinnamonBackend(GSettingsBackend):
+    name = "cinnamon"
+    schema = "org.cinnamon.desktop.background"
+    keys = ("picture-uri",)
+
+    @staticmethod
+    def detect(desk_env):
+        return bool(desk_env) and "cinnamon" in desk_env.lower()
+
+
+@register_backend
+class MateBackend(GSettingsBackend):
+    name = "mate"
+    schema = "org.mate.background"
+    keys = ("picture-filename",)
+    use_uri = False
+
+    @staticmethod
+    def detect(desk_env):
+        return desk_env in ["mate"]
+
+
+XFCE_CHANNEL = "xfce4-desktop"
+# xfce4-desktop image-style values
+XFCE_STYLE_ZOOMED = 5
+XFCE_STYLE_SPANNING = 6
+XFCE_IMAGE_PROP = re.compile(r"^/backdrop/screen(\d+)/monitor([^/]+)/workspace(\d+)/last-image$")
+
+
+@register_backend
+class XfceBackend(SetterBackend):
+    """
+    Sets per display wallpapers on XFCE through xfconf.
+
+    Each image piece is written to the last-image property of its
+    monitor, matched by the connector name of the display when known and
+    by monitor order otherwise. All properties are updated in one batch,
+    over the org.xfce.Xfconf D-Bus interface when dbus-python is
+    available or with a single shell process running xfconf-query.
+    A bus can be passed in to run against a fake xfconf service.
+    """
+    name = "xfce"
+    piecewise = True
+
+    def __init__(self, bus=None):
+        self.bus = bus
+        self.xfconf = None
+        self.lock = threading.Lock()
+        try:
+            import dbus
+            self.dbus = dbus
+        except ImportError:
+            self.dbus = None
+
+    @staticmethod
+    def detect(desk_env):
+        return desk_env in ["xfce", "xubuntu", "ubuntustudio"]
+
+    def set_wallpaper(self, outputfile):
+        return run_async("setter." + self.name, self._apply_spanned, outputfile)
+
+    def set_pieces(self, image_piece_list, display_names=None, changed=None):
+        return run_async("setter." + self.name, self._apply_pieces,
+                         list(image_piece_list), display_names, changed)
+
+    def _apply_spanned(self, outputfile):
+        props = self.list_properties()
+        updates = []
+        for prop in props:
+            if XFCE_IMAGE_PROP.match(prop):
+                updates.append((prop[:-len("last-image")] + "image-style", XFCE_STYLE_SPANNING))
+                updates.append((prop, outputfile))
+        self.set_properties(updates)
+
+    def _apply_pieces(self, image_piece_list, display_names, changed):
+        monitor_props = self.monitor_properties(self.list_properties())
+        targets = self.match_monitors(monitor_props, len(image_piece_list), display_names)
+        updates = []
+        for index, (piece, image_props) in enumerate(zip(image_piece_list, targets)):
+            if changed is not None and index not in changed:
+                continue
+            for prop in image_props:
+                updates.append((prop[:-len("last-image")] + "image-style", XFCE_STYLE_ZOOMED))
+                updates.append((prop, piece))
+        self.set_properties(updates)
+
+    @staticmethod
+    def monitor_properties(props):
+        """Group last-image properties by monitor name, keeping xfconf's order."""
+        monitors = OrderedDict()
+        for prop in props:
+            match = XFCE_IMAGE_PROP.match(prop)
+            if match:
+                monitors.setdefault(match.group(2), []).append(prop)
+        return monitors
+
+    @staticmethod
+    def match_monitors(monitor_props, num_pieces, display_names=None):
+        """Return the list of properties to set for each image piece.
+
+        Pieces are matched to monitors by connector name if the display
+        names are known, a display without existing properties gets new
+        ones for workspace0. Otherwise the monitors are taken in order,
+        numerically for the old monitor0, monitor1, ... naming.
+        """
+        if (display_names and len(display_names) == num_pieces
+                and (not monitor_props
+                     or any(name in monitor_props for name in display_names))):
+            return [monitor_props.get(
+                        name,
+                        ["/backdrop/screen0/monitor{}/workspace0/last-image".format(name)])
+                    for name in display_names]
+        names = list(monitor_props)
+        if all(name.isdigit() for name in names):
+            names.sort(key=int)
+        if len(names) < num_pieces:
+            sp_logging.G_LOGGER.info("XFCE: found %s monitors for %s image pieces.",
+                                     len(names), num_pieces)
+        return [monitor_props[name] for name in names[:num_pieces]]
+
+    def _xfconf_interface(self):
+        if self.xfconf is None:
+            if self.bus is None:
+                self.bus = self.dbus.SessionBus(private=True)
+            self.xfconf = self.dbus.Interface(
+                self.bus.get_object("org.xfce.Xfconf", "/org/xfce/Xfconf"),
+                dbus_interface="org.xfce.Xfconf")
+        return self.xfconf
+
+    def list_properties(self):
+        """Return the property paths under /backdrop."""
+        if self.dbus is not None:
+            try:
+                with self.lock:
+                    props = self._xfconf_interface().GetAllProperties(
+                        XFCE_CHANNEL, "/backdrop", timeout=SETTER_TIMEOUT)
+                return [str(prop) for prop in props]
+            except self.dbus.exceptions.DBusException as excep:
+                sp_logging.G_LOGGER.info("xfconf D-Bus call failed, using xfconf-query: %s",
+                                         excep)
+                self.xfconf = None
+        read_prop = subprocess.run(["xfconf-query", "-c", XFCE_CHANNEL, "-p", "/backdrop", "-l"],
+                                   stdout=subprocess.PIPE, timeout=SETTER_TIMEOUT, check=False)
+        return read_prop.stdout.decode("utf-8").split()
+
+    def set_properties(self, updates):
+        """Write (property, value) pairs in one batch. Creates missing properties."""
+        if not updates:
+            return
+        if self.dbus is not None:
+            try:
+                with self.lock:
+                    xfconf = self._xfconf_interface()
+                    for prop, value in updates:
+                        if isinstance(value, int):
+                            value = self.dbus.Int32(value)
+                        else:
+                            value = self.dbus.String(value)
+                        xfconf.SetProperty(XFCE_CHANNEL, prop, value, timeout=SETTER_TIMEOUT)
+                return
+            except self.dbus.exceptions.DBusException as excep:
+                sp_logging.G_LOGGER.info("xfconf D-Bus call failed, using xfconf-query: %s",
+                                         excep)
+                self.xfconf = None
+        commands = []
+        for prop, value in updates:
+            vtype = "int" if isinstance(value, int) else "string"
+            commands.append(" ".join(shlex.quote(arg) for arg in [
+                "xfconf-query", "-c", XFCE_CHANNEL, "-p", prop,
+                "--create", "-t", vtype, "-s", str(value)]))
+        run_command(["sh", "-c", "; ".join(commands)])
+
+
+@register_backend
+class LxqtBackend(SetterBackend):
+    name = "lxqt"
+
+    @staticmethod
+    def detect(desk_env):
+        return bool(desk_env) and (desk_env.lower() == "lubuntu"
+                                   or "lxqt" in desk_env.lower())
+
+    def set_wallpaper(self, outputfile):
+        return run_async("setter." + self.name, self._pcmanfm, ["-w", outputfile])
+
+    def set_spanmode(self):
+        return run_async("setter." + self.name, self._pcmanfm,
+                         ["--wallpaper-mode=stretch"])
+
+    @staticmethod
+    def _pcmanfm(args):
+        for program in ("pcmanfm", "pcmanfm-qt"):
+            if run_command([program] + args):
+                return
+        sp_logging.G_LOGGER.info("Exception: failure to find either command "
+                                 "'pcmanfm' or 'pcmanfm-qt'.")
+
+
+KDE_SCRIPT = """
+// make an array of all desktops with a valid screen
+var desktopArray = [];
+for(var desktopIndex in desktops()) {{
+    var desktop = desktops()[desktopIndex];
+    if(desktop.screen != -1) {{
+        desktopArray.push(desktop);
+    }}
+}}
+
+// sort the array based on the (vertical) desktop position
+var i = 1;
+while(i < desktopArray.length) {{
+    var j = i;
+    while(j > 0 && screenGeometry(desktopArray[j-1].screen).top > screenGeometry(desktopArray[j].screen).top) {{
+        var temp = desktopArray[j];
+        desktopArray[j] = desktopArray[j-1];
+        desktopArray[j-1] = temp;
+        j = j-1;
+    }}
+    i = i+1;
+}}
+
+// sort the array based on the (horizontal) desktop position
+var i = 1;
+while(i < desktopArray.length) {{
+    var j = i;
+    while(j > 0 && screenGeometry(desktopArray[j-1].screen).left > screenGeometry(desktopArray[j].screen).left) {{
+        var temp = desktopArray[j];
+        desktopArray[j] = desktopArray[j-1];
+        desktopArray[j-1] = temp;
+        j = j-1;
+    }}
+    i = i+1;
+}}
+
+var imageFileArray = Array({imagelist});
+
+// set the desired wallpaper
+var k = 0;
+while(k < desktopArray.length) {{
+    var desktop = desktopArray[k];
+    // empty entries are left unchanged
+    if(imageFileArray[k]) {{
+        desktop.wallpaperPlugin = "org.kde.image";
+        desktop.currentConfigGroup = Array("Wallpaper", "org.kde.image", "General");
+        desktop.writeConfig("Image", imageFileArray[k]);
+    }}
+    k = k+1;
+}}
+"""
+
+
+@register_backend
+class KdeBackend(SetterBackend):
+    """
+    Sets per display wallpapers on KDE Plasma through the PlasmaShell
+    scripting interface.
+
+    The session bus connection and the proxy are kept between calls and
+    reopened once if the shell has gone away. A bus can be passed in to
+    run against a private dbus-daemon.
+    """
+    name = "kde"
+    piecewise = True
+
+    def __init__(self, bus=None):
+        import dbus
+        self.dbus = dbus
+        self.bus = bus
+        self.interface = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def detect(desk_env):
+        # running_kde also recognizes sessions without DESKTOP_SESSION
+        return (bool(desk_env) and ("plasma" in desk_env or "kde" in desk_env)
+                or running_kde())
+
+    def _plasma_interface(self):
+        if self.interface is None:
+            if self.bus is None:
+                self.bus = self.dbus.SessionBus(private=True)
+            self.interface = self.dbus.Interface(
+                self.bus.get_object("org.kde.plasmashell", "/PlasmaShell"),
+                dbus_interface="org.kde.PlasmaShell")
+        return self.interface
+
+    def set_wallpaper(self, outputfile):
+        self.set_pieces([outputfile])
+
+    def set_pieces(self, image_piece_list, display_names=None, changed=None):
+        img_names_str = ', '.join(
+            '"file://' + fname + '"' if changed is None or index in changed else '""'
+            for index, fname in enumerate(image_piece_list))
+        script = KDE_SCRIPT.format(imagelist=img_names_str)
+        with self.lock, sp_metrics.timed("setter." + self.name):
+            try:
+                self._plasma_interface().evaluateScript(script, timeout=SETTER_TIMEOUT)
+            except self.dbus.exceptions.DBusException as excep:
+                sp_logging.G_LOGGER.info("PlasmaShell call failed, reconnecting: %s", excep)
+                self.interface = None
+                self._plasma_interface().evaluateScript(script, timeout=SETTER_TIMEOUT)
+
+
+@register_backend
+class FehBackend(SetterBackend):
+    """Fallback for window managers without a desktop, e.g. i3."""
+    name = "feh"
+
+    @staticmethod
+    def detect(desk_env):
+        return not desk_env or "i3" in desk_env or desk_env in ["/usr/share/xsessions/bspwm"]
+
+    def set_wallpaper(self, outputfile):
+        return run_async("setter." + self.name, run_command,
+                         ["feh", "--bg-scale", "--no-xinerama", outputfile])
+
+
+@register_backend
+class NoBackend(SetterBackend):
+    """Used when the desktop is not recognized; only 'set_command' is run."""
+    name = "none"
+
+    @staticmethod
+    def detect(desk_env):
+        return True
+
+    def set_wallpaper(self, outputfile):
+        pass
+
+
+@register_backend
+class StubBackend(SetterBackend):
+    """Records the calls it gets instead of changing the wallpaper.
+
+    Never detected automatically, select it with
+    SUPERPAPER_SETTER_BACKEND=stub or set_backend().
+    """
+    name = "stub"
+
+    def __init__(self, piecewise=False):
+        self.piecewise = piecewise
+        self.calls = []
+
+    def set_wallpaper(self, outputfile):
+        with sp_metrics.timed("setter." + self.name):
+            self.calls.append(("set_wallpaper", outputfile))
+
+    def set_pieces(self, image_piece_list, display_names=None, changed=None):
+        with sp_metrics.timed("setter." + self.name):
+            self.calls.append(("set_pieces", list(image_piece_list), changed))
+
+    def set_spanmode(self):
+        self.calls.append(("set_spanmode",))
+
+
+def detect_backend(desk_env=None):
+    """Return the backend class matching the session in desk_env."""
+    if desk_env is None:
+        desk_env = os.environ.get("DESKTOP_SESSION")
+    for cls in SETTER_BACKENDS.values():
+        if cls.detect(desk_env):
+            return cls
+    return NoBackend
+
+
+def get_backend():
+    """Return the setter backend of this session, detecting it on first use."""
+    global G_BACKEND
+    with G_BACKEND_LOCK:
+        if G_BACKEND is None:
+            forced = os.environ.get("SUPERPAPER_SETTER_BACKEND")
+            if forced and forced in SETTER_BACKENDS:
+                cls = SETTER_BACKENDS[forced]
+            else:
+                if forced:
+                    sp_logging.G_LOGGER.info("Unknown setter backend '%s', detecting.", forced)
+                cls = detect_backend()
+            G_BACKEND = cls()
+            sp_logging.G_LOGGER.info("DESKTOP_SESSION is: '%s', using setter backend '%s'",
+                                     os.environ.get("DESKTOP_SESSION"), G_BACKEND.name)
+        return G_BACKEND
+
+
+def set_backend(backend):
+    """Replace the active setter backend. None makes the next call detect it again."""
+    global G_BACKEND
+    with G_BACKEND_LOCK:
+        G_BACKEND = backend
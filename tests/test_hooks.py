@@ -0,0 +1,48 @@
+"""Tests of the post wallpaper change hooks."""
+
+import threading
+
+import superpaper.hooks as hooks
+
+
+def make_runner(monkeypatch, hook_list):
+    monkeypatch.setattr(hooks, "HOOK_MODULES", [])
+    monkeypatch.setattr(hooks, "LEGACY_SCRIPT", "/nonexistent/run-after-wp-change.py")
+    runner = hooks.HookRunner()
+    runner.hooks = hook_list
+    runner.loaded_modules = ()
+    return runner
+
+
+def test_wait_lets_hooks_finish(monkeypatch):
+    release = threading.Event()
+    seen = []
+
+    def hook(event):
+        release.wait(5)
+        seen.append(event.outputfile)
+
+    runner = make_runner(monkeypatch, [("slow", hook)])
+    runner.dispatch(hooks.WallpaperChangeEvent("/tmp/wallpaper.png"))
+    assert not runner.wait(0.05)
+    assert all(not thread.daemon for thread in runner.threads)
+    release.set()
+    assert runner.wait(5)
+    assert seen == ["/tmp/wallpaper.png"]
+    assert not runner.threads
+
+
+def test_busy_hook_is_skipped(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def hook(event):
+        calls.append(event)
+        release.wait(5)
+
+    runner = make_runner(monkeypatch, [("busy", hook)])
+    runner.dispatch(hooks.WallpaperChangeEvent("/tmp/first.png"))
+    runner.dispatch(hooks.WallpaperChangeEvent("/tmp/second.png"))
+    release.set()
+    assert runner.wait(5)
+    assert [event.outputfile for event in calls] == ["/tmp/first.png"]
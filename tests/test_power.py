@@ -0,0 +1,53 @@
+"""Tests of the power and idle state read from a fake sysfs tree."""
+
+import platform
+
+import superpaper.power as power
+
+
+def write_attrs(path, **attrs):
+    path.mkdir(parents=True)
+    for name, value in attrs.items():
+        (path / name).write_text(value + "\n")
+
+
+def make_sysfs(root, mains_online="0", battery_status="Discharging", dpms=("On",)):
+    supplies = root / "class" / "power_supply"
+    write_attrs(supplies / "AC", type="Mains", online=mains_online)
+    write_attrs(supplies / "BAT0", type="Battery", status=battery_status)
+    drm = root / "class" / "drm"
+    for index, state in enumerate(dpms):
+        write_attrs(drm / "card0-DP-{}".format(index + 1), status="connected", dpms=state)
+    write_attrs(drm / "card0-HDMI-A-1", status="disconnected", dpms="Off")
+    return str(root)
+
+
+def test_mains_online_is_not_on_battery(tmp_path):
+    root = make_sysfs(tmp_path, mains_online="1", battery_status="Charging")
+    assert not power.on_battery(root)
+
+
+def test_discharging_battery_is_on_battery(tmp_path):
+    root = make_sysfs(tmp_path, mains_online="0", battery_status="Discharging")
+    assert power.on_battery(root)
+
+
+def test_displays_off_needs_every_connected_display_off(tmp_path):
+    assert not power.displays_off(make_sysfs(tmp_path / "mixed", dpms=("Off", "On")))
+    assert power.displays_off(make_sysfs(tmp_path / "off", dpms=("Off", "Off")))
+
+
+def test_missing_tree_reads_as_unknown(tmp_path):
+    assert not power.on_battery(str(tmp_path))
+    assert not power.displays_off(str(tmp_path))
+
+
+def test_read_power_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(platform, "system", lambda: "Linux")
+    monkeypatch.setattr(power, "screen_locked", lambda: False)
+    root = make_sysfs(tmp_path, mains_online="0", battery_status="Discharging",
+                      dpms=("Off", "Off"))
+    state = power.read_power_state(root=root)
+    assert state.on_battery
+    assert state.displays_off
+    assert state.idle
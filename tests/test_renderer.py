@@ -0,0 +1,40 @@
+"""Tests of the reentrant render pipelines."""
+
+from PIL import Image
+
+import superpaper.render_process as render_process
+import superpaper.renderer as renderer
+
+
+def gradient_image(path, size=(400, 200)):
+    """Save an image that is red on the left and blue on the right."""
+    img = Image.new("RGB", size, (0, 0, 255))
+    img.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    img.save(path)
+    return str(path)
+
+
+def test_negative_manual_offset_pads_with_black(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_process, "RENDER_PROCESSES", 0)
+    source = gradient_image(tmp_path / "source.png")
+    layout = renderer.DisplayLayout.from_resolutions([(200, 200), (200, 200)],
+                                                     [(0, 0), (200, 0)])
+    options = renderer.RenderOptions(spanmode="advanced",
+                                     manual_offsets=[(-50, 0), (0, 0)])
+    result = renderer.render([source], layout, options)
+
+    left, right = result.pieces
+    assert left.size == right.size == (200, 200)
+    # The first 50 columns of the left display lie before the source image.
+    assert left.getpixel((10, 100)) == (0, 0, 0)
+    assert left.getpixel((49, 100)) == (0, 0, 0)
+    assert left.getpixel((60, 100))[0] > 200
+    assert right.getpixel((190, 100))[2] > 200
+
+
+def test_region_inside_image_is_not_padded():
+    img = Image.new("RGB", (100, 100), (0, 255, 0))
+    piece = render_process.resample_region(img, (100, 100), (10, 10, 60, 60), None, 1,
+                                           Image.LANCZOS, None, False)
+    assert piece.size == (50, 50)
+    assert piece.getextrema() == ((0, 0), (255, 255), (0, 0))
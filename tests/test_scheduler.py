@@ -0,0 +1,54 @@
+"""Tests of the slideshow scheduler."""
+
+import threading
+
+import superpaper.governor as governor
+import superpaper.power as power
+import superpaper.wallpaper_processing as wpproc
+
+
+def test_battery_postpone_stretches_interval(monkeypatch):
+    monkeypatch.setattr(power, "POWER_AWARE", True)
+    monkeypatch.setattr(power, "BATTERY_INTERVAL_FACTOR", 3)
+    monkeypatch.setattr(power, "read_power_state",
+                        lambda root=None: power.PowerState(on_battery=True))
+    monkeypatch.setattr(governor, "under_pressure", lambda: False)
+    ran = threading.Event()
+    calls = []
+
+    def change(low_power=False):
+        calls.append(low_power)
+        ran.set()
+
+    scheduler = wpproc.SlideshowScheduler()
+    job = wpproc.ScheduledJob(scheduler, 60, change, power_aware=True)
+    job.start(0.05)
+    first_deadline = job.deadline
+    try:
+        assert ran.wait(5)
+        assert calls == [True]
+        # The next run is due after interval * BATTERY_INTERVAL_FACTOR.
+        assert job.deadline - first_deadline == 60 * 3
+    finally:
+        job.stop()
+
+
+def test_deferred_run_keeps_deadline(monkeypatch):
+    monkeypatch.setattr(power, "POWER_AWARE", False)
+    monkeypatch.setattr(governor, "PRESSURE_RETRY_DELAY", 0.05)
+    pressure = [True, True]
+    monkeypatch.setattr(governor, "under_pressure",
+                        lambda: pressure.pop(0) if pressure else False)
+    ran = threading.Event()
+
+    scheduler = wpproc.SlideshowScheduler()
+    job = wpproc.ScheduledJob(scheduler, 60, ran.set, power_aware=True)
+    job.start(0.05)
+    first_deadline = job.deadline
+    try:
+        assert ran.wait(5)
+        assert not pressure
+        # The retries under pressure leave the drift free deadline alone.
+        assert job.deadline == first_deadline + 60
+    finally:
+        job.stop()
@@ -0,0 +1,172 @@
+"""Tests of the wallpaper setter backends."""
+
+import os
+import platform
+
+import pytest
+
+import superpaper.spanmode as spanmode
+import superpaper.wallpaper_processing as wpproc
+import superpaper.wallpaper_setters as setters
+
+
+@pytest.fixture
+def linux(monkeypatch):
+    monkeypatch.setattr(platform, "system", lambda: "Linux")
+    monkeypatch.setattr(wpproc, "G_SET_COMMAND_STRING", "")
+    monkeypatch.setattr(wpproc, "G_ACTIVE_DISPLAYSYSTEM", None)
+    yield
+    setters.set_backend(None)
+
+
+def test_stub_backend_is_forced_from_environment(linux, monkeypatch):
+    monkeypatch.setenv("SUPERPAPER_SETTER_BACKEND", "stub")
+    setters.set_backend(None)
+    backend = setters.get_backend()
+    assert isinstance(backend, setters.StubBackend)
+    assert setters.get_backend() is backend
+
+
+def test_set_wallpaper_linux_spanned(linux):
+    backend = setters.StubBackend()
+    setters.set_backend(backend)
+    spanmode.set_spanmode()
+    assert wpproc.set_wallpaper_linux("/tmp/wall-a.png") is None
+    assert wpproc.set_wallpaper_linux("/tmp/wall-b.png") is None
+    assert backend.calls == [
+        ("set_spanmode",),
+        ("set_wallpaper", "/tmp/wall-a.png"),
+        ("set_wallpaper", "/tmp/wall-b.png"),
+    ]
+
+
+def test_set_wallpaper_linux_piecewise(linux):
+    backend = setters.StubBackend(piecewise=True)
+    setters.set_backend(backend)
+    spanmode.set_spanmode()
+    pieces = ["/tmp/piece0.png", "/tmp/piece1.png"]
+    assert wpproc.set_wallpaper_linux(None, piece_files=pieces, changed=[1]) == pieces
+    assert wpproc.set_wallpaper_piecewise(pieces) == 0
+    assert backend.calls == [
+        ("set_spanmode",),
+        ("set_pieces", pieces, [1]),
+        ("set_pieces", pieces, None),
+    ]
+    assert [call[0] for call in backend.calls].count("set_spanmode") == 1
+
+
+XFCE_PROPS = [
+    "/backdrop/screen0/monitorDP-1/workspace0/image-style",
+    "/backdrop/screen0/monitorDP-1/workspace0/last-image",
+    "/backdrop/screen0/monitorDP-1/workspace1/last-image",
+    "/backdrop/screen0/monitorHDMI-1/workspace0/last-image",
+]
+XFCE_PIECES = ["/tmp/piece0.png", "/tmp/piece1.png"]
+
+
+class FakeXfconf():
+    """Stands in for the org.xfce.Xfconf D-Bus object and its bus."""
+    def __init__(self, props):
+        self.props = dict.fromkeys(props, "")
+        self.set_calls = []
+
+    def get_object(self, bus_name, object_path):
+        return self
+
+    def GetAllProperties(self, channel, base, timeout=None):
+        return {prop: value for prop, value in self.props.items() if prop.startswith(base)}
+
+    def SetProperty(self, channel, prop, value, timeout=None):
+        self.set_calls.append((channel, prop, value))
+        self.props[prop] = value
+
+
+class FakeDBusException(Exception):
+    pass
+
+
+def fake_dbus():
+    return type("dbus", (), {
+        "Interface": staticmethod(lambda obj, dbus_interface: obj),
+        "String": str,
+        "Int32": int,
+        "exceptions": type("exceptions", (), {"DBusException": FakeDBusException}),
+    })
+
+
+def xfce_backend(bus):
+    backend = setters.XfceBackend(bus=bus)
+    backend.dbus = fake_dbus()
+    batches = []
+    set_properties = backend.set_properties
+
+    def record_batch(updates):
+        batches.append(list(updates))
+        set_properties(updates)
+    backend.set_properties = record_batch
+    return backend, batches
+
+
+def test_xfce_pieces_land_on_their_monitors():
+    xfconf = FakeXfconf(XFCE_PROPS)
+    backend, batches = xfce_backend(xfconf)
+    backend.set_pieces(XFCE_PIECES, ["DP-1", "HDMI-1"]).result(5)
+
+    assert len(batches) == 1
+    assert xfconf.props["/backdrop/screen0/monitorDP-1/workspace0/last-image"] == XFCE_PIECES[0]
+    assert xfconf.props["/backdrop/screen0/monitorDP-1/workspace1/last-image"] == XFCE_PIECES[0]
+    assert xfconf.props["/backdrop/screen0/monitorHDMI-1/workspace0/last-image"] == XFCE_PIECES[1]
+    assert xfconf.props["/backdrop/screen0/monitorDP-1/workspace0/image-style"] == \
+        setters.XFCE_STYLE_ZOOMED
+    assert all(channel == setters.XFCE_CHANNEL for channel, _, _ in xfconf.set_calls)
+
+
+def test_xfce_changed_leaves_other_monitors_alone():
+    xfconf = FakeXfconf(XFCE_PROPS)
+    backend, batches = xfce_backend(xfconf)
+    backend.set_pieces(XFCE_PIECES, ["DP-1", "HDMI-1"], changed=[1]).result(5)
+
+    assert len(batches) == 1
+    assert [prop for _, prop, _ in xfconf.set_calls] == [
+        "/backdrop/screen0/monitorHDMI-1/workspace0/image-style",
+        "/backdrop/screen0/monitorHDMI-1/workspace0/last-image",
+    ]
+    assert xfconf.props["/backdrop/screen0/monitorDP-1/workspace0/last-image"] == ""
+
+
+def test_xfce_xfconf_query_fallback(tmp_path, monkeypatch):
+    log = tmp_path / "xfconf.log"
+    props = tmp_path / "props"
+    props.write_text("\n".join(XFCE_PROPS) + "\n")
+    script = tmp_path / "xfconf-query"
+    script.write_text('#!/bin/sh\n'
+                      'echo "$*" >> "{}"\n'
+                      'case "$*" in *" -l") cat "{}";; esac\n'.format(log, props))
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    commands = []
+    run_command = setters.run_command
+
+    def record_command(args, timeout=setters.SETTER_TIMEOUT):
+        commands.append(args)
+        return run_command(args, timeout)
+    monkeypatch.setattr(setters, "run_command", record_command)
+
+    backend = setters.XfceBackend()
+    backend.dbus = None
+    backend.set_pieces(XFCE_PIECES, ["DP-1", "HDMI-1"], changed=[0]).result(5)
+
+    assert len(commands) == 1
+    calls = log.read_text().splitlines()
+    assert calls[0].endswith("-l")
+    set_calls = calls[1:]
+    assert set_calls == [
+        "-c xfce4-desktop -p {} --create -t {} -s {}".format(prop, vtype, value)
+        for prop, vtype, value in [
+            ("/backdrop/screen0/monitorDP-1/workspace0/image-style", "int",
+             setters.XFCE_STYLE_ZOOMED),
+            ("/backdrop/screen0/monitorDP-1/workspace0/last-image", "string", XFCE_PIECES[0]),
+            ("/backdrop/screen0/monitorDP-1/workspace1/image-style", "int",
+             setters.XFCE_STYLE_ZOOMED),
+            ("/backdrop/screen0/monitorDP-1/workspace1/last-image", "string", XFCE_PIECES[0]),
+        ]]